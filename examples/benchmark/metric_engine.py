@@ -0,0 +1,101 @@
+"""
+Benchmark the metric computation of `Evaluator`.
+
+Builds a synthetic dataset of predictions / golden answers (100k items by default) and evaluates
+em / acc / f1 / recall / precision with:
+    - legacy: every metric normalizes and tokenizes the texts again (the previous behavior)
+    - serial: shared normalization / score caches in the main process
+    - parallel: the same with `metric_setting.num_workers` processes
+
+Example:
+    python metric_engine.py --num_items 100000 --num_workers 1 4 8
+"""
+
+import argparse
+import random
+import time
+from collections import Counter
+from flashrag.dataset import Dataset
+from flashrag.evaluator import Evaluator
+from flashrag.evaluator.metrics import cached_token_level_scores
+from flashrag.evaluator.utils import normalize_answer, cached_normalize_answer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num_items", type=int, default=100000)
+parser.add_argument("--num_workers", type=int, nargs="+", default=[1, 4, 8])
+parser.add_argument("--seed", type=int, default=2024)
+args = parser.parse_args()
+
+METRICS = ["em", "acc", "f1", "recall", "precision"]
+WORDS = ["the", "a", "of", "river", "city", "king", "war", "1945", "paris", "john", "smith", "blue", "new", "york"]
+
+
+def random_text(min_len, max_len):
+    text = " ".join(random.choice(WORDS) for _ in range(random.randint(min_len, max_len)))
+    return text.capitalize() + random.choice(["", ".", "!", ","])
+
+
+def build_dataset(num_items):
+    data = []
+    for idx in range(num_items):
+        golden_answers = [random_text(1, 4) for _ in range(random.randint(1, 3))]
+        pred = random.choice(golden_answers) if random.random() < 0.3 else random_text(1, 12)
+        data.append(
+            {"id": str(idx), "question": random_text(5, 15), "golden_answers": golden_answers, "output": {"pred": pred}}
+        )
+    return Dataset(config={"dataset_name": "synthetic"}, data=data)
+
+
+def legacy_scores(pred, golden_answers):
+    """Per-metric computation without shared caches, each metric repeats the normalization."""
+    em = float(any(normalize_answer(answer) == normalize_answer(pred) for answer in golden_answers))
+    acc = float(any(normalize_answer(answer) in normalize_answer(pred) for answer in golden_answers))
+    token_scores = []
+    for _ in ["f1", "recall", "precision"]:
+        best = {"f1": 0, "precision": 0, "recall": 0}
+        for answer in golden_answers:
+            pred_tokens, answer_tokens = normalize_answer(pred).split(), normalize_answer(answer).split()
+            num_same = sum((Counter(pred_tokens) & Counter(answer_tokens)).values())
+            if num_same == 0:
+                continue
+            precision, recall = num_same / len(pred_tokens), num_same / len(answer_tokens)
+            best["f1"] = max(best["f1"], 2 * precision * recall / (precision + recall))
+            best["precision"] = max(best["precision"], precision)
+            best["recall"] = max(best["recall"], recall)
+        token_scores.append(best)
+    return em, acc, token_scores
+
+
+def get_config(num_workers):
+    return {
+        "dataset_name": "synthetic",
+        "save_dir": "",
+        "save_metric_score": False,
+        "save_intermediate_data": False,
+        "metrics": METRICS,
+        "metric_setting": {"num_workers": num_workers, "min_parallel_items": 0},
+    }
+
+
+if __name__ == "__main__":
+    random.seed(args.seed)
+    dataset = build_dataset(args.num_items)
+
+    start_time = time.time()
+    for item in dataset:
+        legacy_scores(item.pred, item.golden_answers)
+    legacy_time = time.time() - start_time
+    print(f"legacy | time: {legacy_time:.3f} | items_per_second: {len(dataset) / legacy_time:.1f}")
+
+    for num_workers in args.num_workers:
+        # start from cold caches for each setting
+        cached_token_level_scores.cache_clear()
+        cached_normalize_answer.cache_clear()
+        evaluator = Evaluator(get_config(num_workers))
+        start_time = time.time()
+        result = evaluator.evaluate(dataset)
+        elapsed = time.time() - start_time
+        print(
+            f"num_workers: {num_workers} | time: {elapsed:.3f} | items_per_second: {len(dataset) / elapsed:.1f} "
+            f"| speedup: {legacy_time / elapsed:.2f} | {result}"
+        )
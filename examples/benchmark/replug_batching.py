@@ -0,0 +1,75 @@
+"""
+Benchmark batched REPLUG generation.
+
+Runs `REPLUGPipeline` with one question per generation batch (the previous behavior) and with the docs of
+several questions packed into one batch, and reports the throughput of each setting.
+
+Example:
+    python replug_batching.py --model_path meta-llama/Llama-2-7b-hf --retriever_path intfloat/e5-base-v2 \
+        --index_path indexes/e5_Flat.index --corpus_path indexes/wiki18.jsonl --batch_sizes 1 4 8 16
+"""
+
+import argparse
+import time
+from flashrag.config import Config
+from flashrag.utils import get_dataset, get_retriever
+from flashrag.pipeline import REPLUGPipeline
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model_path", type=str)
+parser.add_argument("--retriever_path", type=str)
+parser.add_argument("--index_path", type=str)
+parser.add_argument("--corpus_path", type=str)
+parser.add_argument("--data_dir", type=str, default="dataset/")
+parser.add_argument("--dataset_name", type=str, default="nq")
+parser.add_argument("--split", type=str, default="test")
+parser.add_argument("--sample_num", type=int, default=200)
+parser.add_argument("--retrieval_topk", type=int, default=5)
+parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+args = parser.parse_args()
+
+config_dict = {
+    "data_dir": args.data_dir,
+    "dataset_name": args.dataset_name,
+    "split": [args.split],
+    "test_sample_num": args.sample_num,
+    "framework": "hf",
+    "generator_model": "replug",
+    "generator_model_path": args.model_path,
+    "generation_params": {"max_new_tokens": 32},
+    "retrieval_method": "e5",
+    "retrieval_model_path": args.retriever_path,
+    "index_path": args.index_path,
+    "corpus_path": args.corpus_path,
+    "retrieval_topk": args.retrieval_topk,
+    "disable_save": True,
+    "save_intermediate_data": False,
+    "metrics": ["em", "f1"],
+}
+
+
+if __name__ == "__main__":
+    config = Config(config_dict=config_dict)
+    dataset = get_dataset(config)[args.split]
+    # models are loaded once and shared by all settings
+    retriever = get_retriever(config)
+    pipeline = REPLUGPipeline(config, retriever=retriever)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        pipeline.batch_size = batch_size
+        start_time = time.time()
+        pipeline.run(dataset, do_eval=False)
+        elapsed = time.time() - start_time
+        results.append(
+            {
+                "batch_size": batch_size,
+                "rows_per_batch": batch_size * args.retrieval_topk,
+                "time": elapsed,
+                "questions_per_second": len(dataset) / elapsed,
+            }
+        )
+
+    for result in results:
+        result["speedup"] = results[0]["time"] / result["time"]
+        print(" | ".join(f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}" for k, v in result.items()))
@@ -0,0 +1,137 @@
+"""
+Benchmark assisted (speculative) generation of `HFCausalLMGenerator`.
+
+Compares plain decoding with draft-model assisted generation and prompt lookup decoding
+on NQ / HotpotQA style prompts, and reports throughput, speedup and acceptance statistics.
+
+Example:
+    python speculative_decoding.py --model_path meta-llama/Llama-3.1-8B-Instruct \
+        --draft_model_path meta-llama/Llama-3.2-1B-Instruct --dataset_name nq --sample_num 100
+"""
+
+import argparse
+import time
+from flashrag.config import Config
+from flashrag.utils import get_dataset, get_retriever
+from flashrag.prompt import PromptTemplate
+from flashrag.generator import HFCausalLMGenerator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model_path", type=str)
+parser.add_argument("--draft_model_path", type=str, default=None)
+parser.add_argument("--prompt_lookup_num_tokens", type=int, default=10)
+parser.add_argument("--num_assistant_tokens", type=int, default=5)
+parser.add_argument("--data_dir", type=str, default="dataset/")
+parser.add_argument("--dataset_name", type=str, default="nq")  # nq / hotpotqa
+parser.add_argument("--split", type=str, default="test")
+parser.add_argument("--sample_num", type=int, default=100)
+parser.add_argument("--max_new_tokens", type=int, default=32)
+parser.add_argument("--use_retrieval", action="store_true")
+parser.add_argument("--index_path", type=str, default=None)
+parser.add_argument("--corpus_path", type=str, default=None)
+parser.add_argument("--retriever_path", type=str, default=None)
+args = parser.parse_args()
+
+
+class ForwardCounter:
+    """Count forward calls of a model, each forward of the target model verifies one round of draft tokens."""
+
+    def __init__(self, model):
+        self.num_calls = 0
+        self.handle = model.register_forward_hook(self.hook)
+
+    def hook(self, module, inputs, outputs):
+        self.num_calls += 1
+
+    def reset(self):
+        self.num_calls = 0
+
+
+def build_config(mode):
+    config_dict = {
+        "data_dir": args.data_dir,
+        "dataset_name": args.dataset_name,
+        "split": [args.split],
+        "test_sample_num": args.sample_num,
+        "framework": "hf",
+        "generator_model": "generator",
+        "generator_model_path": args.model_path,
+        "generation_params": {"max_new_tokens": args.max_new_tokens, "do_sample": False},
+        "generator_batch_size": 1,
+        "disable_save": True,
+        "save_intermediate_data": False,
+    }
+    if args.use_retrieval:
+        config_dict.update(
+            {
+                "retrieval_method": "e5",
+                "retrieval_model_path": args.retriever_path,
+                "index_path": args.index_path,
+                "corpus_path": args.corpus_path,
+            }
+        )
+    if mode == "draft":
+        config_dict["generator_draft_model_path"] = args.draft_model_path
+        config_dict["num_assistant_tokens"] = args.num_assistant_tokens
+    elif mode == "prompt_lookup":
+        config_dict["prompt_lookup_num_tokens"] = args.prompt_lookup_num_tokens
+    return Config(config_dict=config_dict)
+
+
+def build_prompts(config):
+    dataset = get_dataset(config)[args.split]
+    prompt_template = PromptTemplate(config)
+    if args.use_retrieval:
+        retriever = get_retriever(config)
+        retrieval_results = retriever.batch_search(dataset.question)
+        return [prompt_template.get_string(question=q, retrieval_result=r) for q, r in zip(dataset.question, retrieval_results)]
+    return [prompt_template.get_string(question=q) for q in dataset.question]
+
+
+def run(mode, prompts, generator=None):
+    config = build_config(mode)
+    if generator is None:
+        generator = HFCausalLMGenerator(config)
+    else:
+        # reuse loaded target model, only change the assisted generation setting
+        generator.config = config
+        generator.draft_model = generator._load_draft_model() if generator.draft_model_path is not None else None
+
+    target_counter = ForwardCounter(generator.model)
+    draft_counter = ForwardCounter(generator.draft_model) if generator.draft_model is not None else None
+
+    start_time = time.time()
+    responses = generator.generate(prompts, batch_size=1)
+    elapsed = time.time() - start_time
+
+    num_tokens = sum(len(generator.tokenizer.encode(r, add_special_tokens=False)) for r in responses)
+    # exclude the prefill forward of each prompt
+    num_verify_steps = max(target_counter.num_calls - len(prompts), 1)
+    result = {
+        "mode": mode,
+        "time": elapsed,
+        "tokens_per_second": num_tokens / elapsed,
+        "tokens_per_target_forward": num_tokens / num_verify_steps,
+    }
+    if draft_counter is not None:
+        num_accepted = max(num_tokens - num_verify_steps, 0)
+        num_proposed = max(draft_counter.num_calls - len(prompts), 1)
+        result["acceptance_rate"] = num_accepted / num_proposed
+    target_counter.handle.remove()
+    if draft_counter is not None:
+        draft_counter.handle.remove()
+    return result, generator
+
+
+if __name__ == "__main__":
+    prompts = build_prompts(build_config("baseline"))
+
+    baseline, generator = run("baseline", prompts)
+    all_results = [baseline]
+    if args.draft_model_path is not None:
+        all_results.append(run("draft", prompts, generator)[0])
+    all_results.append(run("prompt_lookup", prompts, generator)[0])
+
+    for result in all_results:
+        result["speedup"] = baseline["time"] / result["time"]
+        print(" | ".join(f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}" for k, v in result.items()))
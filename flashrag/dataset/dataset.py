@@ -1,11 +1,83 @@
 import os
+import copy
 import json
 import random
+import itertools
 import warnings
 import datasets
-from typing import List, Dict, Any, Optional, Generator
+from collections.abc import Sequence
+from typing import List, Dict, Any, Optional, Generator, Iterable, Iterator
 import numpy as np
 
+
+def iter_records(dataset_path: str) -> Iterator[Dict[str, Any]]:
+    """Lazily read the raw records of a data file, one sample at a time."""
+    if not os.path.exists(dataset_path):
+        raise FileNotFoundError(f"Dataset file {dataset_path} not found.")
+
+    if dataset_path.endswith(".jsonl") or dataset_path.endswith(".json"):
+        with open(dataset_path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+    elif dataset_path.endswith("parquet"):
+        hf_data = datasets.load_dataset("parquet", data_files=dataset_path, split="train", streaming=True)
+        hf_data = hf_data.cast_column("image", datasets.Image())
+        for record in hf_data:
+            yield record
+    else:
+        raise NotImplementedError
+
+
+def sample_records(records: Iterable[Any], sample_num: Optional[int] = None, random_sample: bool = False) -> List[Any]:
+    """Take `sample_num` records from a stream, only the kept records are held in memory.
+
+    The first `sample_num` records are taken without reading the rest of the stream, a random sample
+    is drawn with reservoir sampling in one pass.
+    """
+    if sample_num is None:
+        return list(records)
+    if not random_sample:
+        return list(itertools.islice(records, sample_num))
+
+    reservoir = []
+    for idx, record in enumerate(records):
+        if idx < sample_num:
+            reservoir.append(record)
+        else:
+            replace_idx = random.randint(0, idx)
+            if replace_idx < sample_num:
+                reservoir[replace_idx] = record
+    return reservoir
+
+
+class DatasetWriter:
+    """Incrementally write items into a JSONL file, one line per item.
+
+    Each `write` call is flushed, so the results of a running job can be read while it is running.
+    Use as a context manager, or call `close` when finished.
+    """
+
+    def __init__(self, save_path: str, mode: str = "w") -> None:
+        self.save_path = save_path
+        self.file = open(save_path, mode, encoding="utf-8")
+        self.num_items = 0
+
+    def write(self, items: Iterable["Item"]) -> None:
+        for item in items:
+            self.file.write(json.dumps(item.to_dict(), ensure_ascii=False) + "\n")
+            self.num_items += 1
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "DatasetWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
 class Item:
     """A container class used to store and manipulate a sample within a dataset.
     Information related to this sample during training/inference will be stored in `self.output`.
@@ -109,37 +181,41 @@ class Dataset:
                 self.data = data
 
     def _load_data(self, dataset_name: str, dataset_path: str) -> List[Item]:
-        """Load data from the provided dataset_path or directly download the file(TODO)."""
-        if not os.path.exists(dataset_path):
-            # TODO: auto download: self._download(self.dataset_name, dataset_path)
-            raise FileNotFoundError(f"Dataset file {dataset_path} not found.")
-
-        data = []
-        if dataset_path.endswith(".jsonl") or dataset_path.endswith(".json"):
-            with open(dataset_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    item_dict = json.loads(line)
-                    item = Item(item_dict)
-                    data.append(item)
-        elif dataset_path.endswith('parquet'):
-            hf_data = datasets.load_dataset('parquet', data_files=dataset_path, split="train")
-            hf_data = hf_data.cast_column('image', datasets.Image())
-            for item in hf_data:
-                item = Item(item)
-                data.append(item)
-        else:
-            raise NotImplementedError
-        
+        """Load data from the provided dataset_path or directly download the file(TODO).
+        The file is read as a stream, so only the sampled items are kept in memory."""
         if self.sample_num is not None:
             self.sample_num = int(self.sample_num)
             if self.random_sample:
                 print(f"Random sample {self.sample_num} items in test set.")
-                data = random.sample(data, self.sample_num)
-            else:
-                data = data[: self.sample_num]
-
+        data = sample_records(
+            (Item(item_dict) for item_dict in iter_records(dataset_path)), self.sample_num, self.random_sample
+        )
         return data
 
+    @classmethod
+    def iter_chunks(
+        cls,
+        config: Optional[Dict[str, Any]],
+        dataset_path: str,
+        chunk_size: int,
+        sample_num: Optional[int] = None,
+        random_sample: bool = False,
+    ) -> Generator["Dataset", None, None]:
+        """Lazily load a data file as datasets of `chunk_size` items, so a huge file can be run chunk by chunk.
+        Without random sampling, at most one chunk is held in memory."""
+        items = (Item(item_dict) for item_dict in iter_records(dataset_path))
+        if sample_num is not None:
+            sample_num = int(sample_num)
+            if random_sample:
+                items = iter(sample_records(items, sample_num, random_sample=True))
+            else:
+                items = itertools.islice(items, sample_num)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if len(chunk) == 0:
+                return
+            yield cls(config=config, data=chunk)
+
     def update_output(self, key: str, value_list: List[Any]) -> None:
         """Update the overall output field for each sample in the dataset."""
         assert len(self.data) == len(value_list)
@@ -184,8 +260,12 @@ class Dataset:
         return len(self.data)
 
     def save(self, save_path: str) -> None:
-        """Save the dataset into the original format."""
+        """Save the dataset into the original format, a `.jsonl` path is written item by item."""
 
+        if save_path.endswith(".jsonl"):
+            with DatasetWriter(save_path) as writer:
+                writer.write(self.data)
+            return
         save_data = [item.to_dict() for item in self.data]
         with open(save_path, "w", encoding="utf-8") as f:
             json.dump(save_data, f, indent=4, ensure_ascii=False)
@@ -194,3 +274,414 @@ class Dataset:
     def __str__(self) -> str:
         """Return a string representation of the dataset with a summary of items."""
         return f"Dataset '{self.dataset_name}' with {len(self)} items"
+
+
+class RaggedColumn(Sequence):
+    """A column whose rows are variable-length lists, stored as one flat NumPy array with row offsets.
+
+    Rows of docs (e.g. retrieval results) are stored as int ids into a doc pool shared by the whole
+    dataset, so each doc is kept once no matter how many items retrieved it. Rows of numbers keep their
+    dtype (int or float). Rows updated one by one after building are kept in `overrides`.
+    The column is a read-only sequence of rows, a row is built as a list only when it is read.
+    """
+
+    def __init__(self, rows: List[List[Any]], doc_pool: Optional["DocPool"] = None, dtype: Any = None) -> None:
+        self.doc_pool = doc_pool
+        lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        self.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        flat_values = [value for row in rows for value in row]
+        if doc_pool is not None:
+            self.values = np.array([doc_pool.add(doc) for doc in flat_values], dtype=np.int64)
+        else:
+            if dtype is None:
+                dtype = RaggedColumn.get_numeric_dtype(rows)
+            self.values = np.array(flat_values, dtype=dtype)
+        self.overrides = {}
+
+    @staticmethod
+    def is_doc_rows(rows: List[Any]) -> bool:
+        """Whether every row is a list of corpus docs (dicts with `contents`)."""
+        has_doc = False
+        for row in rows:
+            if not isinstance(row, list):
+                return False
+            for value in row:
+                if not isinstance(value, dict) or "contents" not in value:
+                    return False
+                has_doc = True
+        return has_doc
+
+    @staticmethod
+    def get_numeric_dtype(rows: List[Any]) -> Any:
+        """`np.int64` / `np.float64` if every row is a flat list of ints / floats (e.g. doc scores),
+        otherwise None. Rows mixing ints and floats are not numeric rows, so no value changes its type."""
+        kinds = set()
+        for row in rows:
+            if isinstance(row, np.ndarray):
+                if row.ndim != 1 or row.dtype.kind not in "iuf":
+                    return None
+                if len(row) > 0:
+                    kinds.add("f" if row.dtype.kind == "f" else "i")
+            elif isinstance(row, list):
+                for value in row:
+                    if isinstance(value, (bool, np.bool_)):
+                        return None
+                    if isinstance(value, (int, np.integer)):
+                        kinds.add("i")
+                    elif isinstance(value, (float, np.floating)):
+                        kinds.add("f")
+                    else:
+                        return None
+            else:
+                return None
+            if len(kinds) > 1:
+                return None
+        if kinds == {"i"}:
+            return np.int64
+        if kinds == {"f"}:
+            return np.float64
+        return None
+
+    @staticmethod
+    def is_numeric_rows(rows: List[Any]) -> bool:
+        """Whether every row is a flat list of numbers of one type (e.g. doc scores)."""
+        return RaggedColumn.get_numeric_dtype(rows) is not None
+
+    def accepts(self, row: Any) -> bool:
+        """Whether a row can be stored in this column without changing its values."""
+        if isinstance(row, (list, np.ndarray)) and len(row) == 0:
+            return True
+        if self.doc_pool is not None:
+            return RaggedColumn.is_doc_rows([row])
+        return RaggedColumn.get_numeric_dtype([row]) == self.values.dtype
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_row_values(self, index: int) -> np.ndarray:
+        """Raw stored values of a row (doc ids for doc rows)."""
+        if index in self.overrides:
+            return self.overrides[index]
+        return self.values[self.offsets[index] : self.offsets[index + 1]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RaggedColumn index out of range")
+        row_values = self.get_row_values(index)
+        if self.doc_pool is not None:
+            # copies, so changing a doc of one item does not change the other items
+            return [dict(self.doc_pool.docs[doc_id]) for doc_id in row_values]
+        return row_values.tolist()
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __setitem__(self, index: int, row: List[Any]) -> None:
+        if self.doc_pool is not None:
+            self.overrides[index] = np.array([self.doc_pool.add(doc) for doc in row], dtype=np.int64)
+        else:
+            self.overrides[index] = np.array(row, dtype=self.values.dtype)
+
+    def as_arrays(self):
+        """The flat values (doc ids for doc rows) and the row offsets, row `i` is
+        `values[offsets[i]:offsets[i + 1]]`. Overridden rows are merged in first."""
+        if len(self.overrides) > 0:
+            rows = [self.get_row_values(index) for index in range(len(self))]
+            lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+            np.cumsum(lengths, out=self.offsets[1:])
+            self.values = np.concatenate(rows).astype(self.values.dtype) if len(rows) > 0 else self.values
+            self.overrides = {}
+        return self.values, self.offsets
+
+    def to_list(self) -> List[List[Any]]:
+        return [self[index] for index in range(len(self))]
+
+    def __repr__(self) -> str:
+        return repr(self.to_list())
+
+
+class DocPool:
+    """Docs referenced by the ragged doc columns of a dataset, each distinct doc is stored once.
+
+    Docs are keyed by their corpus id and a hash of their fields, so a doc rewritten under the same id
+    (e.g. by a refiner) is stored as a new entry. Stored docs are copies, changing the dict passed to
+    `add` afterwards does not change the pool.
+    """
+
+    def __init__(self) -> None:
+        self.docs = []
+        self.key2id = {}
+
+    @staticmethod
+    def get_doc_key(doc: Dict[str, Any]) -> Any:
+        fields = tuple(
+            (key, value) for key, value in sorted(doc.items()) if isinstance(value, (str, int, float, bool, type(None)))
+        )
+        return (doc.get("id"), hash(fields))
+
+    def add(self, doc: Dict[str, Any]) -> int:
+        doc_key = self.get_doc_key(doc)
+        if doc_key not in self.key2id:
+            self.key2id[doc_key] = len(self.docs)
+            self.docs.append(dict(doc))
+        return self.key2id[doc_key]
+
+
+class ItemView(Item):
+    """A row of a `ColumnarDataset` exposed with the `Item` API, reads and updates go to the columns."""
+
+    def __init__(self, dataset: "ColumnarDataset", index: int) -> None:
+        object.__setattr__(self, "_dataset", dataset)
+        object.__setattr__(self, "_index", index)
+
+    @property
+    def id(self) -> Optional[str]:
+        return self._dataset._columns["id"][self._index]
+
+    @property
+    def question(self) -> Optional[str]:
+        return self._dataset._columns["question"][self._index]
+
+    @property
+    def golden_answers(self) -> List[str]:
+        return self._dataset._columns["golden_answers"][self._index]
+
+    @property
+    def choices(self) -> List[str]:
+        return self._dataset._columns["choices"][self._index]
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self._dataset._columns["metadata"][self._index]
+
+    @property
+    def output(self) -> Dict[str, Any]:
+        return self._dataset._get_row_output(self._index)
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        return {key: column[self._index] for key, column in self._dataset._columns.items() if key in self._dataset._raw_keys}
+
+    def update_output(self, key: str, value: Any) -> None:
+        if key in ["id", "question", "golden_answers", "output", "choices"]:
+            raise AttributeError(f"{key} should not be changed")
+        self._dataset._set_output_value(key, self._index, value)
+
+    def update_evaluation_score(self, metric_name: str, metric_score: float) -> None:
+        metric_scores = self._dataset._get_output_value("metric_score", self._index)
+        if metric_scores is None:
+            metric_scores = {}
+            self._dataset._set_output_value("metric_score", self._index, metric_scores)
+        metric_scores[metric_name] = metric_score
+
+    def __getattr__(self, attr_name: str) -> Any:
+        dataset = object.__getattribute__(self, "_dataset")
+        index = object.__getattribute__(self, "_index")
+        if attr_name in dataset._output_columns:
+            value = dataset._get_output_value(attr_name, index)
+            if value is not None or dataset._has_output_value(attr_name, index):
+                return value
+        if attr_name in dataset._columns:
+            return dataset._columns[attr_name][index]
+        raise AttributeError(f"Attribute `{attr_name}` not found")
+
+    def to_dict(self) -> Dict[str, Any]:
+        from flashrag.dataset.utils import convert_numpy, remove_images, clean_prompt_image
+
+        output = remove_images(self.data)
+        output_dict = self.output
+        # clean base64 image
+        if "prompt" in output_dict:
+            output_dict["prompt"] = clean_prompt_image(output_dict["prompt"])
+        output["output"] = remove_images(convert_numpy(output_dict))
+        if self.metadata:
+            output["metadata"] = remove_images(self.metadata)
+        return output
+
+
+class ColumnarDataset(Dataset):
+    """A `Dataset` storing each field as a column instead of a list of `Item` dicts.
+
+    Fixed fields and outputs are kept as one list per field, outputs made of doc lists (e.g. retrieval
+    results) or number lists (e.g. doc scores) are kept as `RaggedColumn`, with docs stored once in a
+    shared pool. Attribute access (`dataset.question`, `dataset.retrieval_result`) returns the column
+    without rebuilding it per item (ragged columns are returned as lazy `RaggedColumn` sequences, their
+    flat arrays are available from `get_ragged_arrays`), and `dataset[i]` returns an `ItemView` with the same API as `Item`.
+    """
+
+    FIXED_KEYS = ["id", "question", "golden_answers", "choices", "metadata"]
+    FIXED_DEFAULTS = {"id": None, "question": None, "golden_answers": [], "choices": [], "metadata": {}}
+
+    def __init__(
+        self,
+        config: Optional[Dict[str, Any]] = None,
+        dataset_path: Optional[str] = None,
+        data: Optional[List[Dict[str, Any]]] = None,
+        sample_num: Optional[int] = None,
+        random_sample: bool = False,
+    ) -> None:
+        if config is not None:
+            self.config = config
+            dataset_name = config["dataset_name"] if "dataset_name" in config else "defalut_dataset"
+        else:
+            self.config = None
+            warnings.warn("dataset_name is not in config, set it as default.")
+            dataset_name = "default_dataset"
+        self.dataset_name = dataset_name
+        self.dataset_path = dataset_path
+        self.sample_num = sample_num
+        self.random_sample = random_sample
+
+        self.doc_pool = DocPool()
+        self._output_columns = {}
+        if data is None:
+            records = self._load_records(self.dataset_path)
+        else:
+            records = [item.to_dict() if isinstance(item, Item) else item for item in data]
+        self._build_columns(records)
+
+    def _load_records(self, dataset_path: str) -> List[Dict[str, Any]]:
+        if self.sample_num is not None:
+            self.sample_num = int(self.sample_num)
+            if self.random_sample:
+                print(f"Random sample {self.sample_num} items in test set.")
+        return sample_records(iter_records(dataset_path), self.sample_num, self.random_sample)
+
+    def _build_columns(self, records: List[Dict[str, Any]]) -> None:
+        raw_keys = list(dict.fromkeys(key for record in records for key in record if key != "output"))
+        self._raw_keys = set(raw_keys)
+        self._columns = {
+            key: [record[key] if key in record else copy.copy(self.FIXED_DEFAULTS.get(key)) for record in records]
+            for key in list(dict.fromkeys(self.FIXED_KEYS + raw_keys))
+        }
+        self._num_rows = len(records)
+        output_keys = list(dict.fromkeys(key for record in records for key in record.get("output", {})))
+        for key in output_keys:
+            # rows without the key stay unset, as in their `Item`
+            self.update_output(key, [record.get("output", {}).get(key, _MISSING) for record in records])
+
+    def _get_row_output(self, index: int) -> Dict[str, Any]:
+        return {
+            key: self._get_output_value(key, index)
+            for key in self._output_columns
+            if self._has_output_value(key, index)
+        }
+
+    def _has_output_value(self, key: str, index: int) -> bool:
+        column = self._output_columns[key]
+        if isinstance(column, RaggedColumn):
+            return True
+        return column[index] is not _MISSING
+
+    def _get_output_value(self, key: str, index: int) -> Any:
+        if key not in self._output_columns:
+            return None
+        value = self._output_columns[key][index]
+        return None if value is _MISSING else value
+
+    def _set_output_value(self, key: str, index: int, value: Any) -> None:
+        if key not in self._output_columns:
+            self._output_columns[key] = [_MISSING] * self._num_rows
+        column = self._output_columns[key]
+        if isinstance(column, RaggedColumn) and not column.accepts(value):
+            # the value does not fit a ragged column, fall back to a plain list
+            column = self._output_columns[key] = column.to_list()
+        column[index] = value
+
+    @property
+    def data(self) -> List[Item]:
+        return [ItemView(self, index) for index in range(self._num_rows)]
+
+    def update_output(self, key: str, value_list: List[Any]) -> None:
+        """Update an output column at once, lists of docs / numbers are stored as ragged columns."""
+        assert self._num_rows == len(value_list)
+        numeric_dtype = RaggedColumn.get_numeric_dtype(value_list)
+        if RaggedColumn.is_doc_rows(value_list):
+            self._output_columns[key] = RaggedColumn(value_list, doc_pool=self.doc_pool)
+        elif numeric_dtype is not None:
+            self._output_columns[key] = RaggedColumn(value_list, dtype=numeric_dtype)
+        else:
+            self._output_columns[key] = list(value_list)
+
+    def get_column(self, attr_name: str) -> Any:
+        """The stored column of a field, without copying (a `RaggedColumn` for ragged outputs)."""
+        if attr_name in self._output_columns:
+            return self._output_columns[attr_name]
+        return self._columns[attr_name]
+
+    def get_ragged_arrays(self, attr_name: str):
+        """Flat values and row offsets of a ragged output column (see `RaggedColumn.as_arrays`),
+        for doc columns the values are ids into `self.doc_pool.docs`."""
+        column = self.get_column(attr_name)
+        assert isinstance(column, RaggedColumn), f"{attr_name} is not a ragged column"
+        return column.as_arrays()
+
+    def _column_as_list(self, attr_name: str) -> List[Any]:
+        column = self.get_column(attr_name)
+        if isinstance(column, RaggedColumn):
+            return column.to_list()
+        if attr_name in self._output_columns:
+            return [None if value is _MISSING else value for value in column]
+        return column
+
+    @property
+    def question(self) -> List[Optional[str]]:
+        return self._columns["question"]
+
+    @property
+    def golden_answers(self) -> List[List[str]]:
+        return self._columns["golden_answers"]
+
+    @property
+    def id(self) -> List[Optional[str]]:
+        return self._columns["id"]
+
+    @property
+    def output(self) -> List[Dict[str, Any]]:
+        return [self._get_row_output(index) for index in range(self._num_rows)]
+
+    def get_batch_data(self, attr_name: str, batch_size: int) -> Generator[List[Any], None, None]:
+        column = self.get_column(attr_name)
+        if not isinstance(column, RaggedColumn):
+            column = self._column_as_list(attr_name)
+        for i in range(0, self._num_rows, batch_size):
+            yield column[i : i + batch_size]
+
+    def __getattr__(self, attr_name: str) -> List[Any]:
+        if attr_name.startswith("_"):
+            raise AttributeError(attr_name)
+        if attr_name in self._output_columns and isinstance(self._output_columns[attr_name], RaggedColumn):
+            # the column itself, rows are built only when they are read
+            return self._output_columns[attr_name]
+        if attr_name in self._output_columns or attr_name in self._columns:
+            return self._column_as_list(attr_name)
+        raise AttributeError(f"Attribute `{attr_name}` not found")
+
+    def get_attr_data(self, attr_name: str) -> List[Any]:
+        return self._column_as_list(attr_name)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ItemView(self, i) for i in range(self._num_rows)[index]]
+        if index < 0:
+            index += self._num_rows
+        if not 0 <= index < self._num_rows:
+            raise IndexError("ColumnarDataset index out of range")
+        return ItemView(self, index)
+
+    def __iter__(self):
+        for index in range(self._num_rows):
+            yield ItemView(self, index)
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+
+# placeholder of output values not set for a row
+_MISSING = object()
@@ -1,12 +1,17 @@
-from typing import Dict, Any, Union
+import os
+import io
+import json
+import warnings
+from collections.abc import Sequence
+from typing import Dict, Any, Union, List, Optional
 import numpy as np
-from flashrag.dataset import Dataset
+from flashrag.dataset import Dataset, Item
 
 
 def convert_numpy(data: Any) -> Any:
     if isinstance(data, dict):
         return {key: convert_numpy(value) for key, value in data.items()}
-    elif isinstance(data, list):
+    elif isinstance(data, (list, DocRefList)):
         return [convert_numpy(element) for element in data]
     elif isinstance(data, np.ndarray):
         return data.tolist()
@@ -100,4 +105,163 @@ def clean_prompt_image(input):
                 message["content"] = [item for item in message["content"] if item.get("type") != "image"]
         return input
     except:
-        return input
\ No newline at end of file
+        return input
+
+COMPACT_FORMAT_NAME = "flashrag-compact"
+COMPACT_FORMAT_VERSION = 1
+
+
+def get_corpus_fingerprint(corpus_path: str, sample_bytes: int = 1 << 20) -> str:
+    """A cheap fingerprint of a corpus file: its size and a hash of its first and last `sample_bytes`."""
+    import hashlib
+
+    file_size = os.path.getsize(corpus_path)
+    hasher = hashlib.blake2b(str(file_size).encode("utf-8"), digest_size=16)
+    with open(corpus_path, "rb") as f:
+        hasher.update(f.read(sample_bytes))
+        if file_size > sample_bytes:
+            f.seek(max(sample_bytes, file_size - sample_bytes))
+            hasher.update(f.read(sample_bytes))
+    return hasher.hexdigest()
+
+
+def _is_doc_list(value: Any) -> bool:
+    return (
+        isinstance(value, list)
+        and len(value) > 0
+        and all(isinstance(doc, dict) and "id" in doc and "contents" in doc for doc in value)
+    )
+
+
+def _compact_output(value: Any) -> Any:
+    """Replace the doc lists (e.g. retrieval results) in an output by references to corpus doc ids."""
+    if isinstance(value, DocRefList):
+        return {"__doc_ids__": list(value.doc_ids)}
+    if _is_doc_list(value):
+        return {"__doc_ids__": [str(doc["id"]) for doc in value]}
+    if isinstance(value, dict):
+        return {key: _compact_output(element) for key, element in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_compact_output(element) for element in value]
+    return value
+
+
+def save_compact_dataset(dataset: Dataset, save_path: str, corpus_path: Optional[str] = None, compress: bool = False):
+    """Save a dataset as JSONL with docs stored as corpus doc id references.
+
+    The first line is a header with the corpus path and fingerprint, each following line is an item.
+    Doc scores are kept as they are in the output (e.g. `doc_scores`). With `compress`, the file is
+    compressed with zstd (requires `zstandard`).
+    """
+    header = {
+        "format": COMPACT_FORMAT_NAME,
+        "version": COMPACT_FORMAT_VERSION,
+        "corpus_path": corpus_path,
+        "corpus_fingerprint": get_corpus_fingerprint(corpus_path) if corpus_path and os.path.exists(corpus_path) else None,
+        "dataset_name": dataset.dataset_name,
+        "num_items": len(dataset),
+    }
+    if compress:
+        import zstandard
+
+        raw_file = open(save_path, "wb")
+        f = io.TextIOWrapper(zstandard.ZstdCompressor(level=3).stream_writer(raw_file), encoding="utf-8")
+    else:
+        f = open(save_path, "w", encoding="utf-8")
+    with f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for idx in range(len(dataset)):
+            item = dataset[idx]
+            # doc lists are replaced first, so the deep conversions only walk the small remaining output
+            output = remove_images(convert_numpy(_compact_output(item.output)))
+            if "prompt" in output:
+                output["prompt"] = clean_prompt_image(output["prompt"])
+            item_dict = remove_images(item.data)
+            item_dict["output"] = output
+            if item.metadata:
+                item_dict["metadata"] = remove_images(item.metadata)
+            f.write(json.dumps(item_dict, ensure_ascii=False) + "\n")
+
+
+class DocRefList(Sequence):
+    """A list of docs stored as corpus doc ids, the docs are read from the corpus on first access."""
+
+    def __init__(self, doc_ids: List[str], doc_store: "CorpusDocStore") -> None:
+        self.doc_ids = doc_ids
+        self.doc_store = doc_store
+        self._docs = None
+
+    def _load(self) -> List[Dict[str, Any]]:
+        if self._docs is None:
+            self._docs = self.doc_store.get_docs(self.doc_ids)
+        return self._docs
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __repr__(self) -> str:
+        return f"DocRefList({self.doc_ids})"
+
+
+class CorpusDocStore:
+    """Look up corpus docs by doc id, the corpus is loaded only when a doc is first needed."""
+
+    def __init__(self, corpus=None, corpus_path: Optional[str] = None) -> None:
+        self.corpus = corpus
+        self.corpus_path = corpus_path
+        self._id2row = None
+
+    def get_docs(self, doc_ids: List[str]) -> List[Dict[str, Any]]:
+        if self.corpus is None:
+            if self.corpus_path is None:
+                raise ValueError("A corpus or corpus path is needed to load the referenced docs.")
+            from flashrag.retriever.utils import load_corpus
+
+            self.corpus = load_corpus(self.corpus_path)
+        if self._id2row is None:
+            self._id2row = {str(doc_id): row for row, doc_id in enumerate(self.corpus["id"])}
+        return [self.corpus[self._id2row[doc_id]] for doc_id in doc_ids]
+
+
+def _rehydrate_output(value: Any, doc_store: CorpusDocStore) -> Any:
+    if isinstance(value, dict):
+        if len(value) == 1 and "__doc_ids__" in value:
+            return DocRefList(value["__doc_ids__"], doc_store)
+        return {key: _rehydrate_output(element, doc_store) for key, element in value.items()}
+    if isinstance(value, list):
+        return [_rehydrate_output(element, doc_store) for element in value]
+    return value
+
+
+def load_compact_dataset(load_path: str, config=None, corpus=None, corpus_path: Optional[str] = None) -> Dataset:
+    """Load a dataset saved by `save_compact_dataset`, docs are read from the corpus only when accessed.
+
+    The corpus is given by `corpus` (a loaded corpus), `corpus_path`, or the path in the file header.
+    """
+    with open(load_path, "rb") as raw_file:
+        compressed = raw_file.read(4) == b"\x28\xb5\x2f\xfd"  # zstd magic number
+    if compressed:
+        import zstandard
+
+        f = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(load_path, "rb")), encoding="utf-8")
+    else:
+        f = open(load_path, "r", encoding="utf-8")
+    with f:
+        header = json.loads(f.readline())
+        assert header.get("format") == COMPACT_FORMAT_NAME, f"{load_path} is not a compact dataset file."
+        if corpus_path is None:
+            corpus_path = header["corpus_path"]
+        if corpus is None and corpus_path is not None and header["corpus_fingerprint"] is not None:
+            if not os.path.exists(corpus_path) or get_corpus_fingerprint(corpus_path) != header["corpus_fingerprint"]:
+                warnings.warn(f"Corpus {corpus_path} does not match the corpus used to save {load_path}.")
+        doc_store = CorpusDocStore(corpus=corpus, corpus_path=corpus_path)
+
+        data = []
+        for line in f:
+            item_dict = json.loads(line)
+            item_dict["output"] = _rehydrate_output(item_dict.get("output", {}), doc_store)
+            data.append(Item(item_dict))
+    return Dataset(config=config, data=data)
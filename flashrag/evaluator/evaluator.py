@@ -1,7 +1,17 @@
 import os
+import math
 from flashrag.evaluator.metrics import BaseMetric
 
 
+def _calculate_metrics_on_chunk(metric_objects, item_dicts):
+    """Entry of a metric worker process: compute metrics on a chunk of items.
+    The metrics share the worker's normalization / score caches."""
+    from flashrag.dataset import Dataset
+
+    chunk = Dataset(config={"dataset_name": metric_objects[0].dataset_name}, data=item_dicts)
+    return [metric_object.calculate_metric(chunk) for metric_object in metric_objects]
+
+
 class Evaluator:
     """Evaluator is used to summarize the results of all metrics."""
 
@@ -11,7 +21,12 @@ class Evaluator:
 
         self.save_metric_flag = config["save_metric_score"]
         self.save_data_flag = config["save_intermediate_data"]
+        self.save_data_format = config["save_data_format"] if "save_data_format" in config else None
         self.metrics = [metric.lower() for metric in self.config["metrics"]]
+        metric_setting = config["metric_setting"] if "metric_setting" in config else None
+        # number of processes computing per-item metrics, only used for large datasets
+        self.num_workers = metric_setting.get("num_workers", None) if metric_setting is not None else None
+        self.min_parallel_items = metric_setting.get("min_parallel_items", 10000) if metric_setting is not None else 10000
 
         self.avaliable_metrics = self._collect_metrics()
 
@@ -43,13 +58,31 @@ class Evaluator:
             avaliable_metrics[metric_name] = cls
         return avaliable_metrics
 
+    def set_generator(self, generator):
+        """Share a loaded generator with the metrics that need one (e.g. `llm_judge`)."""
+        for metric_object in self.metric_class.values():
+            if hasattr(metric_object, "set_generator"):
+                metric_object.set_generator(generator)
+
     def evaluate(self, data):
         """Calculate all metric indicators and summarize them."""
 
         result_dict = {}
+        parallel_results = {}
+        if self.num_workers is not None and self.num_workers > 1 and len(data) >= self.min_parallel_items:
+            parallel_metrics = [metric for metric in self.metrics if self.metric_class[metric].parallelizable]
+            if len(parallel_metrics) > 0:
+                try:
+                    parallel_results = self._calculate_metrics_parallel(data, parallel_metrics)
+                except Exception as e:
+                    print(f"Error in parallel metric computation, fall back to the main process: {e}")
+
         for metric in self.metrics:
             try:
-                metric_result, metric_scores = self.metric_class[metric].calculate_metric(data)
+                if metric in parallel_results:
+                    metric_result, metric_scores = parallel_results[metric]
+                else:
+                    metric_result, metric_scores = self.metric_class[metric].calculate_metric(data)
                 result_dict.update(metric_result)
 
                 for metric_score, item in zip(metric_scores, data):
@@ -66,16 +99,81 @@ class Evaluator:
 
         return result_dict
 
+    def _calculate_metrics_parallel(self, data, metrics):
+        """Compute per-item metrics on chunks of the data in a process pool.
+        The metric results are means of the item scores, so they are merged by weighted average."""
+        import multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor
+
+        # only the fields used by the metrics are sent to the workers
+        item_dicts = [
+            {
+                "id": item.id,
+                "question": item.question,
+                "golden_answers": item.golden_answers,
+                "choices": item.choices,
+                "output": {"pred": item.pred},
+            }
+            for item in data
+        ]
+        chunk_size = math.ceil(len(item_dicts) / (self.num_workers * 4))
+        chunks = [item_dicts[idx : idx + chunk_size] for idx in range(0, len(item_dicts), chunk_size)]
+        metric_objects = [self.metric_class[metric] for metric in metrics]
+        with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=mp.get_context("spawn")) as executor:
+            chunk_results = list(executor.map(_calculate_metrics_on_chunk, [metric_objects] * len(chunks), chunks))
+
+        parallel_results = {}
+        for metric_idx, metric in enumerate(metrics):
+            metric_scores = [score for chunk_result in chunk_results for score in chunk_result[metric_idx][1]]
+            metric_result = {}
+            for chunk, chunk_result in zip(chunks, chunk_results):
+                for key, value in chunk_result[metric_idx][0].items():
+                    metric_result[key] = metric_result.get(key, 0) + value * len(chunk) / len(item_dicts)
+            parallel_results[metric] = (metric_result, metric_scores)
+        return parallel_results
+
+    def compare(self, run_a, run_b, metrics=None, num_resamples=10000, confidence_level=0.95):
+        """Significance of the difference between two saved runs (save dirs or intermediate data files),
+        with paired bootstrap confidence intervals and paired permutation tests on the per-item scores."""
+        from flashrag.evaluator.significance import compare_runs
+
+        if metrics is None:
+            metrics = self.metrics
+        seed = self.config["seed"] if "seed" in self.config else None
+        results = compare_runs(
+            run_a, run_b, metrics=metrics, num_resamples=num_resamples, confidence_level=confidence_level, seed=seed
+        )
+        for metric, result in results.items():
+            diff = result["paired_bootstrap"]
+            print(
+                f"{metric}: {result['run_a']['mean']:.4f} vs {result['run_b']['mean']:.4f}, "
+                f"diff {diff['mean_diff']:.4f} (CI {diff['ci'][0]:.4f} ~ {diff['ci'][1]:.4f}), "
+                f"p-value {result['permutation_test']['p_value']:.4f}"
+            )
+        return results
+
     def save_metric_score(self, result_dict, file_name="metric_score.txt"):
         save_path = os.path.join(self.save_dir, file_name)
         with open(save_path, "w", encoding="utf-8") as f:
             for k, v in result_dict.items():
                 f.write(f"{k}: {v}\n")
 
-    def save_data(self, data, file_name="intermediate_data.json"):
+    def save_data(self, data, file_name=None):
         """Save the evaluated data, including the raw data and the score of each data
         sample on each metric."""
 
+        if self.save_data_format == "compact":
+            from flashrag.dataset.utils import save_compact_dataset
+
+            compress = self.config["save_data_compress"] if "save_data_compress" in self.config else False
+            if file_name is None:
+                file_name = "intermediate_data.compact.jsonl" + (".zst" if compress else "")
+            save_path = os.path.join(self.save_dir, file_name)
+            save_compact_dataset(data, save_path, corpus_path=self.config["corpus_path"], compress=compress)
+            return
+
+        if file_name is None:
+            file_name = "intermediate_data.jsonl" if self.save_data_format == "jsonl" else "intermediate_data.json"
         save_path = os.path.join(self.save_dir, file_name)
 
         data.save(save_path)
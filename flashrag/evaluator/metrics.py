@@ -1,8 +1,15 @@
+import os
 import re
-import numpy as np
+import copy
+import json
+import random
+import hashlib
 import warnings
-from collections import Counter
-from flashrag.evaluator.utils import normalize_answer
+import numpy as np
+from statistics import NormalDist
+from functools import lru_cache
+from collections import Counter, OrderedDict
+from flashrag.evaluator.utils import normalize_answer, cached_normalize_answer
 
 
 class BaseMetric:
@@ -11,6 +18,9 @@ class BaseMetric:
     """
 
     metric_name = "base"
+    # whether the metric is a mean of independent per-item scores, so it can be computed on chunks
+    # of the dataset in worker processes (the metric object must be picklable)
+    parallelizable = False
 
     def __init__(self, config):
         self.config = config
@@ -45,41 +55,52 @@ class BaseMetric:
         return golden_answers_list
 
 
+@lru_cache(maxsize=1 << 18)
+def cached_token_level_scores(prediction: str, ground_truths: tuple):
+    """Token-level f1 / precision / recall of a prediction against its best matching ground truth.
+    Shared by f1 / recall / precision, so the scores of an item are computed once."""
+    final_metric = {"f1": 0, "precision": 0, "recall": 0}
+    normalized_prediction = cached_normalize_answer(prediction)
+    prediction_tokens = normalized_prediction.split()
+    prediction_counter = Counter(prediction_tokens)
+    for ground_truth in ground_truths:
+        normalized_ground_truth = cached_normalize_answer(ground_truth)
+
+        if normalized_prediction in ["yes", "no", "noanswer"] and normalized_prediction != normalized_ground_truth:
+            continue
+        if (
+            normalized_ground_truth in ["yes", "no", "noanswer"]
+            and normalized_prediction != normalized_ground_truth
+        ):
+            continue
+        ground_truth_tokens = normalized_ground_truth.split()
+        common = prediction_counter & Counter(ground_truth_tokens)
+        num_same = sum(common.values())
+        if num_same == 0:
+            continue
+        precision = 1.0 * num_same / len(prediction_tokens)
+        recall = 1.0 * num_same / len(ground_truth_tokens)
+        f1 = (2 * precision * recall) / (precision + recall)
+        final_metric["f1"] = max(f1, final_metric["f1"])
+        final_metric["precision"] = max(precision, final_metric["precision"])
+        final_metric["recall"] = max(recall, final_metric["recall"])
+    return final_metric
+
+
 class F1_Score(BaseMetric):
     """Token-level F1 score"""
 
     metric_name = "f1"
+    parallelizable = True
 
     def __init__(self, config):
         super().__init__(config)
 
     def token_level_scores(self, prediction: str, ground_truths: list):
-        final_metric = {"f1": 0, "precision": 0, "recall": 0}
         if isinstance(ground_truths, str):
             ground_truths = [ground_truths]
-        for ground_truth in ground_truths:
-            normalized_prediction = normalize_answer(prediction)
-            normalized_ground_truth = normalize_answer(ground_truth)
-
-            if normalized_prediction in ["yes", "no", "noanswer"] and normalized_prediction != normalized_ground_truth:
-                continue
-            if (
-                normalized_ground_truth in ["yes", "no", "noanswer"]
-                and normalized_prediction != normalized_ground_truth
-            ):
-                continue
-            prediction_tokens = normalized_prediction.split()
-            ground_truth_tokens = normalized_ground_truth.split()
-            common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
-            num_same = sum(common.values())
-            if num_same == 0:
-                continue
-            precision = 1.0 * num_same / len(prediction_tokens)
-            recall = 1.0 * num_same / len(ground_truth_tokens)
-            f1 = (2 * precision * recall) / (precision + recall)
-            for k in ["f1", "precision", "recall"]:
-                final_metric[k] = max(eval(k), final_metric[k])
-        return final_metric
+        # the returned dict is cached, callers must not modify it
+        return cached_token_level_scores(prediction, tuple(ground_truths))
 
     def calculate_metric(self, data):
         pred_list = data.pred
@@ -97,6 +118,7 @@ class Recall_Score(F1_Score):
     """Token-level Recall score"""
 
     metric_name = "recall"
+    parallelizable = True
 
     def __init__(self, config):
         super().__init__(config)
@@ -116,6 +138,7 @@ class Precision_Score(F1_Score):
     """Token-level Precision score"""
 
     metric_name = "precision"
+    parallelizable = True
 
     def __init__(self, config):
         super().__init__(config)
@@ -138,6 +161,7 @@ class ExactMatch(BaseMetric):
     """
 
     metric_name = "em"
+    parallelizable = True
 
     def __init__(self, config):
         super().__init__(config)
@@ -146,7 +170,7 @@ class ExactMatch(BaseMetric):
     def calculate_em(self, prediction: str, golden_answers: list) -> float:
         if isinstance(golden_answers, str):
             golden_answers = [golden_answers]
-        normalized_prediction = normalize_answer(prediction)
+        normalized_prediction = cached_normalize_answer(prediction)
         score = 0.0
         for golden_answer in golden_answers:
             if self.is_regex:
@@ -157,7 +181,7 @@ class ExactMatch(BaseMetric):
                     score = 1.0
                     break
             else:
-                golden_answer = normalize_answer(golden_answer)
+                golden_answer = cached_normalize_answer(golden_answer)
                 if golden_answer == normalized_prediction:
                     score = 1.0
                     break
@@ -179,6 +203,7 @@ class Sub_ExactMatch(BaseMetric):
     r"""Sub-Exact match measure whether the predicted answer contains the standard answer."""
 
     metric_name = "acc"
+    parallelizable = True
 
     def __init__(self, config):
         super().__init__(config)
@@ -187,7 +212,7 @@ class Sub_ExactMatch(BaseMetric):
     def calculate_sub_em(self, prediction: str, golden_answers: list) -> float:
         if isinstance(golden_answers, str):
             golden_answers = [golden_answers]
-        normalized_prediction = normalize_answer(prediction)
+        normalized_prediction = cached_normalize_answer(prediction)
         score = 0.0
         for golden_answer in golden_answers:
             if self.is_regex:
@@ -198,7 +223,7 @@ class Sub_ExactMatch(BaseMetric):
                     score = 1.0
                     break
             else:
-                golden_answer = normalize_answer(golden_answer)
+                golden_answer = cached_normalize_answer(golden_answer)
                 if golden_answer in normalized_prediction:
                     score = 1.0
                     break
@@ -216,68 +241,121 @@ class Sub_ExactMatch(BaseMetric):
         return {"acc": sub_em_score}, metric_score_list
 
 
+class AnswerMatcher:
+    """Find whether a text contains any of a set of normalized answers in one scan of the text.
+
+    Uses an Aho-Corasick automaton if `pyahocorasick` is installed, otherwise a regex alternation.
+    """
+
+    def __init__(self, answers):
+        answers = list(dict.fromkeys(answers))
+        # an empty answer is contained in every text
+        self.match_all = "" in answers
+        answers = [answer for answer in answers if answer != ""]
+        self.automaton = None
+        self.pattern = None
+        if self.match_all or len(answers) == 0:
+            return
+        try:
+            import ahocorasick
+        except ImportError:
+            ahocorasick = None
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for idx, answer in enumerate(answers):
+                self.automaton.add_word(answer, idx)
+            self.automaton.make_automaton()
+        else:
+            # longer answers first, the first match is enough
+            self.pattern = re.compile("|".join(re.escape(answer) for answer in sorted(answers, key=len, reverse=True)))
+
+    def has_match(self, text: str) -> bool:
+        if self.match_all:
+            return True
+        if self.automaton is not None:
+            return next(self.automaton.iter(text), None) is not None
+        if self.pattern is not None:
+            return self.pattern.search(text) is not None
+        return False
+
+
 class Retrieval_Recall(BaseMetric):
-    r"""The recall of the top-k retreived passages, we measure if any of the passage contain the answer string."""
+    r"""The recall of the top-k retreived passages, we measure if any of the passage contain the answer string.
+
+    `retrieval_recall_topk` may be a list of k, then the scores of all k are computed in one pass
+    (the score of each item is a dict of the scores of each k).
+    """
 
     metric_name = "retrieval_recall"
+    # LRU of doc id -> (hash of contents, normalized contents), shared by retrieval metrics and iterations
+    cached_doc_norms = OrderedDict()
+    max_cached_docs = 1 << 17
 
     def __init__(self, config):
         super().__init__(config)
-        self.topk = config["metric_setting"]["retrieval_recall_topk"]
-
-    def calculate_metric(self, data):
+        topk = config["metric_setting"]["retrieval_recall_topk"]
+        self.topk_list = sorted(set(topk)) if isinstance(topk, (list, tuple)) else [topk]
+        self.topk = self.topk_list[-1]
+        self.is_multi_topk = isinstance(topk, (list, tuple))
+
+    def normalize_doc(self, doc):
+        contents = doc["contents"]
+        # the contents are not kept, a rewritten doc is detected by its hash
+        contents_hash = hash(contents)
+        doc_key = doc["id"] if "id" in doc else contents_hash
+        cached = self.cached_doc_norms.get(doc_key)
+        if cached is not None and cached[0] == contents_hash:
+            self.cached_doc_norms.move_to_end(doc_key)
+            return cached[1]
+        normalized_contents = normalize_answer(contents)
+        self.cached_doc_norms[doc_key] = (contents_hash, normalized_contents)
+        if len(self.cached_doc_norms) > self.max_cached_docs:
+            self.cached_doc_norms.popitem(last=False)
+        return normalized_contents
+
+    def get_hit_lists(self, data):
+        """Whether each of the top-k docs of each item contains a golden answer, k is the largest topk."""
         golden_answers_list = self.get_dataset_answer(data)
         retrieve_docs = data.retrieval_result
-        recall_score_list = []
+        hit_lists = []
         for doc_list, golden_answers in zip(retrieve_docs, golden_answers_list):
             if len(doc_list) < self.topk:
                 warnings.warn(f"Length of retrieved docs is smaller than topk ({self.topk})")
-            doc_list = [doc["contents"] for doc in doc_list[: self.topk]]
-            hit_list = []
-            for doc in doc_list:
-                for golden_answer in golden_answers:
-                    if normalize_answer(golden_answer) in normalize_answer(doc):
-                        hit_list.append(True)
-                        break
-                else:
-                    hit_list.append(False)
-            score = 1 if any(hit_list) else 0
-            recall_score_list.append(score)
-        recall_score = sum(recall_score_list) / len(recall_score_list)
+            matcher = AnswerMatcher([cached_normalize_answer(golden_answer) for golden_answer in golden_answers])
+            hit_lists.append([matcher.has_match(self.normalize_doc(doc)) for doc in doc_list[: self.topk]])
+        return hit_lists
 
-        return {f"retrieval_recall_top{self.topk}": recall_score}, recall_score_list
+    def get_scores(self, hit_lists, score_func, score_name):
+        """Scores of each k computed from the same hit lists."""
+        metric_dict = {}
+        score_lists = {}
+        for topk in self.topk_list:
+            score_list = [score_func(hit_list[:topk]) for hit_list in hit_lists]
+            metric_dict[f"{score_name}_top{topk}"] = sum(score_list) / len(score_list)
+            score_lists[f"{score_name}_top{topk}"] = score_list
+        if not self.is_multi_topk:
+            return metric_dict, score_lists[f"{score_name}_top{self.topk}"]
+        item_scores = [{key: score_list[idx] for key, score_list in score_lists.items()} for idx in range(len(hit_lists))]
+        return metric_dict, item_scores
+
+    def calculate_metric(self, data):
+        hit_lists = self.get_hit_lists(data)
+        return self.get_scores(hit_lists, lambda hit_list: 1 if any(hit_list) else 0, "retrieval_recall")
 
 
-class Retrieval_Precision(BaseMetric):
+class Retrieval_Precision(Retrieval_Recall):
     r"""The precision of the top-k retreived passages, we measure if any of the passage contain the answer string."""
 
     metric_name = "retrieval_precision"
 
     def __init__(self, config):
         super().__init__(config)
-        self.topk = config["metric_setting"]["retrieval_recall_topk"]
 
     def calculate_metric(self, data):
-        golden_answers_list = self.get_dataset_answer(data)
-        retrieve_docs = data.retrieval_result
-        precision_score_list = []
-        for doc_list, golden_answers in zip(retrieve_docs, golden_answers_list):
-            if len(doc_list) < self.topk:
-                warnings.warn(f"Length of retrieved docs is smaller than topk ({self.topk})")
-            doc_list = [doc["contents"] for doc in doc_list[: self.topk]]
-            hit_list = []
-            for doc in doc_list:
-                for golden_answer in golden_answers:
-                    if normalize_answer(golden_answer) in normalize_answer(doc):
-                        hit_list.append(True)
-                        break
-                else:
-                    hit_list.append(False)
-            score = sum(hit_list) / len(hit_list)
-            precision_score_list.append(score)
-        precision_score = sum(precision_score_list) / len(precision_score_list)
-
-        return {f"retrieval_precision_top{self.topk}": precision_score}, precision_score_list
+        hit_lists = self.get_hit_lists(data)
+        return self.get_scores(
+            hit_lists, lambda hit_list: sum(hit_list) / len(hit_list) if len(hit_list) > 0 else 0, "retrieval_precision"
+        )
 
 
 class Rouge_Score(BaseMetric):
@@ -524,25 +602,110 @@ class LLMJudge(BaseMetric):
     Feedback:::
     Total rating: """
 
-    def __init__(self, config):
+    # hash of (judge model, question, answer) -> judge score
+    cached_judgments = {}
+
+    def __init__(self, config, generator=None):
         super().__init__(config)
         if "llm_judge_setting" in config["metric_setting"]:
             llm_setting = config["metric_setting"]["llm_judge_setting"]
         else:
             assert False, "No available LLM settings!"
-        # TODO: integrate generator class
-        llm_name = llm_setting["model_name"]
+        self.llm_setting = llm_setting
+        self.judge_model_name = llm_setting["model_name"]
+        self.framework = llm_setting.get("framework", config["framework"])
         if "model_path" not in llm_setting:
-            model_path = config["model2path"].get(llm_name, None)
+            model_path = config["model2path"].get(self.judge_model_name, None)
         else:
             model_path = llm_setting["model_path"]
-        if model_path is None:
+        if model_path is None and self.framework != "openai":
             assert False, "None model path "
-
-        from transformers import pipeline
-
-        self.llm_pipeline = pipeline("text2text-generation", model=model_path, device=0)
-
+        self.model_path = model_path
+        self.batch_size = llm_setting.get("batch_size", config["generator_batch_size"])
+        self.max_new_tokens = llm_setting.get("max_new_tokens", 100)
+        # judge a random subset of items, the score is reported with a confidence interval
+        self.sample_num = llm_setting.get("sample_num", None)
+        self.confidence_level = llm_setting.get("confidence_level", 0.95)
+        # judgments are also appended to this file, so they are reused by later runs
+        self.cache_path = llm_setting.get("cache_path", None)
+        if self.cache_path is not None:
+            self._load_cache()
+
+        # reuse the generator of the pipeline even if it is not the judge model
+        self.reuse_generator = llm_setting.get("reuse_generator", False)
+
+        # any flashrag generator can be used (e.g. the generator of the pipeline),
+        # otherwise the judge model is loaded on first use
+        self.generator = generator
+
+    def __getstate__(self):
+        # the loaded judge model is not sent to metric worker processes
+        state = self.__dict__.copy()
+        state["generator"] = None
+        return state
+
+    def set_generator(self, generator):
+        """Use an already loaded generator (e.g. of the pipeline) as the judge, instead of loading
+        a second engine, if it serves the judge model or `reuse_generator` is set."""
+        if self.generator is not None or generator is None:
+            return
+        if self.reuse_generator or getattr(generator, "model_name", None) == self.judge_model_name:
+            self.generator = generator
+
+    @staticmethod
+    def _get_generator_framework(generator):
+        generator_name = type(generator).__name__
+        if generator_name == "OpenaiGenerator":
+            return "openai"
+        if generator_name in ["VLLMGenerator", "LoRAGeneratorView"]:
+            return "vllm"
+        return "hf"
+
+    def _get_generator(self):
+        if self.generator is None:
+            from flashrag.utils import get_generator
+
+            if hasattr(self.config, "final_config"):
+                judge_config = copy.copy(self.config)
+                judge_config.final_config = dict(self.config.final_config)
+            else:
+                judge_config = dict(self.config)
+            judge_config["framework"] = self.framework
+            judge_config["generator_model"] = self.judge_model_name
+            judge_config["generator_model_path"] = self.model_path
+            judge_config["generator_batch_size"] = self.batch_size
+            judge_config["generation_params"] = {}
+            self.generator = get_generator(judge_config)
+        return self.generator
+
+    def _generate(self, prompts):
+        generator = self._get_generator()
+        framework = self._get_generator_framework(generator)
+        # greedy decoding, so judgments are deterministic and can be cached
+        if framework == "hf":
+            generation_params = {"do_sample": False}
+        else:
+            generation_params = {"temperature": 0}
+        if framework == "openai":
+            prompts = [[{"role": "user", "content": prompt}] for prompt in prompts]
+        return generator.generate(prompts, max_tokens=self.max_new_tokens, **generation_params)
+
+    def _get_cache_key(self, question, answer):
+        key_str = json.dumps([self.judge_model_name, question, answer], ensure_ascii=False)
+        return hashlib.blake2b(key_str.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _load_cache(self):
+        if not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.cached_judgments[record["key"]] = record["score"]
+
+    @staticmethod
     def extract_judge_score(answer: str, split_str: str = "Total rating:") -> int:
         try:
             if split_str in answer:
@@ -555,21 +718,59 @@ class LLMJudge(BaseMetric):
             print(e)
             return 0
 
+    def judge(self, question_list, pred_list):
+        """Judge scores of (question, answer) pairs, only pairs not in the cache are sent to the judge model."""
+        cache_keys = [self._get_cache_key(q, a) for q, a in zip(question_list, pred_list)]
+        # pairs to judge, deduplicated by key
+        new_pairs = {}
+        for key, q, a in zip(cache_keys, question_list, pred_list):
+            if key not in self.cached_judgments and key not in new_pairs:
+                new_pairs[key] = (q, a)
+
+        if len(new_pairs) > 0:
+            judge_input_prompt = [self.JUDGE_PROMPT.format(question=q, answer=a) for q, a in new_pairs.values()]
+            judge_output = self._generate(judge_input_prompt)
+            new_scores = [self.extract_judge_score(o) for o in judge_output]
+            for key, score in zip(new_pairs, new_scores):
+                self.cached_judgments[key] = score
+            if self.cache_path is not None:
+                with open(self.cache_path, "a", encoding="utf-8") as f:
+                    for key, score in zip(new_pairs, new_scores):
+                        f.write(json.dumps({"key": key, "score": score}) + "\n")
+
+        return [self.cached_judgments[key] for key in cache_keys]
+
     def calculate_metric(self, data):
         question_list = data.question
         pred_list = data.pred
 
-        judge_input_prompt = [self.JUDGE_PROMPT.format(question=q, answer=a) for q, a in zip(question_list, pred_list)]
-        judge_output = self.llm_pipeline(judge_input_prompt, max_new_tokens=100, batch_size=8)
-        judge_output = [item["generated_text"] for item in judge_output]
+        judge_idxs = list(range(len(question_list)))
+        if self.sample_num is not None and self.sample_num < len(judge_idxs):
+            seed = self.config["seed"] if "seed" in self.config else None
+            judge_idxs = sorted(random.Random(seed).sample(judge_idxs, self.sample_num))
 
-        metric_score_list = [self.extract_judge_score(o) for o in judge_output]
+        judge_scores = self.judge([question_list[idx] for idx in judge_idxs], [pred_list[idx] for idx in judge_idxs])
         # rescale score
-        metric_score_list = [score / 10 + 1 for score in metric_score_list]
+        judge_scores = [score / 10 + 1 for score in judge_scores]
 
-        score = sum(metric_score_list) / len(metric_score_list)
+        # items not in the sampled subset get no score
+        metric_score_list = [None] * len(question_list)
+        for idx, score in zip(judge_idxs, judge_scores):
+            metric_score_list[idx] = score
+
+        score = sum(judge_scores) / len(judge_scores)
+        metric_dict = {"llm_judge_score": score}
+        if len(judge_idxs) < len(question_list):
+            # normal approximation with finite population correction
+            num_sampled, num_total = len(judge_scores), len(question_list)
+            std = float(np.std(judge_scores, ddof=1)) if num_sampled > 1 else 0.0
+            fpc = ((num_total - num_sampled) / (num_total - 1)) ** 0.5
+            z = NormalDist().inv_cdf(0.5 + self.confidence_level / 2)
+            half_width = z * std / num_sampled**0.5 * fpc
+            metric_dict["llm_judge_score_ci"] = (score - half_width, score + half_width)
+            metric_dict["llm_judge_sample_num"] = num_sampled
 
-        return {"llm_judge_score": score}, metric_score_list
+        return metric_dict, metric_score_list
 
 
 class CountToken(BaseMetric):
@@ -598,11 +799,12 @@ class CountToken(BaseMetric):
         self.is_hf_tokenizer = is_hf_tokenizer
 
     def calculate_metric(self, data):
+        from flashrag.utils.token_counter import get_token_counter
+
         input_prompts = data.prompt
-        if self.is_hf_tokenizer:
-            token_counts = [len(self.tokenizer.tokenize(text)) for text in input_prompts]
-        else:
-            token_counts = [len(self.tokenizer.encode(text)) for text in input_prompts]
+        # batched and memoized, prompt building counts through the same counter, so the prompts
+        # measured there are not encoded again when `tokenizer_name` is the generator's tokenizer
+        token_counts = get_token_counter(self.tokenizer).count_batch(input_prompts)
         avg_tokens = sum(token_counts) / len(token_counts)
 
         return {"avg_input_tokens": avg_tokens}, token_counts
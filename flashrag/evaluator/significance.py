@@ -0,0 +1,197 @@
+import os
+import json
+import math
+import numpy as np
+
+
+def _load_item_dicts(path):
+    """Item dicts of a saved run, `path` is a save dir or an intermediate data / checkpoint file."""
+    if os.path.isdir(path):
+        for file_name in [
+            "intermediate_data.json",
+            "intermediate_data.jsonl",
+            "intermediate_data.compact.jsonl",
+            "intermediate_data.compact.jsonl.zst",
+            "checkpoint.jsonl",
+        ]:
+            if os.path.exists(os.path.join(path, file_name)):
+                path = os.path.join(path, file_name)
+                break
+        else:
+            raise FileNotFoundError(f"No intermediate data found in {path}.")
+
+    if ".compact." in os.path.basename(path):
+        from flashrag.dataset.utils import load_compact_dataset
+
+        # doc references are not resolved, only the scores are read
+        return [{"id": item.id, "output": item.output} for item in load_compact_dataset(path)]
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            item_dicts = [json.loads(line) for line in f if line.strip()]
+        else:
+            item_dicts = json.load(f)
+    # records of `run_with_checkpoint` wrap the item
+    return [record["item"] if "item" in record and "output" not in record else record for record in item_dicts]
+
+
+def load_item_scores(path, metrics=None):
+    """Per-item metric scores of a saved run.
+
+    Returns:
+        ids: list of item ids (None if the items have no id).
+        scores: dict of metric name -> float array over items, NaN where an item has no score. Dict scores
+            (e.g. retrieval recall with several k) are flattened into one entry per key.
+    """
+    item_dicts = _load_item_dicts(path)
+    ids = [item_dict.get("id") for item_dict in item_dicts]
+    score_lists = {}
+    for idx, item_dict in enumerate(item_dicts):
+        metric_scores = item_dict.get("output", {}).get("metric_score", {})
+        for metric, score in metric_scores.items():
+            flat_scores = score if isinstance(score, dict) else {metric: score}
+            for name, value in flat_scores.items():
+                if metrics is not None and name not in metrics and metric not in metrics:
+                    continue
+                if name not in score_lists:
+                    score_lists[name] = [math.nan] * len(item_dicts)
+                score_lists[name][idx] = math.nan if value is None else float(value)
+    scores = {name: np.asarray(score_list, dtype=np.float64) for name, score_list in score_lists.items()}
+    return ids, scores
+
+
+def _get_chunk_size(num_items, max_elements=1 << 23):
+    # number of resamples per chunk, bounds the (chunk, num_items) index matrix
+    return max(1, max_elements // max(num_items, 1))
+
+
+def _bootstrap_means(values, num_resamples, rng, max_unique=1024):
+    """Means of `num_resamples` bootstrap resamples of values.
+
+    Most metric scores take few distinct values (e.g. 0 / 1 for em), then the number of draws of each
+    value is sampled from a multinomial, which costs O(#values) instead of O(#items) per resample.
+    Otherwise items are drawn by index, in chunks of index matrices.
+    """
+    num_items = len(values)
+    unique_values, value_counts = np.unique(values, return_counts=True)
+    means = np.empty(num_resamples)
+    if len(unique_values) <= max_unique:
+        chunk_size = _get_chunk_size(len(unique_values))
+        for start in range(0, num_resamples, chunk_size):
+            end = min(start + chunk_size, num_resamples)
+            draw_counts = rng.multinomial(num_items, value_counts / num_items, size=end - start)
+            means[start:end] = draw_counts @ unique_values / num_items
+        return means
+    chunk_size = _get_chunk_size(num_items)
+    for start in range(0, num_resamples, chunk_size):
+        end = min(start + chunk_size, num_resamples)
+        idxs = rng.integers(0, num_items, size=(end - start, num_items), dtype=np.int32)
+        means[start:end] = values[idxs].mean(axis=1)
+    return means
+
+
+def bootstrap_ci(scores, num_resamples=10000, confidence_level=0.95, seed=None):
+    """Bootstrap confidence interval of the mean of per-item scores (NaN scores are ignored)."""
+    scores = np.asarray(scores, dtype=np.float64)
+    scores = scores[~np.isnan(scores)]
+    num_items = len(scores)
+    if num_items == 0:
+        return {"mean": math.nan, "ci": (math.nan, math.nan), "num_items": 0}
+    means = _bootstrap_means(scores, num_resamples, np.random.default_rng(seed))
+    alpha = (1 - confidence_level) / 2
+    return {
+        "mean": float(scores.mean()),
+        "ci": (float(np.quantile(means, alpha)), float(np.quantile(means, 1 - alpha))),
+        "num_items": num_items,
+    }
+
+
+def paired_bootstrap(scores_a, scores_b, num_resamples=10000, confidence_level=0.95, seed=None):
+    """Paired bootstrap of the mean difference `a - b` over the items scored in both runs.
+
+    Resamples are drawn vectorized (see `_bootstrap_means`), 10k resamples over 100k items take seconds.
+    The p-value is two-sided: twice the fraction of resampled differences on the other side of zero.
+    """
+    diffs = np.asarray(scores_a, dtype=np.float64) - np.asarray(scores_b, dtype=np.float64)
+    diffs = diffs[~np.isnan(diffs)]
+    num_items = len(diffs)
+    if num_items == 0:
+        return {"mean_diff": math.nan, "ci": (math.nan, math.nan), "p_value": math.nan, "num_items": 0}
+    resampled_diffs = _bootstrap_means(diffs, num_resamples, np.random.default_rng(seed))
+    alpha = (1 - confidence_level) / 2
+    p_value = 2 * min((resampled_diffs <= 0).mean(), (resampled_diffs >= 0).mean())
+    return {
+        "mean_diff": float(diffs.mean()),
+        "ci": (float(np.quantile(resampled_diffs, alpha)), float(np.quantile(resampled_diffs, 1 - alpha))),
+        "p_value": float(min(p_value, 1.0)),
+        "num_items": num_items,
+    }
+
+
+def paired_permutation_test(scores_a, scores_b, num_permutations=10000, seed=None):
+    """Two-sided paired permutation (sign-flip) test of the mean difference `a - b`.
+
+    Under the null hypothesis the two scores of an item are exchangeable, so the sign of each difference
+    is flipped at random. With few distinct differences the flips are counted per value (binomial draws),
+    otherwise the sign matrices of a chunk are applied with one matrix product.
+    """
+    diffs = np.asarray(scores_a, dtype=np.float64) - np.asarray(scores_b, dtype=np.float64)
+    diffs = diffs[~np.isnan(diffs)]
+    num_items = len(diffs)
+    if num_items == 0:
+        return {"mean_diff": math.nan, "p_value": math.nan, "num_items": 0}
+    observed = abs(diffs.mean())
+    rng = np.random.default_rng(seed)
+    num_extreme = 0
+    unique_values, value_counts = np.unique(diffs[diffs != 0], return_counts=True)
+    if len(unique_values) <= 1024:
+        # few distinct differences: the number of flipped signs of each value is binomial
+        chunk_size = _get_chunk_size(len(unique_values))
+        for start in range(0, num_permutations, chunk_size):
+            end = min(start + chunk_size, num_permutations)
+            num_positive = rng.binomial(value_counts, 0.5, size=(end - start, len(unique_values)))
+            permuted_means = (2 * num_positive - value_counts) @ unique_values / num_items
+            num_extreme += int((np.abs(permuted_means) >= observed - 1e-9).sum())
+    else:
+        chunk_size = _get_chunk_size(num_items)
+        for start in range(0, num_permutations, chunk_size):
+            end = min(start + chunk_size, num_permutations)
+            signs = rng.integers(0, 2, size=(end - start, num_items), dtype=np.int8) * 2 - 1
+            permuted_means = signs.astype(np.float32) @ diffs.astype(np.float32) / num_items
+            # small tolerance for float32 accumulation
+            num_extreme += int((np.abs(permuted_means) >= observed - 1e-6).sum())
+    return {
+        "mean_diff": float(diffs.mean()),
+        "p_value": (num_extreme + 1) / (num_permutations + 1),
+        "num_items": num_items,
+    }
+
+
+def compare_runs(run_a, run_b, metrics=None, num_resamples=10000, confidence_level=0.95, seed=None):
+    """Compare the per-item scores of two saved runs on the same dataset.
+
+    Items are paired by id (by position if the items have no id). Returns a dict of metric name ->
+    mean of each run with its CI, paired bootstrap CI of the difference and the permutation test p-value.
+    """
+    ids_a, scores_a = load_item_scores(run_a, metrics)
+    ids_b, scores_b = load_item_scores(run_b, metrics)
+    if all(item_id is not None for item_id in ids_a + ids_b):
+        id2idx_b = {item_id: idx for idx, item_id in enumerate(ids_b)}
+        pairs = [(idx_a, id2idx_b[item_id]) for idx_a, item_id in enumerate(ids_a) if item_id in id2idx_b]
+    else:
+        assert len(ids_a) == len(ids_b), "Runs without item ids must have the same number of items."
+        pairs = [(idx, idx) for idx in range(len(ids_a))]
+    idxs_a = np.array([pair[0] for pair in pairs], dtype=np.int64)
+    idxs_b = np.array([pair[1] for pair in pairs], dtype=np.int64)
+
+    results = {}
+    for metric in scores_a:
+        if metric not in scores_b:
+            continue
+        paired_a, paired_b = scores_a[metric][idxs_a], scores_b[metric][idxs_b]
+        results[metric] = {
+            "run_a": bootstrap_ci(paired_a, num_resamples, confidence_level, seed),
+            "run_b": bootstrap_ci(paired_b, num_resamples, confidence_level, seed),
+            "paired_bootstrap": paired_bootstrap(paired_a, paired_b, num_resamples, confidence_level, seed),
+            "permutation_test": paired_permutation_test(paired_a, paired_b, num_resamples, seed),
+        }
+    return results
@@ -1,20 +1,29 @@
 import re
 import string
+from functools import lru_cache
+
+
+ARTICLES_PATTERN = re.compile(r"\b(a|an|the)\b")
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
 
 
 def normalize_answer(s):
     def remove_articles(text):
-        return re.sub(r"\b(a|an|the)\b", " ", text)
+        return ARTICLES_PATTERN.sub(" ", text)
 
     def white_space_fix(text):
         return " ".join(text.split())
 
     def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
+        return text.translate(PUNCTUATION_TABLE)
 
     def lower(text):
         return text.lower()
 
     return white_space_fix(remove_articles(remove_punc(lower(s))))
 
+
+@lru_cache(maxsize=1 << 18)
+def cached_normalize_answer(s):
+    """`normalize_answer` memoized for short texts (predictions, answers) shared by several metrics."""
+    return normalize_answer(s)
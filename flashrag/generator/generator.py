@@ -11,7 +11,7 @@ from transformers import (
     BartForConditionalGeneration,
     AutoConfig,
 )
-from flashrag.generator.utils import resolve_max_tokens
+from flashrag.generator.utils import resolve_max_tokens, is_token_ids_input
 
 
 class BaseGenerator:
@@ -101,8 +101,11 @@ class EncoderDecoderGenerator(BaseGenerator):
         return passage_ids, passage_masks.bool()
 
     def generate(self, input_list: List, batch_size=None, **params):
-        if isinstance(input_list, str):
+        if isinstance(input_list, str) or (len(input_list) > 0 and isinstance(input_list[0], int)):
             input_list = [input_list]
+        use_token_ids = is_token_ids_input(input_list)
+        if use_token_ids and self.fid:
+            raise ValueError("FiD takes a list of passages per input, token ids are not supported.")
         if batch_size is None:
             batch_size = self.batch_size
 
@@ -115,20 +118,17 @@ class EncoderDecoderGenerator(BaseGenerator):
             from flashrag.generator.stop_word_criteria import StopWordCriteria
 
             stop_sym = generation_params.pop("stop")
-            stopping_criteria = [
-                StopWordCriteria(
-                    tokenizer=self.tokenizer,
-                    prompts=input_list,
-                    stop_words=stop_sym,
-                )
-            ]
-            generation_params["stopping_criteria"] = stopping_criteria
 
         generation_params = resolve_max_tokens(params, generation_params, prioritize_new_tokens=True)
 
         responses = []
         for idx in trange(0, len(input_list), batch_size, desc="Generation process: "):
             batched_prompts = input_list[idx : idx + batch_size]
+            if stop_sym is not None:
+                # decoder inputs only contain the start token, prompt length is inferred at the first step
+                generation_params["stopping_criteria"] = [
+                    StopWordCriteria(tokenizer=self.tokenizer, stop_words=stop_sym)
+                ]
             if self.fid:
                 # assume each input in input_list is a list, contains K string
                 input_ids, attention_mask = self.encode_passages(batched_prompts)
@@ -136,6 +136,13 @@ class EncoderDecoderGenerator(BaseGenerator):
                     "input_ids": input_ids.to(self.device),
                     "attention_mask": attention_mask.to(self.device),
                 }
+            elif use_token_ids:
+                # already tokenized prompts (e.g. from `PromptTemplate(..., return_token_ids=True)`)
+                inputs = self.tokenizer.pad(
+                    {"input_ids": [list(token_ids)[: self.max_input_len] for token_ids in batched_prompts]},
+                    return_tensors="pt",
+                    padding=True,
+                ).to(self.device)
             else:
                 inputs = self.tokenizer(
                     batched_prompts,
@@ -181,9 +188,11 @@ class VLLMGenerator(BaseGenerator):
                 tensor_parallel_size = self.tensor_parallel_size,
                 gpu_memory_utilization = self.gpu_memory_utilization,
                 enable_lora = True,
-                max_lora_rank = 64,
+                max_lora_rank = self.max_lora_rank,
+                max_loras = self.max_loras,
                 max_logprobs = 32016,
-                max_model_len = self.max_model_len
+                max_model_len = self.max_model_len,
+                enable_prefix_caching = self.enable_prefix_caching
             )
         else:
             self.model = LLM(
@@ -191,9 +200,16 @@ class VLLMGenerator(BaseGenerator):
                 tensor_parallel_size = self.tensor_parallel_size,
                 gpu_memory_utilization = self.gpu_memory_utilization,
                 max_logprobs = 32016,
-                max_model_len = self.max_model_len
+                max_model_len = self.max_model_len,
+                enable_prefix_caching = self.enable_prefix_caching
             )
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_path, trust_remote_code=True)
+
+        # adapter name -> LoRARequest, all adapters share the base model of this engine
+        self.lora_requests = {}
+        for lora_name, lora_path in self.lora_paths.items():
+            self.register_lora(lora_name, lora_path)
+
     def update_additional_setting(self):
         if "gpu_memory_utilization" not in self._config:
             self.gpu_memory_utilization = 0.85
@@ -205,22 +221,83 @@ class VLLMGenerator(BaseGenerator):
             self.tensor_parallel_size = self.gpu_num
 
         self.lora_path = None if "generator_lora_path" not in self._config else self._config["generator_lora_path"]
-        self.use_lora = False
-        if self.lora_path is not None:
-            self.use_lora = True
+        # a single path keeps the old behavior (always use the adapter), a dict {name: path} registers
+        # several named adapters which are selected per call with the `lora` argument of `generate`
+        if self.lora_path is None:
+            self.lora_paths = {}
+            self.default_lora = None
+        elif isinstance(self.lora_path, str):
+            self.lora_paths = {"lora_module": self.lora_path}
+            self.default_lora = "lora_module"
+        else:
+            self.lora_paths = dict(self.lora_path)
+            self.default_lora = None
+        self.use_lora = len(self.lora_paths) > 0
+        self.max_lora_rank = self._config["max_lora_rank"] if "max_lora_rank" in self._config else None
+        if self.max_lora_rank is None:
+            self.max_lora_rank = 64
+        self.max_loras = self._config["max_loras"] if "max_loras" in self._config else None
+        if self.max_loras is None:
+            self.max_loras = max(len(self.lora_paths), 1)
         self.max_model_len = self._config['generator_max_input_len']
+        # reuse the kv cache of shared prompt prefixes (e.g. sibling prompts in tree pipelines)
+        self.enable_prefix_caching = self._config["enable_prefix_caching"] if "enable_prefix_caching" in self._config else None
+        if self.enable_prefix_caching is None:
+            self.enable_prefix_caching = False
+
+    def register_lora(self, name, path):
+        """Register a named adapter, the adapter is loaded by vllm on the first request that uses it."""
+        from vllm.lora.request import LoRARequest
+
+        assert self.use_lora, "The engine is built without lora support, set `generator_lora_path` to enable it."
+        if name in self.lora_requests:
+            return self.lora_requests[name]
+        # lora int id must be unique and positive
+        lora_request = LoRARequest(name, len(self.lora_requests) + 1, path)
+        self.lora_requests[name] = lora_request
+        return lora_request
+
+    def get_lora_request(self, lora=None):
+        """Map an adapter name (or a list with one name per input, None for the base model) to LoRARequests."""
+        if lora is None:
+            lora = self.default_lora
+        if lora is None:
+            return None
+        if isinstance(lora, str):
+            if lora not in self.lora_requests:
+                raise ValueError(f"Unknown lora adapter: {lora}, registered: {list(self.lora_requests.keys())}")
+            return self.lora_requests[lora]
+        return [self.get_lora_request(name) if name is not None else None for name in lora]
+
+    def with_lora(self, lora):
+        """Return a view of the generator that routes every call to the given adapter.
+
+        The view can be passed as `generator` to pipelines, so that pipelines with different adapters
+        share the base model loaded in this engine.
+        """
+        return LoRAGeneratorView(self, lora)
 
     def generate(
         self,
         input_list: List[str],
         return_raw_output=False,
         return_scores=False,
+        lora=None,
         **params,
     ):
+        """Generate with vllm.
+
+        Args:
+            lora: name of the registered adapter used for all inputs, or a list with one name per input
+                (None for the base model). If not given, the adapter of a single `generator_lora_path` is used.
+        """
         from vllm import SamplingParams
 
-        if isinstance(input_list, str):
+        if isinstance(input_list, str) or (len(input_list) > 0 and isinstance(input_list[0], int)):
             input_list = [input_list]
+        if is_token_ids_input(input_list):
+            # already tokenized prompts, skip the tokenization inside vllm
+            input_list = [{"prompt_token_ids": list(token_ids)} for token_ids in input_list]
 
         generation_params = deepcopy(self.generation_params)
         generation_params.update(params)
@@ -246,13 +323,14 @@ class VLLMGenerator(BaseGenerator):
 
         sampling_params = SamplingParams(**generation_params)
 
-        if self.use_lora:
-            from vllm.lora.request import LoRARequest
-
+        lora_request = self.get_lora_request(lora)
+        if lora_request is not None:
+            if isinstance(lora_request, list):
+                assert len(lora_request) == len(input_list), "The number of lora names must match the inputs."
             outputs = self.model.generate(
                 input_list,
                 sampling_params,
-                lora_request=LoRARequest("lora_module", 1, self.lora_path),
+                lora_request=lora_request,
             )
         else:
             outputs = self.model.generate(input_list, sampling_params)
@@ -272,6 +350,21 @@ class VLLMGenerator(BaseGenerator):
             return base_output
 
 
+class LoRAGeneratorView:
+    """A `VLLMGenerator` bound to one adapter, other attributes are taken from the shared generator."""
+
+    def __init__(self, generator, lora):
+        self.generator = generator
+        self.lora = lora
+
+    def generate(self, input_list, **params):
+        params.setdefault("lora", self.lora)
+        return self.generator.generate(input_list, **params)
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+
 class HFCausalLMGenerator(BaseGenerator):
     """Class for decoder-only generator, based on hf."""
 
@@ -281,10 +374,21 @@ class HFCausalLMGenerator(BaseGenerator):
         if self.lora_path is not None:
             self.use_lora = True
             self.model.load_adapter(self.lora_path)
+        self.draft_model = self._load_draft_model() if self.draft_model_path is not None else None
 
     def update_additional_setting(self):
         self.lora_path = None if "generator_lora_path" not in self._config else self._config["generator_lora_path"]
         self.use_lora = False
+        # settings for assisted (speculative) generation
+        self.draft_model_path = (
+            None if "generator_draft_model_path" not in self._config else self._config["generator_draft_model_path"]
+        )
+        self.num_assistant_tokens = (
+            None if "num_assistant_tokens" not in self._config else self._config["num_assistant_tokens"]
+        )
+        self.prompt_lookup_num_tokens = (
+            None if "prompt_lookup_num_tokens" not in self._config else self._config["prompt_lookup_num_tokens"]
+        )
 
     def _load_model(self, model=None):
         r"""Load model and tokenizer for generator."""
@@ -305,6 +409,21 @@ class HFCausalLMGenerator(BaseGenerator):
 
         return model, tokenizer
 
+    def _load_draft_model(self):
+        r"""Load the small draft model used for assisted generation.
+        The draft model must share the tokenizer (vocabulary) of the main model."""
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            self.draft_model_path,
+            torch_dtype="auto",
+            trust_remote_code=True,
+        )
+        draft_model.to(self.model.device)
+        draft_model.eval()
+        if self.num_assistant_tokens is not None:
+            draft_model.generation_config.num_assistant_tokens = self.num_assistant_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        return draft_model
+
     def add_new_tokens(self, token_embedding_path, token_name_func=lambda idx: f"[ref{idx+1}]"):
         import torch
         del self.model
@@ -348,12 +467,23 @@ class HFCausalLMGenerator(BaseGenerator):
         batch_size=None,
         return_scores=False,
         return_dict=False,
+        return_logits=True,
+        score_topk=0,
         **params,
     ):
-        """Generate batches one by one. The generated content needs to exclude input."""
+        """Generate batches one by one. The generated content needs to exclude input.
+
+        Args:
+            return_scores: also return the probability of each generated token.
+            return_dict: return a dict with generated token ids, responses and scores.
+            return_logits: (only with `return_dict`) include the full-vocabulary logits of each step,
+                which costs B x T x V memory. Without it, the scores are collected on the fly (B x T).
+            score_topk: (only with `return_dict`) also return the top-k log-probs and token ids of each step.
+        """
 
-        if isinstance(input_list, str):
+        if isinstance(input_list, str) or (len(input_list) > 0 and isinstance(input_list[0], int)):
             input_list = [input_list]
+        use_token_ids = is_token_ids_input(input_list)
         if batch_size is None:
             batch_size = self.batch_size
 
@@ -363,20 +493,27 @@ class HFCausalLMGenerator(BaseGenerator):
         # deal stop params
         stop_sym = None
         if "stop" in generation_params:
-            from flashrag.generator.stop_word_criteria import StopWordCriteria
+            from flashrag.generator.stop_word_criteria import StopWordCriteria, truncate_at_stop_words
 
             stop_sym = generation_params.pop("stop")
-            stopping_criteria = [
-                StopWordCriteria(
-                    tokenizer=self.tokenizer,
-                    prompts=input_list,
-                    stop_words=stop_sym,
-                )
-            ]
-            generation_params["stopping_criteria"] = stopping_criteria
 
         generation_params = resolve_max_tokens(params, generation_params, prioritize_new_tokens=True)
 
+        # assisted generation: draft model first, then n-gram lookup over the prompt
+        # (works well for extractive QA since the answer is usually copied from the references)
+        if self.draft_model is not None:
+            generation_params.setdefault("assistant_model", self.draft_model)
+        elif self.prompt_lookup_num_tokens is not None:
+            generation_params.setdefault("prompt_lookup_num_tokens", self.prompt_lookup_num_tokens)
+        use_assisted = (
+            generation_params.get("assistant_model") is not None
+            or generation_params.get("prompt_lookup_num_tokens") is not None
+        )
+        if use_assisted:
+            if batch_size != 1:
+                warnings.warn("Assisted generation only supports batch size 1, set batch size to 1.")
+                batch_size = 1
+
         # set eos token for llama
         if "llama" in self.model_name.lower():
             extra_eos_tokens = [
@@ -392,110 +529,132 @@ class HFCausalLMGenerator(BaseGenerator):
         scores = []
         generated_token_ids = []
         generated_token_logits = []
+        generated_topk_log_probs = []
+        generated_topk_token_ids = []
+
+        # full logits of each step are only kept when explicitly requested, otherwise
+        # the chosen-token scores are collected by a logits processor
+        need_scores = return_scores or return_dict
+        keep_full_logits = return_dict and return_logits
+        use_score_processor = need_scores and not keep_full_logits and not use_assisted
+        if use_score_processor:
+            from transformers import LogitsProcessorList
+            from flashrag.generator.score_processor import GenerationScoreProcessor
 
         import torch
         for idx in trange(0, len(input_list), batch_size, desc="Generation process: "):
             with torch.inference_mode():
                 torch.cuda.empty_cache()
                 batched_prompts = input_list[idx : idx + batch_size]
-                inputs = self.tokenizer(
-                    batched_prompts,
-                    return_tensors="pt",
-                    padding=True,
-                    truncation=True,
-                    max_length=self.max_input_len,
-                ).to(self.model.device)
+                if use_token_ids:
+                    inputs = self.tokenizer.pad(
+                        {"input_ids": [list(token_ids)[: self.max_input_len] for token_ids in batched_prompts]},
+                        return_tensors="pt",
+                        padding=True,
+                    ).to(self.model.device)
+                else:
+                    inputs = self.tokenizer(
+                        batched_prompts,
+                        return_tensors="pt",
+                        padding=True,
+                        truncation=True,
+                        max_length=self.max_input_len,
+                    ).to(self.model.device)
+                prompt_length = inputs["input_ids"].shape[-1]
+
+                batch_generation_params = dict(generation_params)
+                if stop_sym is not None:
+                    # rows are stopped individually, the criteria keeps state for the current batch
+                    batch_generation_params["stopping_criteria"] = [
+                        StopWordCriteria(
+                            tokenizer=self.tokenizer,
+                            stop_words=stop_sym,
+                            prompt_length=prompt_length,
+                        )
+                    ]
+                score_processor = None
+                if use_score_processor:
+                    score_processor = GenerationScoreProcessor(prompt_length=prompt_length, topk=score_topk)
+                    batch_generation_params["logits_processor"] = LogitsProcessorList(
+                        list(generation_params.get("logits_processor", [])) + [score_processor]
+                    )
                 outputs = self.model.generate(
                     **inputs,
-                    output_scores=True,
+                    output_scores=need_scores and not use_score_processor,
                     return_dict_in_generate=True,
-                    **generation_params,
+                    **batch_generation_params,
                 )
 
-                generated_ids = outputs.sequences
-                logits = torch.stack(outputs.scores, dim=1).softmax(-1)
-                generated_ids = generated_ids[:, inputs["input_ids"].shape[-1] :]
-                gen_score = torch.gather(logits, 2, generated_ids[:, :, None]).squeeze(-1).cpu().tolist()
-                scores.extend(gen_score)
+                generated_ids = outputs.sequences[:, prompt_length:]
+                if score_processor is not None:
+                    chosen_log_probs, topk_log_probs, topk_token_ids = score_processor.finalize(outputs.sequences)
+                    scores.extend(chosen_log_probs.exp().cpu().tolist())
+                elif need_scores:
+                    # gather step by step to avoid a softmax over the stacked B x T x V scores
+                    chosen_log_probs = torch.stack(
+                        [
+                            step_scores.float().log_softmax(dim=-1).gather(1, generated_ids[:, step, None]).squeeze(-1)
+                            for step, step_scores in enumerate(outputs.scores)
+                        ],
+                        dim=1,
+                    )
+                    scores.extend(chosen_log_probs.exp().cpu().tolist())
+                    topk_log_probs, topk_token_ids = None, None
+                    if score_topk > 0:
+                        topk_log_probs, topk_token_ids = torch.stack(outputs.scores, dim=1).float().log_softmax(
+                            dim=-1
+                        ).topk(score_topk, dim=-1)
 
             # get additinoal info
             if return_dict:
-                batch_generated_token_ids = generated_ids.detach().cpu()
-                batch_generated_token_logits = (
-                    torch.cat(
-                        [token_scores.unsqueeze(1) for token_scores in outputs.scores],
-                        dim=1,
-                    )
-                    .detach()
-                    .cpu()
-                )
-                if batch_generated_token_ids.shape[1] < generation_params["max_new_tokens"]:
-                    real_batch_size, num_generated_tokens = batch_generated_token_ids.shape
-                    padding_length = generation_params["max_new_tokens"] - num_generated_tokens
-                    padding_token_ids = torch.zeros(
-                        (real_batch_size, padding_length),
-                        dtype=batch_generated_token_ids.dtype,
-                    ).fill_(self.tokenizer.pad_token_id)
-                    padding_token_logits = torch.zeros(
-                        (
-                            real_batch_size,
-                            padding_length,
-                            batch_generated_token_logits.shape[-1],
-                        ),
-                        dtype=batch_generated_token_logits.dtype,
-                    )
-                    batch_generated_token_ids = torch.cat([batch_generated_token_ids, padding_token_ids], dim=1)
-                    batch_generated_token_logits = torch.cat(
-                        [batch_generated_token_logits, padding_token_logits],
-                        dim=1,
+                max_new_tokens = generation_params.get("max_new_tokens", generated_ids.shape[1])
+                real_batch_size, num_generated_tokens = generated_ids.shape
+                padding_length = max(max_new_tokens - num_generated_tokens, 0)
+
+                def pad_steps(tensor, fill_value=0):
+                    # pad the step dimension to `max_new_tokens`
+                    tensor = tensor.detach().cpu()
+                    if padding_length == 0:
+                        return tensor
+                    padding = torch.full(
+                        (real_batch_size, padding_length, *tensor.shape[2:]), fill_value, dtype=tensor.dtype
                     )
-                generated_token_ids.append(batch_generated_token_ids)
-                generated_token_logits.append(batch_generated_token_logits)
-
-            for i, generated_sequence in enumerate(outputs.sequences):
-                input_ids = inputs["input_ids"][i]
-                text = self.tokenizer.decode(
-                    generated_sequence,
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=False,
-                )
-                if input_ids is None:
-                    prompt_length = 0
-                else:
-                    prompt_length = len(
-                        self.tokenizer.decode(
-                            input_ids,
-                            skip_special_tokens=True,
-                            clean_up_tokenization_spaces=False,
-                        )
+                    return torch.cat([tensor, padding], dim=1)
+
+                generated_token_ids.append(pad_steps(generated_ids, self.tokenizer.pad_token_id))
+                if keep_full_logits:
+                    generated_token_logits.append(
+                        pad_steps(torch.cat([token_scores.unsqueeze(1) for token_scores in outputs.scores], dim=1))
                     )
-                new_text = text[prompt_length:]
+                if topk_log_probs is not None:
+                    generated_topk_log_probs.append(pad_steps(topk_log_probs, float("-inf")))
+                    generated_topk_token_ids.append(pad_steps(topk_token_ids, self.tokenizer.pad_token_id))
 
+            # only decode the generated part, the prompt does not need to be decoded again
+            new_texts = self.tokenizer.batch_decode(
+                generated_ids,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
+            )
+            for new_text in new_texts:
                 if stop_sym is not None:
-                    strip_stopword = True
-                    # Find the first occurrence of any stop word
-                    lower_stop_index = len(new_text)  # Default to end of text
-                    for sym in stop_sym:
-                        stop_index = new_text.find(sym)
-                        if stop_index != -1:
-                            # Adjust stop index based on whether we're stripping the stop word
-                            stop_index += 0 if strip_stopword else len(sym)
-                            lower_stop_index = min(stop_index, lower_stop_index)
-
                     # Cut the text at the first stop word found (if any)
-                    new_text = new_text[:lower_stop_index]
+                    new_text = truncate_at_stop_words(new_text, stop_sym, strip_stopword=True)
 
                 responses.append(new_text.strip())
 
         if return_dict:
-            generated_token_ids = torch.cat(generated_token_ids, dim=0)
-            generated_token_logits = torch.cat(generated_token_logits, dim=0)
-            return {
-                "generated_token_ids": generated_token_ids,
-                "generated_token_logits": generated_token_logits,
+            output_dict = {
+                "generated_token_ids": torch.cat(generated_token_ids, dim=0),
                 "responses": responses,
                 "scores": scores,
             }
+            if keep_full_logits:
+                output_dict["generated_token_logits"] = torch.cat(generated_token_logits, dim=0)
+            if len(generated_topk_log_probs) > 0:
+                output_dict["topk_log_probs"] = torch.cat(generated_topk_log_probs, dim=0)
+                output_dict["topk_token_ids"] = torch.cat(generated_topk_token_ids, dim=0)
+            return output_dict
 
         if return_scores:
             return responses, scores
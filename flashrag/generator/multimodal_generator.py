@@ -291,6 +291,10 @@ class InternVL2InferenceEngine(BaseInferenceEngine):
                     prompt_prefix += f'Image-{i+1}: <image>\n'
                 prompt = prompt_prefix + prompt
 
+                # each chat call generates a new batch
+                for criteria in params.get("stopping_criteria", []):
+                    if hasattr(criteria, "reset"):
+                        criteria.reset()
                 output = self.model.chat(
                     self.tokenizer,
                     pixel_values,
@@ -419,14 +423,6 @@ class HFMultiModalGenerator(BaseMultiModalGenerator):
             from flashrag.generator.stop_word_criteria import StopWordCriteria
 
             stop_sym = generation_params.pop("stop")
-            stopping_criteria = [
-                StopWordCriteria(
-                    tokenizer=self.tokenizer,
-                    prompts=input_list,
-                    stop_words=stop_sym,
-                )
-            ]
-            generation_params["stopping_criteria"] = stopping_criteria
 
         generation_params = resolve_max_tokens(params, generation_params, prioritize_new_tokens=True)
 
@@ -443,6 +439,11 @@ class HFMultiModalGenerator(BaseMultiModalGenerator):
         for idx in trange(0, len(input_list), batch_size, desc='Generation process: '):
             torch.cuda.empty_cache()
             batch_prompts = input_list[idx: idx+batch_size]
+            if stop_sym is not None:
+                # the criteria keeps the state of one batch, prompt length is inferred at the first step
+                generation_params["stopping_criteria"] = [
+                    StopWordCriteria(tokenizer=self.inference_engine.tokenizer, stop_words=stop_sym)
+                ]
             output_responses.extend(self.inference_engine.generate(batch_prompts, **generation_params))
         return output_responses
 
@@ -0,0 +1,58 @@
+from typing import Optional
+import torch
+from transformers import LogitsProcessor
+
+
+class GenerationScoreProcessor(LogitsProcessor):
+    """Collect the log-prob of each chosen token (and optionally the top-k alternatives) during generation.
+
+    `generate(output_scores=True)` keeps the scores of every step, which is a B x T x V tensor.
+    This processor only keeps the log-softmax of the latest step (B x V) and gathers the log-prob
+    of the chosen token when it appears in `input_ids` at the next step, so the stored result is B x T.
+    The processor does not modify the scores, it should be the last one in the processor list
+    so that the log-probs are computed on the processed distribution.
+    """
+
+    def __init__(self, prompt_length: int, topk: int = 0):
+        self.prompt_length = prompt_length
+        self.topk = topk
+        self.last_log_probs = None
+        self.chosen_log_probs = []
+        self.topk_log_probs = []
+        self.topk_token_ids = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.last_log_probs is not None:
+            self.chosen_log_probs.append(self.last_log_probs.gather(1, input_ids[:, -1:]).squeeze(-1))
+        log_probs = scores.float().log_softmax(dim=-1)
+        self.last_log_probs = log_probs
+        if self.topk > 0:
+            topk_log_probs, topk_token_ids = log_probs.topk(self.topk, dim=-1)
+            self.topk_log_probs.append(topk_log_probs)
+            self.topk_token_ids.append(topk_token_ids)
+        return scores
+
+    def finalize(self, sequences: torch.LongTensor):
+        """Gather the log-prob of the last generated token and return the collected results.
+
+        Returns:
+            chosen_log_probs: B x T tensor of the log-prob of each generated token.
+            topk_log_probs, topk_token_ids: B x T x k tensors, None if `topk` is 0.
+        """
+        if self.last_log_probs is not None:
+            last_token_ids = sequences[:, self.prompt_length + len(self.chosen_log_probs)]
+            self.chosen_log_probs.append(self.last_log_probs.gather(1, last_token_ids[:, None]).squeeze(-1))
+            self.last_log_probs = None
+
+        batch_size = sequences.shape[0]
+        if len(self.chosen_log_probs) == 0:
+            chosen_log_probs = sequences.new_zeros((batch_size, 0), dtype=torch.float32)
+        else:
+            chosen_log_probs = torch.stack(self.chosen_log_probs, dim=1)
+
+        topk_log_probs: Optional[torch.Tensor] = None
+        topk_token_ids: Optional[torch.Tensor] = None
+        if self.topk > 0 and len(self.topk_log_probs) > 0:
+            topk_log_probs = torch.stack(self.topk_log_probs, dim=1)
+            topk_token_ids = torch.stack(self.topk_token_ids, dim=1)
+        return chosen_log_probs, topk_log_probs, topk_token_ids
@@ -3,71 +3,154 @@ Created by Nestor Demeure.
 This software is released under the Apache License 2.0.
 """
 
-from typing import List
+from typing import List, Optional
 import torch
 from transformers import StoppingCriteria, AutoTokenizer
 
+# tokenizer id -> (tokenizer, vocab size, text of each token)
+_TOKEN_STRING_CACHE = {}
+
+
+def get_token_strings(tokenizer: AutoTokenizer) -> List[str]:
+    """Decode every token of the vocabulary once and cache the result for the tokenizer.
+
+    Each token is decoded after an anchor token so that the leading space of the token is kept
+    (e.g. sentencepiece drops it when a token is decoded alone). Special tokens map to empty strings.
+    """
+    cache_key = id(tokenizer)
+    vocab_size = len(tokenizer)
+    if cache_key in _TOKEN_STRING_CACHE:
+        cached_tokenizer, cached_vocab_size, token_strings = _TOKEN_STRING_CACHE[cache_key]
+        if cached_tokenizer is tokenizer and cached_vocab_size == vocab_size:
+            return token_strings
+
+    anchor_ids = tokenizer.encode("a", add_special_tokens=False)[-1:]
+    anchor_len = len(tokenizer.decode(anchor_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False))
+    decoded = tokenizer.batch_decode(
+        [anchor_ids + [token_id] for token_id in range(vocab_size)],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False,
+    )
+    token_strings = [text[anchor_len:] for text in decoded]
+    _TOKEN_STRING_CACHE[cache_key] = (tokenizer, vocab_size, token_strings)
+    return token_strings
+
 
 class StopWordCriteria(StoppingCriteria):
     """
-    A stopping criteria that halts the text generation process if any specified stop word is encountered.
+    A stopping criteria that halts the text generation of a row once any specified stop word is encountered.
+
+    Instead of decoding the tail of every row at each step, the text of every token in the vocabulary is
+    computed once. Tokens that contain a stop word by themselves are checked with a single vectorized
+    `torch.isin` over the new token ids, stop words spanning several tokens are matched on a short
+    per-row text tail that is extended with the cached token strings. Each row is marked as finished
+    individually, so `generate` pads finished rows and stops as soon as all rows are finished.
 
     Inspired by https://discuss.huggingface.co/t/implimentation-of-stopping-criteria-list/20040/9
     And: https://github.com/outlines-dev/outlines/blob/main/outlines/generate/api.py
     """
 
-    def __init__(self, tokenizer: AutoTokenizer, prompts: List[str], stop_words: List[str] = [], check_every: int = 1):
+    def __init__(
+        self,
+        tokenizer: AutoTokenizer,
+        stop_words: List[str] = [],
+        prompt_length: Optional[int] = None,
+        check_every: int = 1,
+    ):
         """
         Initializes the StopWordCriteria with the necessary parameters for checking stop words during text generation.
 
         Parameters:
-            tokenizer (AutoTokenizer): The tokenizer for encoding prompts and stop words.
-            prompts (List[str]): Initial prompts used for generation, needed to determine where generated text begins.
+            tokenizer (AutoTokenizer): The tokenizer used by the generator.
             stop_words (List[str]): Words that trigger the stopping of generation when detected.
+            prompt_length (int): Length of the (padded) input ids, needed to determine where generated text begins.
+                If None, it is inferred at the first call, assuming one token is generated per step.
             check_every (int): Frequency of checking for stop words in the token stream (a performance optimization, use 1 to cut it out).
         """
         super().__init__()
         self.tokenizer = tokenizer
-        self.input_sizes = [self.tokenizer.encode(prompt, return_tensors="pt").size(-1) for prompt in prompts]
-        self.stop_words = stop_words
-        self.max_stop_word_size = max(
-            (self.tokenizer.encode(word, return_tensors="pt").size(-1) for word in stop_words), default=0
-        )
+        self.stop_words = [word for word in stop_words if len(word) > 0]
         self.check_every = check_every
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        self.max_stop_word_len = max((len(word) for word in self.stop_words), default=0)
+        # multi-byte characters may be split over several tokens, so they also need the text tail
+        self.use_tail_match = self.max_stop_word_len > 1 or any(not word.isascii() for word in self.stop_words)
+
+        self.token_strings = get_token_strings(tokenizer) if len(self.stop_words) > 0 else []
+        # tokens whose text contains a stop word, these stop the row without any string operation
+        self.stop_token_ids = torch.tensor(
+            [
+                token_id
+                for token_id, token_str in enumerate(self.token_strings)
+                if any(word in token_str for word in self.stop_words)
+            ],
+            dtype=torch.long,
+        )
+        self.reset(prompt_length)
+
+    def reset(self, prompt_length: Optional[int] = None):
+        """Reset the state of the criteria before a new batch is generated."""
+        self.prompt_length = prompt_length
+        self.last_length = prompt_length
+        self.finished = None
+        self.tails = None
+        self.tail_ids = None
+
+    def _match_tail(self, row_idx: int, new_token_ids: List[int]) -> bool:
+        self.tail_ids[row_idx] = (self.tail_ids[row_idx] + new_token_ids)[-(2 * self.max_stop_word_len + self.check_every) :]
+        new_text = "".join(self.token_strings[token_id] for token_id in new_token_ids)
+        if "\ufffd" in new_text:
+            # incomplete multi-byte characters can only be resolved by decoding the ids together
+            tail = self.tokenizer.decode(self.tail_ids[row_idx], skip_special_tokens=True)
+        else:
+            tail = self.tails[row_idx] + new_text
+        if any(word in tail for word in self.stop_words):
+            return True
+        self.tails[row_idx] = tail[max(len(tail) - self.max_stop_word_len + 1, 0) :]
+        return False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
         """
-        Determines whether to stop generation based on the presence of stop words.
-
-        Stops if a stop word is found in *all* batch elements *and* the sequence length is a multiple of `check_every`.
-        Note: Delay in stopping may occur if `check_every > 1`.
+        Determines which rows should stop generation based on the presence of stop words.
 
         Parameters:
             input_ids (torch.LongTensor): Generated token IDs.
             scores (torch.FloatTensor): Generation scores for each token. Not used here.
 
         Returns:
-            bool: True to stop generation, False to continue.
+            torch.BoolTensor: True for each row that has finished generation.
         """
         batch_size, seq_len = input_ids.shape
+        if self.finished is None:
+            if self.prompt_length is None:
+                self.prompt_length = seq_len - 1
+            self.last_length = self.prompt_length
+            self.finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+            self.tails = [""] * batch_size
+            self.tail_ids = [[] for _ in range(batch_size)]
 
         # Skip check if no stop words are defined or it is not yet time to check
         if (len(self.stop_words) == 0) or (seq_len % self.check_every != 0):
-            return False
+            return self.finished.clone()
+
+        new_tokens = input_ids[:, self.last_length :]
+        self.last_length = seq_len
 
-        for i in range(batch_size):
-            # Calculate starting index for new tokens
-            prompt_size = self.input_sizes[i]
-            max_new_tokens = (2 * self.max_stop_word_size) + self.check_every
-            latest_tokens = input_ids[i, prompt_size:][-max_new_tokens:]
+        # single token hit, vectorized over the whole batch
+        if self.stop_token_ids.numel() > 0:
+            if self.stop_token_ids.device != input_ids.device:
+                self.stop_token_ids = self.stop_token_ids.to(input_ids.device)
+            self.finished |= torch.isin(new_tokens, self.stop_token_ids).any(dim=1)
 
-            # Check for stop words in the decoded text
-            if not any(
-                word in self.tokenizer.decode(latest_tokens, skip_special_tokens=True) for word in self.stop_words
-            ):
-                return False  # Continue generation if any batch item lacks stop words
+        # stop words spanning several tokens, only for unfinished rows
+        if self.use_tail_match:
+            unfinished_rows = (~self.finished).nonzero(as_tuple=True)[0].tolist()
+            if len(unfinished_rows) > 0:
+                new_token_list = new_tokens[unfinished_rows].tolist()
+                for row_idx, row_token_ids in zip(unfinished_rows, new_token_list):
+                    if self._match_tail(row_idx, row_token_ids):
+                        self.finished[row_idx] = True
 
-        return True  # Stop generation if all conditions are met
+        return self.finished.clone()
 
     def extract_answers(self, input_ids: torch.LongTensor, strip_stopword: bool = True) -> List[str]:
         """
@@ -80,26 +163,18 @@ class StopWordCriteria(StoppingCriteria):
         Returns:
             List[str]: Extracted answers, with or without stop words.
         """
-        batch_size, _ = input_ids.shape
-        result = []
-
-        for i in range(batch_size):
-            # Decode generated tokens to text, excluding the prompt
-            prompt_size = self.input_sizes[i]
-            answer_tokens = input_ids[i, prompt_size:]
-            answer_text = self.tokenizer.decode(answer_tokens, skip_special_tokens=True)
-
-            # Find the first occurrence of any stop word
-            lower_stop_index = len(answer_text)  # Default to end of text
-            for word in self.stop_words:
-                stop_index = answer_text.find(word)
-                if stop_index != -1:
-                    # Adjust stop index based on whether we're stripping the stop word
-                    stop_index += 0 if strip_stopword else len(word)
-                    lower_stop_index = min(stop_index, lower_stop_index)
-
-            # Cut the text at the first stop word found (if any)
-            answer_text = answer_text[:lower_stop_index]
-            result.append(answer_text)
-
-        return result
+        prompt_length = self.prompt_length if self.prompt_length is not None else 0
+        answer_texts = self.tokenizer.batch_decode(input_ids[:, prompt_length:], skip_special_tokens=True)
+        return [truncate_at_stop_words(answer_text, self.stop_words, strip_stopword) for answer_text in answer_texts]
+
+
+def truncate_at_stop_words(text: str, stop_words: List[str], strip_stopword: bool = True) -> str:
+    """Cut the text at the first occurrence of any stop word."""
+    lower_stop_index = len(text)  # Default to end of text
+    for word in stop_words:
+        stop_index = text.find(word)
+        if stop_index != -1:
+            # Adjust stop index based on whether we're stripping the stop word
+            stop_index += 0 if strip_stopword else len(word)
+            lower_stop_index = min(stop_index, lower_stop_index)
+    return text[:lower_stop_index]
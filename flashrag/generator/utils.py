@@ -67,6 +67,16 @@ def resolve_max_tokens(params: dict, generation_params: dict, prioritize_new_tok
     return generation_params
 
 
+def is_token_ids_input(input_list) -> bool:
+    """Whether the input is a batch of token id lists (e.g. from `PromptTemplate.get_string(return_token_ids=True)`) instead of strings."""
+    return (
+        len(input_list) > 0
+        and isinstance(input_list[0], (list, tuple))
+        and len(input_list[0]) > 0
+        and isinstance(input_list[0][0], int)
+    )
+
+
 def convert_image_to_base64(image):
     from PIL import Image
     from io import BytesIO
@@ -1,4 +1,5 @@
 import re
+import time
 from tqdm import tqdm
 from typing import List, Tuple
 import math
@@ -6,6 +7,7 @@ import numpy as np
 from transformers import AutoTokenizer, PreTrainedTokenizer, PreTrainedTokenizerFast
 from flashrag.utils import get_retriever, get_generator, selfask_pred_parse, ircot_pred_parse
 from flashrag.pipeline import BasicPipeline
+from flashrag.pipeline.utils import RetrievalSession, PrefixGrouper
 from flashrag.dataset.utils import get_batch_dataset, merge_batch_dataset
 from flashrag.prompt import PromptTemplate
 
@@ -20,10 +22,14 @@ class IterativePipeline(BasicPipeline):
             retriever = get_retriever(config)
         self.generator = generator
         self.retriever = retriever
+        # query reuse of the retrieval session in the last run
+        self.retrieval_stats = None
         
 
     def run(self, dataset, do_eval=True, pred_process_fun=None):
         questions = dataset.question
+        # queries repeated across items and iterations are only searched once
+        retrieval_session = RetrievalSession(self.retriever, len(dataset))
         # run in batch
         past_generation_result = []  # list of N items
         for iter_idx in range(self.iter_num):
@@ -34,7 +40,7 @@ class IterativePipeline(BasicPipeline):
                 input_query = [f"{q} {r}" for q, r in zip(questions, past_generation_result)]
 
             # generation-augmented retrieval
-            retrieval_results = self.retriever.batch_search(input_query)
+            retrieval_results, _ = retrieval_session.search(input_query)
             dataset.update_output(f"retrieval_result_iter_{iter_idx}", retrieval_results)
 
             # retrieval-augmented generation
@@ -48,6 +54,9 @@ class IterativePipeline(BasicPipeline):
             past_generation_result = self.generator.generate(input_prompts)
             dataset.update_output(f"pred_iter_{iter_idx}", past_generation_result)
 
+        self.retrieval_stats = retrieval_session.stats()
+        if self.verbose:
+            print(f"Retrieval session: {self.retrieval_stats}")
         # use last retrieval result for evaluation
         dataset.update_output("retrieval_result", retrieval_results)
 
@@ -150,6 +159,8 @@ class SelfRAGPipeline(BasicPipeline):
             tokenizer, use_grounding=use_grounding, use_utility=use_utility
         )
         self.vocab_size = tokenizer.vocab_size + len(tokenizer.added_tokens_decoder)
+        # prompts with different paragraphs share the question prompt
+        self.prefix_grouper = PrefixGrouper(verbose=self.verbose)
 
     def load_special_tokens(self, tokenizer, use_grounding, use_utility):
         ret_tokens = {token: tokenizer.convert_tokens_to_ids(token) for token in self.retrieval_tokens_names}
@@ -390,79 +401,135 @@ class SelfRAGPipeline(BasicPipeline):
         return best_pred
 
     def run_single_beam(self, prompt, item_retrieval_result=None):
-        curr_depth = 1
-        terminated = False
-        node_id = 0
-        prediction_tree = {}
-        levels = {}
-        prediction_tree[node_id] = {
-            "prompt": prompt,
-            "pred": "[Retrieval]",
-            "processed_pred": "",
-            "score": None,
-            "ctx": None,
-            "parent": None,
+        return self.run_beams([prompt], [item_retrieval_result])[0]
+
+    def run_beams(self, prompts, retrieval_results):
+        """Beam search of long-form generation for several items at once.
+
+        The beams of all items are expanded as one frontier: at each depth, the augmented prompts of every
+        node to expand (over all items) are deduplicated and generated in one call, then each node is
+        scored with `critic_preds` and the beams are pruned per item.
+        """
+        states = [
+            self._init_beam(prompt, item_retrieval_result)
+            for prompt, item_retrieval_result in zip(prompts, retrieval_results)
+        ]
+        for curr_depth in range(1, self.max_depth):
+            expand_requests = []
+            for state in states:
+                if state["stopped"]:
+                    continue
+                state["levels"][curr_depth] = []
+                if curr_depth - 1 in state["levels"] and state["terminated"] is False:
+                    expand_requests += [(state, node, aug_prompts) for node, aug_prompts in self._get_expand_prompts(state, curr_depth)]
+                else:
+                    state["stopped"] = True
+
+            # generate each distinct prompt of the frontier once
+            prompt2idx = {}
+            for _, _, aug_prompts in expand_requests:
+                for aug_prompt in aug_prompts:
+                    prompt2idx.setdefault(aug_prompt, len(prompt2idx))
+            if len(prompt2idx) > 0:
+                unique_preds = self.prefix_grouper.generate(
+                    self.generator, list(prompt2idx.keys()), return_raw_output=True, logprobs=5
+                )
+                for state, node, aug_prompts in expand_requests:
+                    item_pred = [unique_preds[prompt2idx[aug_prompt]] for aug_prompt in aug_prompts]
+                    self._add_children(state, node, curr_depth, item_pred)
+
+            for state in states:
+                if state["stopped"]:
+                    continue
+                current_rank = state["levels"][curr_depth]
+                node_scores = np.array([state["prediction_tree"][node_id]["score"] for node_id in current_rank], dtype=float)
+                # stable descending order, same as sorting by score with reverse=True
+                top_idxs = np.argsort(-node_scores, kind="stable")[: self.beam_width]
+                state["levels"][curr_depth] = [current_rank[idx] for idx in top_idxs]
+                state["curr_depth"] = curr_depth + 1
+
+        return [self._collect_beam_result(state) for state in states]
+
+    def _init_beam(self, prompt, item_retrieval_result):
+        prediction_tree = {
+            0: {
+                "prompt": prompt,
+                "pred": "[Retrieval]",
+                "processed_pred": "",
+                "score": None,
+                "ctx": None,
+                "parent": None,
+            }
         }
-        levels[0] = [0]
-        while curr_depth < self.max_depth:
-            levels[curr_depth] = []
-            if curr_depth - 1 in levels and terminated is False:
-                for node in levels[curr_depth - 1]:
-                    pred = prediction_tree[node]["pred"]
-                    if pred == "</s>":
-                        terminated = True
-                        continue
-                    prompt = prediction_tree[node]["prompt"]
-                    prev_generation = prediction_tree[node]["processed_pred"]
-                    score = prediction_tree[node]["score"]
-                    if "[Retrieval]" in pred:
-                        retrieval_results = {}
-
-                        if item_retrieval_result is not None:
-                            aug_prompts = [
-                                prompt
-                                + prev_generation
-                                + "[Retrieval]"
-                                + "<paragraph>{}</paragraph>".format(para["contents"])
-                                for para in item_retrieval_result
-                            ]
-                        else:
-                            aug_prompts = [prompt + prev_generation]
-
-                        item_pred = self.generator.generate(aug_prompts, return_raw_output=True, logprobs=5)
-                        _, preds, scores, overall_score_dict = self.critic_preds(item_pred)
-
-                        for i, (pred, p_score) in enumerate(zip(preds, scores)):
-                            retrieval_results[i] = {"pred": pred, "score": p_score}
-
-                        for i, result in retrieval_results.items():
-                            node_id += 1
-                            node_score = result["score"] * score if score is not None else result["score"]
-                            pred = result["pred"]
-                            prediction_tree[node_id] = {
-                                "prompt": prompt + prev_generation,
-                                "pred": pred,
-                                "score": node_score,
-                                "ctx": item_retrieval_result[i],
-                                "parent": node,
-                                "overall_score_dict": overall_score_dict,
-                            }
-
-                            if "[Retrieval]" in pred:
-                                gen_result_index = pred.index("[Retrieval]")
-                                prev_generation = pred[:gen_result_index]
-                            else:
-                                prev_generation = pred
-                            prediction_tree[node_id]["processed_pred"] = prev_generation
-                            levels[curr_depth].append(node_id)
-
-                current_rank = levels[curr_depth]
-                node2score = {node_id: prediction_tree[node_id]["score"] for node_id in current_rank}
-                top_nodes = sorted(node2score.items(), key=lambda x: x[1], reverse=True)[: self.beam_width]
-                levels[curr_depth] = [node[0] for node in top_nodes]
-                curr_depth += 1
+        return {
+            "prediction_tree": prediction_tree,
+            "levels": {0: [0]},
+            "node_id": 0,
+            "curr_depth": 1,
+            "terminated": False,
+            "stopped": False,
+            "item_retrieval_result": item_retrieval_result,
+        }
+
+    def _get_expand_prompts(self, state, curr_depth):
+        prediction_tree = state["prediction_tree"]
+        item_retrieval_result = state["item_retrieval_result"]
+        for node in state["levels"][curr_depth - 1]:
+            pred = prediction_tree[node]["pred"]
+            if pred == "</s>":
+                state["terminated"] = True
+                continue
+            if "[Retrieval]" not in pred:
+                continue
+            prompt = prediction_tree[node]["prompt"]
+            prev_generation = prediction_tree[node]["processed_pred"]
+            if item_retrieval_result is not None:
+                aug_prompts = [
+                    prompt + prev_generation + "[Retrieval]" + "<paragraph>{}</paragraph>".format(para["contents"])
+                    for para in item_retrieval_result
+                ]
             else:
-                break
+                aug_prompts = [prompt + prev_generation]
+            yield node, aug_prompts
+
+    def _add_children(self, state, node, curr_depth, item_pred):
+        prediction_tree = state["prediction_tree"]
+        item_retrieval_result = state["item_retrieval_result"]
+        prompt = prediction_tree[node]["prompt"]
+        prev_generation = prediction_tree[node]["processed_pred"]
+        score = prediction_tree[node]["score"]
+
+        retrieval_results = {}
+        _, preds, scores, overall_score_dict = self.critic_preds(item_pred)
+        for i, (pred, p_score) in enumerate(zip(preds, scores)):
+            retrieval_results[i] = {"pred": pred, "score": p_score}
+
+        for i, result in retrieval_results.items():
+            state["node_id"] += 1
+            node_id = state["node_id"]
+            node_score = result["score"] * score if score is not None else result["score"]
+            pred = result["pred"]
+            prediction_tree[node_id] = {
+                "prompt": prompt + prev_generation,
+                "pred": pred,
+                "score": node_score,
+                "ctx": item_retrieval_result[i],
+                "parent": node,
+                "overall_score_dict": overall_score_dict,
+            }
+
+            if "[Retrieval]" in pred:
+                gen_result_index = pred.index("[Retrieval]")
+                prev_generation = pred[:gen_result_index]
+            else:
+                prev_generation = pred
+            prediction_tree[node_id]["processed_pred"] = prev_generation
+            state["levels"][curr_depth].append(node_id)
+
+    def _collect_beam_result(self, state):
+        prediction_tree = state["prediction_tree"]
+        levels = state["levels"]
+        curr_depth = state["curr_depth"]
 
         final_prediction = ""
         parent = 0
@@ -595,27 +662,36 @@ class SelfRAGPipeline(BasicPipeline):
         retrieval_flags = self.judge_retrieve(input_prompts)
         dataset.update_output("retrieval_flag", retrieval_flags)
 
-        # for long form task, only support single item run
-        for item, prompt, retrieval_flag in zip(dataset, input_prompts, retrieval_flags):
-            if retrieval_flag:
-                pred, intermediate_result = self.run_single_beam(prompt, item_retrieval_result=item.retrieval_result)
-                item.update_output("intermediate_result", intermediate_result)
+        # beams of all items needing retrieval are searched together, other items are generated in one batch
+        retrieval_idxs = [idx for idx, retrieval_flag in enumerate(retrieval_flags) if retrieval_flag]
+        no_retrieval_idxs = [idx for idx, retrieval_flag in enumerate(retrieval_flags) if not retrieval_flag]
+        preds = [None] * len(input_prompts)
 
-                if self.task == "factscore":
-                    pred = self.postprocess_prediction(pred)
-                else:
-                    assert self.task in ["asqa", "eli5"]
-                    pred = self.postprocess_long_form(pred, intermediate_result)
+        beam_results = self.run_beams(
+            [input_prompts[idx] for idx in retrieval_idxs], [dataset[idx].retrieval_result for idx in retrieval_idxs]
+        )
+        for idx, (pred, intermediate_result) in zip(retrieval_idxs, beam_results):
+            dataset[idx].update_output("intermediate_result", intermediate_result)
+
+            if self.task == "factscore":
+                pred = self.postprocess_prediction(pred)
             else:
-                prompt += "[No Retrieval]"
-                pred = self.generator.generate(prompt)[0]
+                assert self.task in ["asqa", "eli5"]
+                pred = self.postprocess_long_form(pred, intermediate_result)
+            preds[idx] = pred
 
-            item.update_output("pred", pred)
+        if len(no_retrieval_idxs) > 0:
+            no_retrieval_preds = self.generator.generate([input_prompts[idx] + "[No Retrieval]" for idx in no_retrieval_idxs])
+            for idx, pred in zip(no_retrieval_idxs, no_retrieval_preds):
+                preds[idx] = pred
+
+        dataset.update_output("pred", preds)
 
         return dataset
 
     def run(self, dataset, do_eval=True, pred_process_fun=None, long_form=False):
         run_func = self.run_batch_pred_long_form if long_form else self.run_batch_pred
+        self.prefix_grouper.reset()
         
         # # to avoid oom, split the total dataset into small batches
         # all_dataset_list = []
@@ -625,6 +701,8 @@ class SelfRAGPipeline(BasicPipeline):
         # dataset = merge_batch_dataset(all_dataset_list)
 
         dataset = run_func(dataset)
+        if self.verbose:
+            print(f"Prefix grouping: {self.prefix_grouper.report()}")
         dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
         return dataset
 
@@ -659,7 +737,7 @@ class SelfRAGPipeline(BasicPipeline):
             item.update_output("prompt", prompt_list)
             all_input_list += prompt_list
 
-        batch_pred = self.generator.generate(all_input_list, return_raw_output=True, logprobs=5)
+        batch_pred = self.prefix_grouper.generate(self.generator, all_input_list, return_raw_output=True, logprobs=5)
 
         # parse output based on retrieval flag
         pred_idx = 0
@@ -749,55 +827,78 @@ class FLAREPipeline(BasicPipeline):
         return judge_result, new_query
 
     def run_item(self, item):
-        question = item.question
-        gen_length = 0
+        self.run_batch([item])
+
+    def run_batch(self, items):
+        # Advance all active items one look-ahead round at a time, each round issues one batched
+        # look-ahead generation, one batched retrieval and one batched generation with references
+        questions = [item.question for item in items]
+        final_gen_results = ["" for _ in items]
+        gen_lengths = [0 for _ in items]
         iter_round = 0
-        final_gen_result = ""
-        while gen_length < self.max_generation_length and iter_round < self.max_iter_num:
-            input_prompt = self.prompt_template.get_string(question=question, previous_gen=final_gen_result)
+        active_item_ids = list(range(len(items)))
 
-            # input_prompt = self.build_prompt(
-            #     question_list=[question], use_reference=False, previous_gen=final_gen_result)[0]
+        while active_item_ids and iter_round < self.max_iter_num:
+            input_prompts = [
+                self.prompt_template.get_string(question=questions[item_id], previous_gen=final_gen_results[item_id])
+                for item_id in active_item_ids
+            ]
             # scores: token logits of the whole generation seq
-            round_gen_output, scores = self.generator.generate(
-                input_prompt, return_scores=True, stop=self.stop_sym, max_new_tokens=self.look_ahead_steps
+            round_gen_outputs, round_scores = self.generator.generate(
+                input_prompts, return_scores=True, stop=self.stop_sym, max_new_tokens=self.look_ahead_steps
             )
-            round_gen_output, scores = round_gen_output[0], scores[0]
-            # next_sent_scores: token logits of the first sent in generation seq
-            next_sent, next_sent_score = self.get_next_sentence(round_gen_output, scores)
-            # judge next sentence
-            judge_result, query = self.judge_sent_confidence(next_sent, next_sent_score)
-            item.update_output(f"judge_result_iter{iter_round}", judge_result)
-
-            if not judge_result:
-                # do retrieval-augmented generation
-                retrieval_result = self.retriever.search(query)
-                item.update_output("retrieval_result", retrieval_result)
-                input_prompt = self.prompt_template.get_string(
-                    question=question, retrieval_result=retrieval_result, previous_gen=final_gen_result
-                )
 
-                # input_prompt = self.build_prompt(
-                #     question_list = [question],
-                #     retrieval_results = [retrieval_result],
-                #     previous_gen = final_gen_result)[0]
-                output, scores = self.generator.generate(
-                    input_prompt, return_scores=True, stop=self.stop_sym, max_new_tokens=self.look_ahead_steps
+            next_sents, next_sent_lengths = {}, {}
+            retrieval_item_ids, queries = [], []
+            for item_id, round_gen_output, scores in zip(active_item_ids, round_gen_outputs, round_scores):
+                # next_sent_scores: token logits of the first sent in generation seq
+                next_sent, next_sent_score = self.get_next_sentence(round_gen_output, scores)
+                # judge next sentence
+                judge_result, query = self.judge_sent_confidence(next_sent, next_sent_score)
+                items[item_id].update_output(f"judge_result_iter{iter_round}", judge_result)
+                next_sents[item_id] = next_sent
+                next_sent_lengths[item_id] = len(next_sent_score)
+                if not judge_result:
+                    retrieval_item_ids.append(item_id)
+                    queries.append(query)
+
+            if retrieval_item_ids:
+                # do retrieval-augmented generation for items with low-confidence sentences
+                retrieval_results = self.retriever.batch_search(queries)
+                input_prompts = [
+                    self.prompt_template.get_string(
+                        question=questions[item_id],
+                        retrieval_result=retrieval_result,
+                        previous_gen=final_gen_results[item_id],
+                    )
+                    for item_id, retrieval_result in zip(retrieval_item_ids, retrieval_results)
+                ]
+                outputs, scores_list = self.generator.generate(
+                    input_prompts, return_scores=True, stop=self.stop_sym, max_new_tokens=self.look_ahead_steps
                 )
-                output, scores = output[0], scores[0]
-                next_sent, _ = self.get_next_sentence(output, scores)
-                item.update_output(f"gen_iter_{iter_round}", next_sent)
-                item.update_output("retrieval_result", retrieval_result)
-
-            final_gen_result += next_sent
-            gen_length += len(next_sent_score)
+                for item_id, retrieval_result, output, scores in zip(
+                    retrieval_item_ids, retrieval_results, outputs, scores_list
+                ):
+                    next_sent, _ = self.get_next_sentence(output, scores)
+                    next_sents[item_id] = next_sent
+                    items[item_id].update_output(f"gen_iter_{iter_round}", next_sent)
+                    items[item_id].update_output("retrieval_result", retrieval_result)
+
+            # retire finished items
+            new_active_item_ids = []
+            for item_id in active_item_ids:
+                final_gen_results[item_id] += next_sents[item_id]
+                gen_lengths[item_id] += next_sent_lengths[item_id]
+                if gen_lengths[item_id] < self.max_generation_length:
+                    new_active_item_ids.append(item_id)
+            active_item_ids = new_active_item_ids
             iter_round += 1
 
-        item.update_output("pred", final_gen_result)
+        for item, final_gen_result in zip(items, final_gen_results):
+            item.update_output("pred", final_gen_result)
 
     def run(self, dataset, do_eval=True, pred_process_fun=None):
-        for item in tqdm(dataset, desc="Inference: "):
-            self.run_item(item)
+        self.run_batch(dataset)
 
         dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
         return dataset
@@ -842,81 +943,102 @@ class SelfAskPipeline(BasicPipeline):
                 new_doc_list.append(doc)
         return new_doc_list
 
+    def _build_context(self, question, retrieval_result, res):
+        follow_ups = "No." if self.single_hop else "Yes."
+        return (
+            self.format_reference(retrieval_result)
+            + f"\nQuesiton: {question}"
+            + "\nAre follow up questions needed here: "
+            + follow_ups
+            + "\n"
+            + res
+        )
+
     def run_item(self, item):
-        question = item.question
-        retrieval_result = self.retriever.search(question)
+        self.run_batch([item])
 
-        stop_condition = "Intermediate answer:"
-        follow_ups = "No." if self.single_hop else "Yes."
-        res = ""
-        early_exit = False
+    def run_batch(self, items):
+        # Each item keeps a small state record, all live items are stepped together: generation is
+        # batched per stop condition and the follow-up queries of a step are retrieved in one call
+        questions = [item.question for item in items]
+        retrieval_results = self.retriever.batch_search(questions)
+        states = [
+            {"stop_condition": "Intermediate answer:", "res": "", "retrieval_result": retrieval_result, "done": False}
+            for retrieval_result in retrieval_results
+        ]
+
+        active_item_ids = list(range(len(items)))
         for idx in range(self.max_iter):
-            input_prompt = (
-                self.P_INS
-                + "\n"
-                + self.format_reference(retrieval_result)
-                + f"\nQuesiton: {question}"
-                + "\nAre follow up questions needed here: "
-                + follow_ups
-                + "\n"
-                + res
-            )
-            gen_out = self.generator.generate(input_prompt, stop=["Context:", "#", stop_condition])[0]
-            item.update_output(f"intermediate_output_iter{idx}", gen_out)
+            if not active_item_ids:
+                break
+            stop_groups = {}
+            for item_id in active_item_ids:
+                stop_groups.setdefault(states[item_id]["stop_condition"], []).append(item_id)
+            gen_outs = {}
+            for stop_condition, group_item_ids in stop_groups.items():
+                input_prompts = [
+                    self.P_INS
+                    + "\n"
+                    + self._build_context(questions[item_id], states[item_id]["retrieval_result"], states[item_id]["res"])
+                    for item_id in group_item_ids
+                ]
+                outputs = self.generator.generate(input_prompts, stop=["Context:", "#", stop_condition])
+                gen_outs.update(zip(group_item_ids, outputs))
 
-            if stop_condition == "Intermediate answer:":
-                res += gen_out.split("Intermediate answer:")[0]
-                stop_condition = "Follow up:"
+            followup_item_ids, followup_queries, finished_item_ids = [], [], []
+            for item_id in active_item_ids:
+                state, gen_out = states[item_id], gen_outs[item_id]
+                items[item_id].update_output(f"intermediate_output_iter{idx}", gen_out)
 
-            elif stop_condition == "Follow up:":
-                followup_split = re.split(self.FOLLOW_UP_PATTERN, gen_out)
-                res += followup_split[0]
+                if state["stop_condition"] == "Intermediate answer:":
+                    state["res"] += gen_out.split("Intermediate answer:")[0]
+                    state["stop_condition"] = "Follow up:"
 
-                if len(followup_split) > 1:
-                    res += re.findall(self.FOLLOW_UP_PATTERN, gen_out)[0]
-                stop_condition = "Intermediate answer:"
+                elif state["stop_condition"] == "Follow up:":
+                    followup_split = re.split(self.FOLLOW_UP_PATTERN, gen_out)
+                    state["res"] += followup_split[0]
 
-            # make sure the result does not end in a new line
-            if len(res) == 0:
-                early_exit = True
-                break
-            if res[-1] == "\n":
-                res = res[:-1]
-
-            if "Follow up: " in gen_out:
-                # get the first follow up
-                new_query = [l for l in gen_out.split("\n") if "Follow up: " in l][0].split("Follow up: ")[-1]
-                retrieval_result = self.retriever.search(new_query)
-
-            if "So the final answer is: " in gen_out:
-                res = (
-                    self.format_reference(retrieval_result)
-                    + f"\nQuesiton: {question}"
-                    + "\nAre follow up questions needed here: "
-                    + follow_ups
-                    + "\n"
-                    + res
-                )
-                early_exit = True
-                # print("Success: early exit!")
-                break
+                    if len(followup_split) > 1:
+                        state["res"] += re.findall(self.FOLLOW_UP_PATTERN, gen_out)[0]
+                    state["stop_condition"] = "Intermediate answer:"
 
-        if not early_exit:
-            res = (
-                self.format_reference(retrieval_result)
-                + f"\nQuesiton: {question}"
-                + "\nAre follow up questions needed here: "
-                + follow_ups
-                + "\n"
-                + res
-            )
+                # make sure the result does not end in a new line
+                if len(state["res"]) == 0:
+                    state["done"] = True
+                    continue
+                if state["res"][-1] == "\n":
+                    state["res"] = state["res"][:-1]
+
+                if "Follow up: " in gen_out:
+                    # get the first follow up
+                    new_query = [l for l in gen_out.split("\n") if "Follow up: " in l][0].split("Follow up: ")[-1]
+                    followup_item_ids.append(item_id)
+                    followup_queries.append(new_query)
+
+                if "So the final answer is: " in gen_out:
+                    finished_item_ids.append(item_id)
 
-        item.update_output("retrieval_result", retrieval_result)
-        item.update_output("pred", res)
+            if followup_item_ids:
+                for item_id, retrieval_result in zip(followup_item_ids, self.retriever.batch_search(followup_queries)):
+                    states[item_id]["retrieval_result"] = retrieval_result
+
+            for item_id in finished_item_ids:
+                state = states[item_id]
+                state["res"] = self._build_context(questions[item_id], state["retrieval_result"], state["res"])
+                state["done"] = True
+
+            active_item_ids = [item_id for item_id in active_item_ids if not states[item_id]["done"]]
+
+        for item_id in active_item_ids:
+            state = states[item_id]
+            state["res"] = self._build_context(questions[item_id], state["retrieval_result"], state["res"])
+
+        for item, state in zip(items, states):
+            item.update_output("retrieval_result", state["retrieval_result"])
+            item.update_output("pred", state["res"])
 
     def run(self, dataset, do_eval=True, pred_process_fun=selfask_pred_parse):
-        for item in tqdm(dataset, desc="Inference: "):
-            self.run_item(item)
+        self.run_batch(dataset)
 
         dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
         return dataset
@@ -944,25 +1066,21 @@ class IRCOTPipeline(BasicPipeline):
         self.retriever = get_retriever(config) if retriever is None else retriever
 
         self.max_iter = max_iter
+        # query reuse of the retrieval session in the last run
+        self.retrieval_stats = None
 
     def run_batch(self, items):
         # Initialize the necessary data structures
         batch_thoughts = {item_id: [] for item_id in range(len(items))}
         iter_num = 0
-        batch_retrieval_results = []
-        doc2score_batch = []
-        id2doc_batch = []
+        # caches issued queries and merges the docs of each item across iterations
+        retrieval_session = RetrievalSession(self.retriever, len(items))
 
         # Initial retrieval for all items in the batch
         questions = [item.question for item in items]
-        retrieval_results, scoress = self.retriever.batch_search(questions, return_score=True)
-        for retrieval_result, scores in zip(retrieval_results,scoress):   
-            
-            doc2score = {doc_item['id']: score for doc_item, score in zip(retrieval_result, scores)}
-            id2doc = {doc_item['id']: doc_item for doc_item in retrieval_result}
-            batch_retrieval_results.append(retrieval_result)
-            doc2score_batch.append(doc2score)
-            id2doc_batch.append(id2doc)
+        batch_retrieval_results, scoress = retrieval_session.search(questions)
+        for item_id, (retrieval_result, scores) in enumerate(zip(batch_retrieval_results, scoress)):
+            retrieval_session.add(item_id, retrieval_result, scores)
 
         # Start the iterative process
         active_item_ids = list(range(len(items)))  # Track items that need more iterations
@@ -1005,27 +1123,18 @@ class IRCOTPipeline(BasicPipeline):
             # Perform batch retrieval for new thoughts of active items
             if active_item_ids:
                 new_thoughts_for_retrieval = [batch_thoughts[item_id][-1] for item_id in active_item_ids]
-                new_retrieval_results, new_scoress = self.retriever.batch_search(new_thoughts_for_retrieval, return_score=True)
-
-                for i, item_id in enumerate(active_item_ids):
-                    new_retrieval_result, new_scores = new_retrieval_results[i],new_scoress[i]
-                    
-                    # Update doc2score and id2doc for the current item
-                    for doc_item, score in zip(new_retrieval_result, new_scores):
-                        doc_id = doc_item['id']
-                        id2doc_batch[item_id][doc_id] = doc_item
-                        if doc_id in doc2score_batch[item_id]:
-                            doc2score_batch[item_id][doc_id] = max(doc2score_batch[item_id][doc_id], score)
-                        else:
-                            doc2score_batch[item_id][doc_id] = score
+                new_retrieval_results, new_scoress = retrieval_session.search(new_thoughts_for_retrieval)
 
-                    # Sort and update retrieval results
-                    sorted_doc_score = sorted(doc2score_batch[item_id].items(), key=lambda x: x[1], reverse=False)
-                    sorted_doc_id = [t[0] for t in sorted_doc_score]
-                    batch_retrieval_results[item_id] = [id2doc_batch[item_id][id] for id in sorted_doc_id]
+                for item_id, new_retrieval_result, new_scores in zip(active_item_ids, new_retrieval_results, new_scoress):
+                    # Merge docs (max score for duplicated docs) and sort them by score in ascending order
+                    retrieval_session.add(item_id, new_retrieval_result, new_scores)
+                    batch_retrieval_results[item_id] = retrieval_session.get_docs(item_id, ascending=True)
 
             iter_num += 1
 
+        self.retrieval_stats = retrieval_session.stats()
+        if self.verbose:
+            print(f"Retrieval session: {self.retrieval_stats}")
         # Final update for each item in the batch
         for item_id, item in enumerate(items):
             item.update_output('retrieval_result', batch_retrieval_results[item_id])
@@ -1079,7 +1188,8 @@ class RQRAGPipeline(BasicPipeline):
         retriever = None,
         generator = None,
         max_depth = 3,
-        batch_size = 32
+        batch_size = 32,
+        max_frontier_size = None
     ):
         super().__init__(config, prompt_template)
 
@@ -1089,6 +1199,13 @@ class RQRAGPipeline(BasicPipeline):
         
         self.max_depth = max_depth
         self.batch_size = batch_size
+        # max number of paths expanded together, None means the whole frontier of a depth
+        self.max_frontier_size = max_frontier_size
+        # per-depth stats of all batches in the last run
+        self.depth_stats = []
+        self.num_batches = 0
+        # sibling paths share the prompt of their parent
+        self.prefix_grouper = PrefixGrouper(verbose=self.verbose)
         
         # Due to the low effiency of original method, it only supports vllm now.
     
@@ -1112,110 +1229,132 @@ class RQRAGPipeline(BasicPipeline):
         return format_evidence
 
     def generate_tree_of_thoughts_batch(self, initial_prompts_batch: List[str]):
-        paths_batch_dict = {
-            idx: [{
-                "prompt": initial_prompt,
-                "depth": 0,
-                "done": False
-            }]
+        """Expand the trees of all items depth by depth.
+
+        All pending paths of all items form the frontier of a depth. The query tokens of every path are
+        generated in one call and the answers of every path in another (the two use different sampling
+        params), and all resulting queries are retrieved with one `batch_search`. The frontier is processed
+        in slices of `max_frontier_size` paths to bound memory.
+        """
+        frontier = [
+            {"item_idx": idx, "prompt": initial_prompt, "depth": 0, "done": False}
             for idx, initial_prompt in enumerate(initial_prompts_batch)
-        }
-        
+        ]
         final_outputs_batch = {idx: [] for idx in range(len(initial_prompts_batch))}
-        
-        while any(paths for paths in paths_batch_dict.values()):
-            current_batch = []
-            for i, _ in paths_batch_dict.items():
-                if paths_batch_dict[i]:
-                    current_path = paths_batch_dict[i].pop(0)
-                    current_batch.append(current_path)
-                else:
-                    continue
-            
-            if not current_batch:
-                break
-            
-            for special_token in self.expand_on_tokens:
-                
-                if current_batch[0]["depth"] >= self.max_depth and special_token != "[A_Response]":
-                    continue
-                
-                # Prepare for inputs
-                input_texts = [path["prompt"] + special_token for path in current_batch]
-            
-                # Generate outputs
-                if special_token != "[A_Response]":
-                    init_outputs = self.generator.generate(
-                        input_list = input_texts,
-                        return_raw_output = True,
-                        **self.response_generation_params
-                    )
-                else:
-                    init_outputs = self.generator.generate(
-                        input_list = input_texts,
-                        return_raw_output = True,
-                        **self.other_generation_params
-                    )
 
-                # Decode outputs
-                decoded_outputs = [output.outputs[0].text for output in init_outputs]
-                # Initialize lists to collect queries for batch retrieval
-                queries_for_search = []
-                
-                # Process outputs and prepare for retrieval
-                for i, decoded_output in enumerate(decoded_outputs):
-                    current_path = current_batch[i]
-                    decoded_output = decoded_output.replace("<s> ", "<s>")
-                    
-                    if special_token == "[A_Response]":
-                        pattern = r"(.*?)\[EOS\]"
-                        matches = re.findall(pattern, decoded_output, re.DOTALL)
-                        result = matches[-1].strip() if matches else "Unable to detect valid answer"
-                        token_ids = init_outputs[i].outputs[0].token_ids[1:-1]
-                        logprobs = init_outputs[i].outputs[0].logprobs[1:-1]
-                        confidence = 0
-                        for token_id, logprobs in zip(token_ids, logprobs):
-                            logprob = logprobs[token_id].logprob
-                            prob = math.exp(logprob)
-                            confidence += prob
-                        
-                        if len(token_ids) > 0:
-                            confidence /= len(token_ids)
-                        
-                        new_path = {
-                            "prompt": input_texts[i] + decoded_output,
-                            "depth": current_path["depth"],
-                            "done": True,
-                            "final_answer": result,
-                            "confidence": confidence
-                        }
-                        final_outputs_batch[i].append(new_path)
-                    else:
-                        # Extract the query
-                        pattern = r"(.*?)\[EOS\]"
-                        matches = re.findall(pattern, decoded_output, re.DOTALL)
-                        query_for_search = matches[-1].strip() if matches else "dummy"
-                        queries_for_search.append(query_for_search)
-                
-                # Perform batch retrieval
-                if queries_for_search:
-                    batch_search_results = self.retriever.batch_search(queries_for_search)
-                    
-                    for i, decoded_output in enumerate(decoded_outputs):
-                        search_results = batch_search_results[i]
-                        format_evidence = self.format_evidences(search_results)
-                        new_prompt = decoded_output + "[R_Evidences]" + format_evidence + "[/R_Evidences]"
-                        new_path = {
-                            "prompt": input_texts[i] + new_prompt,
-                            "depth": current_path["depth"] + 1,
-                            "done": False,
-                        }
-                        paths_batch_dict[i].append(new_path)
+        while frontier:
+            depth = frontier[0]["depth"]
+            start_time = time.time()
+            slice_size = self.max_frontier_size if self.max_frontier_size is not None else len(frontier)
+            next_frontier = []
+            num_inputs, num_queries = 0, 0
+            for start in range(0, len(frontier), slice_size):
+                paths = frontier[start : start + slice_size]
+                new_paths, answer_paths, slice_num_inputs, slice_num_queries = self._expand_frontier(paths)
+                next_frontier += new_paths
+                for path in answer_paths:
+                    final_outputs_batch[path["item_idx"]].append(path)
+                num_inputs += slice_num_inputs
+                num_queries += slice_num_queries
+
+            elapsed = time.time() - start_time
+            self.depth_stats.append(
+                {
+                    "batch": self.num_batches,
+                    "depth": depth,
+                    "num_paths": len(frontier),
+                    "num_generation_inputs": num_inputs,
+                    "num_queries": num_queries,
+                    "time": elapsed,
+                    "inputs_per_second": num_inputs / max(elapsed, 1e-6),
+                }
+            )
+            frontier = next_frontier
 
         final_outputs_batch_list = [final_outputs_batch[i] for i in range(len(initial_prompts_batch))]
-        
+
         return final_outputs_batch_list
 
+    def _expand_frontier(self, paths):
+        """Generate answers for all paths and sub-queries for paths below max depth, then retrieve
+        evidences of all sub-queries in one batch."""
+        # every path is answered
+        answer_inputs = [path["prompt"] + "[A_Response]" for path in paths]
+        answer_outputs = self.prefix_grouper.generate(
+            self.generator,
+            answer_inputs,
+            return_raw_output = True,
+            **self.other_generation_params
+        )
+        answer_paths = []
+        for path, input_text, output in zip(paths, answer_inputs, answer_outputs):
+            decoded_output = output.outputs[0].text.replace("<s> ", "<s>")
+            pattern = r"(.*?)\[EOS\]"
+            matches = re.findall(pattern, decoded_output, re.DOTALL)
+            result = matches[-1].strip() if matches else "Unable to detect valid answer"
+            token_ids = output.outputs[0].token_ids[1:-1]
+            token_logprobs = output.outputs[0].logprobs[1:-1]
+            confidence = 0
+            for token_id, logprobs in zip(token_ids, token_logprobs):
+                logprob = logprobs[token_id].logprob
+                prob = math.exp(logprob)
+                confidence += prob
+
+            if len(token_ids) > 0:
+                confidence /= len(token_ids)
+
+            answer_paths.append(
+                {
+                    "item_idx": path["item_idx"],
+                    "prompt": input_text + decoded_output,
+                    "depth": path["depth"],
+                    "done": True,
+                    "final_answer": result,
+                    "confidence": confidence,
+                }
+            )
+
+        # paths below max depth are expanded with every query token
+        expand_requests = [
+            (path, path["prompt"] + special_token)
+            for path in paths
+            if path["depth"] < self.max_depth
+            for special_token in self.expand_on_tokens
+            if special_token != "[A_Response]"
+        ]
+        new_paths = []
+        if expand_requests:
+            expand_outputs = self.prefix_grouper.generate(
+                self.generator,
+                [input_text for _, input_text in expand_requests],
+                return_raw_output = True,
+                **self.response_generation_params
+            )
+            decoded_outputs = [output.outputs[0].text.replace("<s> ", "<s>") for output in expand_outputs]
+            queries_for_search = []
+            for decoded_output in decoded_outputs:
+                # Extract the query
+                pattern = r"(.*?)\[EOS\]"
+                matches = re.findall(pattern, decoded_output, re.DOTALL)
+                queries_for_search.append(matches[-1].strip() if matches else "dummy")
+
+            batch_search_results = self.retriever.batch_search(queries_for_search)
+            for (path, input_text), decoded_output, search_results in zip(
+                expand_requests, decoded_outputs, batch_search_results
+            ):
+                format_evidence = self.format_evidences(search_results)
+                new_prompt = decoded_output + "[R_Evidences]" + format_evidence + "[/R_Evidences]"
+                new_paths.append(
+                    {
+                        "item_idx": path["item_idx"],
+                        "prompt": input_text + new_prompt,
+                        "depth": path["depth"] + 1,
+                        "done": False,
+                    }
+                )
+
+        return new_paths, answer_paths, len(answer_inputs) + len(expand_requests), len(expand_requests)
+
     def select_best_path_single_turn(self, final_outputs):
         # After generating all paths, we can select the best answer
         # Compute perplexity and confidence for each path
@@ -1235,6 +1374,9 @@ class RQRAGPipeline(BasicPipeline):
     def run(self, dataset, do_eval = True):
         preds = []
         meta_results = []
+        self.prefix_grouper.reset()
+        self.depth_stats = []
+        self.num_batches = 0
 
         for i in tqdm(range(0, len(dataset), self.batch_size), position=0, desc='RQRAG Process'):
             batch_items = dataset[i : i + self.batch_size]
@@ -1244,8 +1386,15 @@ class RQRAGPipeline(BasicPipeline):
                 pred, best_path = self.select_best_path_single_turn(paths)
                 preds.append(pred)
                 meta_results.append(best_path)
+            if self.verbose:
+                for depth_stat in self.depth_stats:
+                    if depth_stat["batch"] == self.num_batches:
+                        print(" | ".join(f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}" for k, v in depth_stat.items()))
+            self.num_batches += 1
 
 
+        if self.verbose:
+            print(f"Prefix grouping: {self.prefix_grouper.report()}")
         dataset.update_output("paths", meta_results)
         dataset.update_output("pred", preds)
 
@@ -6,11 +6,17 @@ import numpy as np
 from transformers import LogitsProcessorList
 from flashrag.utils import get_retriever, get_generator
 from flashrag.pipeline import BasicPipeline
+from flashrag.pipeline.utils import PrefixGrouper
 from flashrag.prompt import PromptTemplate
 
 
 class REPLUGPipeline(BasicPipeline):
-    def __init__(self, config, prompt_template=None, retriever=None, generator=None):
+    def __init__(self, config, prompt_template=None, retriever=None, generator=None, batch_size=None):
+        """
+        Args:
+            batch_size: number of questions whose docs are packed into one generation batch. If None, use
+                `replug_batch_size` in config, otherwise fit `generator_batch_size` rows (at least one question).
+        """
         from flashrag.pipeline.replug_utils import load_replug_model
 
         super().__init__(config, prompt_template)
@@ -22,6 +28,13 @@ class REPLUGPipeline(BasicPipeline):
             retriever = get_retriever(config)
         self.generator = generator
         self.retriever = retriever
+
+        if batch_size is None:
+            batch_size = config["replug_batch_size"] if "replug_batch_size" in config else None
+        if batch_size is None:
+            batch_size = max(1, config["generator_batch_size"] // config["retrieval_topk"])
+        self.batch_size = batch_size
+
     def build_single_doc_prompt(self, question: str, doc_list: List[str]):
         return [self.prompt_template.get_string(question=question, formatted_reference=doc) for doc in doc_list]
 
@@ -40,19 +53,33 @@ class REPLUGPipeline(BasicPipeline):
         dataset.update_output("retrieval_result", retrieval_results)
         dataset.update_output("doc_scores", doc_scores)
 
+        self.prefix_grouper = PrefixGrouper(verbose=self.verbose)
         pred_answer_list = []
-        # each doc has a prompt
-        for item in tqdm(dataset, desc="Inference: "):
-            docs = [self.format_reference(doc_item) for doc_item in item.retrieval_result]
-            prompts = self.build_single_doc_prompt(question=item.question, doc_list=docs)
-
-            scores = torch.tensor(item.doc_scores, dtype=torch.float32).to(self.device)
+        # each doc has a prompt, the docs of `batch_size` questions are generated in one batch and
+        # the logits are mixed within the docs of each question
+        for start in tqdm(range(0, len(dataset), self.batch_size), desc="Inference: "):
+            batch_items = [dataset[idx] for idx in range(start, min(start + self.batch_size, len(dataset)))]
+            prompts, scores, group_ids, group_first_rows = [], [], [], []
+            for group_idx, item in enumerate(batch_items):
+                docs = [self.format_reference(doc_item) for doc_item in item.retrieval_result]
+                group_first_rows.append(len(prompts))
+                prompts += self.build_single_doc_prompt(question=item.question, doc_list=docs)
+                scores += list(item.doc_scores)
+                group_ids += [group_idx] * len(docs)
+
+            # docs of a question must stay together for logits mixing, only the prefix sharing is reported
+            self.prefix_grouper.measure(prompts)
+            scores = torch.tensor(scores, dtype=torch.float32).to(self.device)
+            group_ids = torch.tensor(group_ids, dtype=torch.long).to(self.device)
             output = self.generator.generate(
-                prompts, batch_size=len(docs), logits_processor=LogitsProcessorList([REPLUGLogitsProcessor(scores)])
+                prompts,
+                batch_size=len(prompts),
+                logits_processor=LogitsProcessorList([REPLUGLogitsProcessor(scores, group_ids)]),
             )
-            # the output of the batch is same
-            output = output[0]
-            pred_answer_list.append(output)
+            # the output of the docs of the same question is same
+            pred_answer_list += [output[row] for row in group_first_rows]
+        if self.verbose:
+            print(f"Prefix grouping: {self.prefix_grouper.report()}")
 
         dataset.update_output("pred", pred_answer_list)
 
@@ -169,79 +196,98 @@ class SuRePipeline(BasicPipeline):
             score = 0.5
         return score
 
+    def _generate(self, input_prompts):
+        if len(input_prompts) == 0:
+            return []
+        return self.generator.generate(input_prompts)
+
     def run(self, dataset, do_eval=True, pred_process_fun=None):
         input_query = dataset.question
 
         retrieval_results, doc_scores = self.retriever.batch_search(input_query, return_score=True)
         dataset.update_output("retrieval_result", retrieval_results)
 
-        pred_answer_list = []
-        for item in tqdm(dataset, desc="Pipeline runing: "):
-            retrieval_result = item.retrieval_result
-            doc_num = len(retrieval_result)
+        # Stage-wise batching: every stage issues one generate call over all (item, candidate) pairs
+        # of the dataset, the ragged structure is tracked by flat index arrays
+        formatted_refs = []
+        for retrieval_result in retrieval_results:
             # format all docs
             for doc_item in retrieval_result:
                 if "title" not in doc_item or "text" not in doc_item:
                     doc_item["title"] = doc_item["contents"].split("\n")[0]
                     doc_item["text"] = "\n".join(doc_item["contents"].split("\n")[1:])
-            formatted_ref = self.format_ref(
-                titles=[i["title"] for i in retrieval_result], texts=[i["text"] for i in retrieval_result]
+            formatted_refs.append(
+                self.format_ref(
+                    titles=[i["title"] for i in retrieval_result], texts=[i["text"] for i in retrieval_result]
+                )
             )
-            # get candidates
-
-            input_prompt = self.P_CAN_TEMPLATE.get_string(
-                N=doc_num, formatted_reference=formatted_ref, question=item.question
+        questions = dataset.question
+
+        # get candidates
+        input_prompts = [
+            self.P_CAN_TEMPLATE.get_string(N=len(retrieval_result), formatted_reference=formatted_ref, question=question)
+            for question, retrieval_result, formatted_ref in zip(questions, retrieval_results, formatted_refs)
+        ]
+        all_candidates = [self.parse_candidates(output) for output in self._generate(input_prompts)]
+        dataset.update_output("candidates", all_candidates)
+        if any(len(candidates) == 0 for candidates in all_candidates):
+            print("No valid predictions!")
+
+        # flat (item, candidate) pairs, the candidates of item i are pair_offsets[i]:pair_offsets[i + 1]
+        cand_nums = np.array([len(candidates) for candidates in all_candidates], dtype=np.int64)
+        pair_offsets = np.concatenate([[0], np.cumsum(cand_nums)])
+        pair_item_idxs = np.repeat(np.arange(len(all_candidates)), cand_nums)
+        flat_candidates = [cand for candidates in all_candidates for cand in candidates]
+
+        # get summarization for each candidate
+        input_prompts = [
+            self.P_SUM_TEMPLATE.get_string(
+                question=questions[item_idx], pred=cand, formatted_reference=formatted_refs[item_idx]
+            )
+            for item_idx, cand in zip(pair_item_idxs, flat_candidates)
+        ]
+        flat_summary = self._generate(input_prompts)
+
+        # instance-wise validation
+        input_prompts = [
+            self.P_VAL_TEMPLATE.get_string(question=questions[item_idx], pred=cand, summary=summary)
+            for item_idx, cand, summary in zip(pair_item_idxs, flat_candidates, flat_summary)
+        ]
+        flat_val_scores = [self.parse_validation(res) for res in self._generate(input_prompts)]
+
+        # pair-wise ranking, all ordered summary pairs of all items
+        rank_pairs = []
+        for item_idx, cand_num in enumerate(cand_nums):
+            offset = pair_offsets[item_idx]
+            rank_pairs.extend(
+                (item_idx, offset + i, offset + j) for i, j in itertools.permutations(range(cand_num), 2)
             )
-            output = self.generator.generate([input_prompt])[0]
-            candidates = self.parse_candidates(output)
-            item.update_output("candidates", candidates)
+        input_prompts = [
+            self.P_RANK_TEMPLATE.get_string(
+                question=questions[item_idx], summary1=flat_summary[summary1_idx], summary2=flat_summary[summary2_idx]
+            )
+            for item_idx, summary1_idx, summary2_idx in rank_pairs
+        ]
+        flat_ranking_scores = np.zeros(len(flat_candidates))
+        if len(rank_pairs) > 0:
+            pair_scores = np.array([self.parse_ranking(res) for res in self._generate(input_prompts)])
+            # ranking score for each summary: sum of its scores as the first passage
+            np.add.at(flat_ranking_scores, np.array([pair[1] for pair in rank_pairs]), pair_scores)
 
+        pred_answer_list = []
+        for item_idx, item in enumerate(dataset):
+            candidates = all_candidates[item_idx]
             if len(candidates) == 0:
-                print("No valid predictions!")
-                pred = ""
-                pred_answer_list.append(pred)
+                pred_answer_list.append("")
                 continue
-
-            # get summarization for each candidate
-            input_prompts = [
-                self.P_SUM_TEMPLATE.get_string(question=item.question, pred=cand, formatted_reference=formatted_ref)
-                for cand in candidates
-            ]
-
-            all_summary = self.generator.generate(input_prompts)
-            item.update_output("all_summary", all_summary)
-
-            # instance-wise validation
-            input_prompts = [
-                self.P_VAL_TEMPLATE.get_string(question=item.question, pred=cand, summary=summary)
-                for cand, summary in zip(candidates, all_summary)
-            ]
-            val_results = self.generator.generate(input_prompts)
-            val_scores = [self.parse_validation(res) for res in val_results]
+            start, end = pair_offsets[item_idx], pair_offsets[item_idx + 1]
+            item.update_output("all_summary", flat_summary[start:end])
+            val_scores = flat_val_scores[start:end]
             item.update_output("val_scores", val_scores)
-
-            # pair-wise ranking
-            summary_num = len(all_summary)
-            score_matrix = np.zeros((summary_num, summary_num))
-            iter_idxs = list(itertools.permutations(range(summary_num), 2))
-            input_prompts = [
-                self.P_RANK_TEMPLATE.get_string(
-                    question=item.question, summary1=all_summary[idx_tuple[0]], summary2=all_summary[idx_tuple[1]]
-                )
-                for idx_tuple in iter_idxs
-            ]
-            ranking_output = self.generator.generate(input_prompts)
-            ranking_scores = [self.parse_ranking(res) for res in ranking_output]
-            for idx_tuple, score in zip(iter_idxs, ranking_scores):
-                score_matrix[idx_tuple[0], idx_tuple[1]] = score
-            ranking_scores = score_matrix.sum(axis=1).squeeze().tolist()  # ranking score for each summary
-            item.update_output("ranking_scores", ranking_scores)
+            ranking_scores = flat_ranking_scores[start:end].tolist()
+            item.update_output("ranking_scores", ranking_scores if len(ranking_scores) > 1 else ranking_scores[0])
 
             # combine two scores as the final score for each summary
-            if not isinstance(ranking_scores, list):
-                ranking_scores = [ranking_scores]
-            if not isinstance(val_scores, list):
-                val_scores = [val_scores]
             total_scores = [x + y for x, y in zip(val_scores, ranking_scores)]
 
             best_idx = np.argmax(total_scores)
@@ -0,0 +1,185 @@
+import os
+import queue
+import traceback
+from copy import deepcopy
+from tqdm import tqdm
+from flashrag.evaluator import Evaluator
+from flashrag.dataset import Dataset, Item
+
+
+def _worker_loop(worker_idx, final_config, device, num_cpu_threads, pipeline_class, pipeline_params, run_params, task_queue, result_queue):
+    """Entry of a worker process: build its own pipeline replica and run the chunks from the task queue."""
+    try:
+        from flashrag.config import Config
+
+        worker_config = deepcopy(final_config)
+        # an empty gpu id hides all gpus, the worker runs on cpu
+        worker_config["gpu_id"] = "" if device == "cpu" else device
+        if device == "cpu":
+            worker_config["faiss_gpu"] = False
+        worker_config["disable_save"] = True
+        worker_config["save_intermediate_data"] = False
+        config = Config(config_dict=worker_config)
+        if device == "cpu" and num_cpu_threads is not None:
+            import torch
+
+            torch.set_num_threads(num_cpu_threads)
+
+        pipeline = pipeline_class(config, **pipeline_params)
+    except Exception:
+        result_queue.put(("error", worker_idx, traceback.format_exc()))
+        return
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        chunk_idx, item_dicts = task
+        try:
+            dataset = Dataset(config=config, data=item_dicts)
+            dataset = pipeline.run(dataset, do_eval=False, **run_params)
+            result_queue.put(("result", chunk_idx, [item.to_dict() for item in dataset]))
+        except Exception:
+            result_queue.put(("error", worker_idx, traceback.format_exc()))
+            return
+
+
+class ParallelPipelineRunner:
+    """Run a pipeline with several worker processes, each holding its own retriever / generator replica.
+
+    The dataset is split into chunks, which are taken by the workers from a shared task queue. Results are
+    streamed back as chunks finish, merged in the original order and evaluated in the main process.
+    Workers are started with `spawn`, so `pipeline_class` and `pipeline_params` must be picklable.
+    Cpu workers run the retriever, reranker and refiner on cpu and search the faiss index on cpu, their
+    generator must run on cpu too, so only the `hf` and `openai` frameworks are supported with them.
+    """
+
+    # seconds to wait for a result before checking that the workers are still alive
+    poll_interval = 5
+
+    def __init__(self, config, pipeline_class, pipeline_params=None, num_workers=None, worker_devices=None, chunk_size=None):
+        """
+        Args:
+            pipeline_class: a subclass of `BasicPipeline`, built in each worker as `pipeline_class(config, **pipeline_params)`.
+            num_workers: number of worker processes, default to `parallel_num_workers` in config,
+                otherwise one worker per gpu in `gpu_id` (one cpu worker if no gpu is available).
+            worker_devices: device of each worker, e.g. ["0", "1"], ["0,1", "2,3"] or ["cpu", "cpu"].
+                Default to `parallel_worker_devices` in config, otherwise gpus are assigned round-robin.
+            chunk_size: number of items per task, default to `pipeline_chunk_size` in config.
+        """
+        self.config = config
+        self.pipeline_class = pipeline_class
+        self.pipeline_params = {} if pipeline_params is None else pipeline_params
+        self.evaluator = Evaluator(config)
+
+        if worker_devices is None:
+            worker_devices = config["parallel_worker_devices"] if "parallel_worker_devices" in config else None
+        if num_workers is None:
+            num_workers = config["parallel_num_workers"] if "parallel_num_workers" in config else None
+
+        if worker_devices is None:
+            gpu_ids = [] if config["gpu_num"] == 0 or config["gpu_id"] is None else str(config["gpu_id"]).split(",")
+            if num_workers is None:
+                num_workers = max(len(gpu_ids), 1)
+            if len(gpu_ids) == 0:
+                worker_devices = ["cpu"] * num_workers
+            else:
+                worker_devices = [gpu_ids[idx % len(gpu_ids)] for idx in range(num_workers)]
+        worker_devices = [str(device) for device in worker_devices]
+        if num_workers is None:
+            num_workers = len(worker_devices)
+        assert len(worker_devices) == num_workers, "The number of worker devices should equal to the number of workers."
+        if "cpu" in worker_devices:
+            framework = config["framework"] if "framework" in config else None
+            # vllm and fschat only load the generator on gpu
+            assert framework not in ["vllm", "fschat"], f"Cpu workers can not run a generator with framework `{framework}`, use `hf` or `openai`."
+        self.num_workers = num_workers
+        self.worker_devices = worker_devices
+
+        if chunk_size is None:
+            chunk_size = config["pipeline_chunk_size"] if "pipeline_chunk_size" in config else None
+        if chunk_size is None:
+            chunk_size = 256
+        self.chunk_size = chunk_size
+
+    def run(self, dataset, do_eval=True, pred_process_fun=None, **run_params):
+        """Run the pipeline over the dataset with all workers and evaluate the merged result.
+
+        `run_params` are passed to `run` of the pipeline in each worker. Predictions are processed by the
+        pipeline in the workers; `pred_process_fun` (if given) replaces its default and must be picklable.
+        """
+        import multiprocessing as mp
+
+        if pred_process_fun is not None:
+            run_params["pred_process_fun"] = pred_process_fun
+
+        chunks = [
+            [item.to_dict() for item in dataset.data[idx : idx + self.chunk_size]]
+            for idx in range(0, len(dataset), self.chunk_size)
+        ]
+        num_cpu_workers = sum(device == "cpu" for device in self.worker_devices)
+        num_cpu_threads = max(1, (os.cpu_count() or 1) // num_cpu_workers) if num_cpu_workers > 0 else None
+
+        ctx = mp.get_context("spawn")
+        task_queue = ctx.Queue()
+        result_queue = ctx.Queue()
+        for chunk_idx, chunk in enumerate(chunks):
+            task_queue.put((chunk_idx, chunk))
+        for _ in range(self.num_workers):
+            task_queue.put(None)
+
+        final_config = self.config.final_config if hasattr(self.config, "final_config") else dict(self.config)
+        workers = [
+            ctx.Process(
+                target=_worker_loop,
+                args=(
+                    worker_idx,
+                    final_config,
+                    device,
+                    num_cpu_threads,
+                    self.pipeline_class,
+                    self.pipeline_params,
+                    run_params,
+                    task_queue,
+                    result_queue,
+                ),
+                daemon=True,
+            )
+            for worker_idx, device in enumerate(self.worker_devices)
+        ]
+        for worker in workers:
+            worker.start()
+
+        chunk_results = {}
+        try:
+            with tqdm(total=len(chunks), desc="Parallel inference: ") as pbar:
+                while len(chunk_results) < len(chunks):
+                    try:
+                        status, idx, content = result_queue.get(timeout=self.poll_interval)
+                    except queue.Empty:
+                        # a killed worker (e.g. OOM or segfault) never reports its chunk
+                        for worker_idx, worker in enumerate(workers):
+                            if worker.exitcode not in [None, 0]:
+                                raise RuntimeError(
+                                    f"Worker {worker_idx} exited with code {worker.exitcode} before all chunks finished."
+                                )
+                        if all(not worker.is_alive() for worker in workers):
+                            raise RuntimeError("All workers exited before all chunks finished.")
+                        continue
+                    if status == "error":
+                        raise RuntimeError(f"Worker {idx} failed:\n{content}")
+                    chunk_results[idx] = content
+                    pbar.update(1)
+        finally:
+            for worker in workers:
+                if worker.is_alive() and len(chunk_results) < len(chunks):
+                    worker.terminate()
+                worker.join()
+
+        data = [Item(item_dict) for chunk_idx in range(len(chunks)) for item_dict in chunk_results[chunk_idx]]
+        dataset = Dataset(config=self.config, data=data)
+
+        if do_eval:
+            eval_result = self.evaluator.evaluate(dataset)
+            print(eval_result)
+        return dataset
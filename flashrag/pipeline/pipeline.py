@@ -1,7 +1,32 @@
+import os
+import copy
+import json
+import math
+from tqdm import tqdm
 from flashrag.evaluator import Evaluator
-from flashrag.dataset.utils import split_dataset, merge_dataset
+from flashrag.dataset import Dataset, Item, DatasetWriter
+from flashrag.dataset.utils import split_dataset, merge_dataset, get_batch_dataset, merge_batch_dataset
 from flashrag.utils import get_retriever, get_generator, get_refiner, get_judger
 from flashrag.prompt import PromptTemplate
+from flashrag.pipeline.utils import GenerationBatcher, use_generator, run_branches
+
+
+def _truncate_partial_line(file_path, block_size=1 << 16):
+    """Cut a line left unfinished by a crash at the end of a jsonl file, so appended records start on a new line."""
+    with open(file_path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - block_size)
+            f.seek(start)
+            block = f.read(pos - start)
+            newline_pos = block.rfind(b"\n")
+            if newline_pos != -1:
+                pos = start + newline_pos + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
 
 
 class BasicPipeline:
@@ -15,6 +40,10 @@ class BasicPipeline:
         self.retriever = None
         self.evaluator = Evaluator(config)
         self.save_retrieval_cache = config["save_retrieval_cache"]
+        # print diagnostics of the run (e.g. prefix sharing of prompts)
+        self.verbose = config["pipeline_verbose"] if "pipeline_verbose" in config else False
+        # set during `run_with_checkpoint`, modules should not be released after a chunk
+        self.chunked_run = False
         if prompt_template is None:
             prompt_template = PromptTemplate(config)
         self.prompt_template = prompt_template
@@ -23,6 +52,78 @@ class BasicPipeline:
         """The overall inference process of a RAG framework."""
         pass
 
+    def run_with_checkpoint(self, dataset, do_eval=True, pred_process_fun=None, chunk_size=None, resume_dir=None, **params):
+        """Run the pipeline chunk by chunk and append the results of each finished chunk to
+        `checkpoint.jsonl` in save dir, so a crashed run can be resumed.
+
+        Args:
+            chunk_size: number of items per chunk, default to `checkpoint_chunk_size` in config.
+            resume_dir: save dir of a previous run, items found in its checkpoint are not run again.
+                Default to `resume_dir` in config.
+            params: other arguments passed to `run` of each chunk.
+        """
+        if chunk_size is None:
+            chunk_size = self.config["checkpoint_chunk_size"] if "checkpoint_chunk_size" in self.config else None
+        if chunk_size is None:
+            chunk_size = 100
+        if resume_dir is None:
+            resume_dir = self.config["resume_dir"] if "resume_dir" in self.config else None
+
+        checkpoint_path = os.path.join(self.config["save_dir"], "checkpoint.jsonl")
+        # index in dataset -> item dict of finished items
+        finished_items = {}
+        if resume_dir is not None:
+            resume_path = os.path.join(resume_dir, "checkpoint.jsonl")
+            if os.path.exists(resume_path):
+                with open(resume_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # the last line may be cut by a crash
+                            continue
+                        idx = record["index"]
+                        if idx < len(dataset) and record["id"] == dataset[idx].id:
+                            finished_items[idx] = record["item"]
+                print(f"Resume {len(finished_items)} finished items from {resume_path}")
+
+        remain_idxs = [idx for idx in range(len(dataset)) if idx not in finished_items]
+        remain_dataset = Dataset(config=dataset.config, data=[dataset[idx] for idx in remain_idxs]) if remain_idxs else None
+
+        if pred_process_fun is not None:
+            params["pred_process_fun"] = pred_process_fun
+        same_dir = resume_dir is not None and os.path.abspath(resume_dir) == os.path.abspath(self.config["save_dir"])
+        if same_dir and os.path.exists(checkpoint_path):
+            _truncate_partial_line(checkpoint_path)
+        # resuming in place appends to the old checkpoint, otherwise the new one starts with the finished items
+        with open(checkpoint_path, "a" if same_dir else "w", encoding="utf-8") as f:
+            if not same_dir:
+                for idx in sorted(finished_items):
+                    f.write(json.dumps({"index": idx, "id": dataset[idx].id, "item": finished_items[idx]}, ensure_ascii=False) + "\n")
+            self.chunked_run = True
+            try:
+                offset = 0
+                for chunk in get_batch_dataset(remain_dataset, batch_size=chunk_size) if remain_dataset is not None else []:
+                    chunk = self.run(chunk, do_eval=False, **params)
+                    for item in chunk:
+                        idx = remain_idxs[offset]
+                        offset += 1
+                        f.write(json.dumps({"index": idx, "id": item.id, "item": item.to_dict()}, ensure_ascii=False) + "\n")
+                        finished_items[idx] = item
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                self.chunked_run = False
+
+        data = [
+            finished_items[idx] if isinstance(finished_items[idx], Item) else Item(finished_items[idx])
+            for idx in range(len(dataset))
+        ]
+        dataset = Dataset(config=dataset.config, data=data)
+        # predictions are already processed in each chunk
+        dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=None)
+        return dataset
+
     def evaluate(self, dataset, do_eval=True, pred_process_fun=None):
         """The evaluation process after finishing overall generation"""
 
@@ -30,12 +131,14 @@ class BasicPipeline:
             dataset = pred_process_fun(dataset)
 
         if do_eval:
+            # metrics like llm_judge can reuse the loaded generator
+            self.evaluator.set_generator(getattr(self, "generator", None))
             # evaluate & save result
             eval_result = self.evaluator.evaluate(dataset)
             print(eval_result)
 
-        # save retrieval cache
-        if self.save_retrieval_cache:
+        # save retrieval cache, once after the last chunk of a chunked run
+        if self.save_retrieval_cache and not self.chunked_run:
             self.retriever._save_cache()
 
         return dataset
@@ -79,11 +182,13 @@ class SequentialPipeline(BasicPipeline):
         dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
         return dataset
 
-    def run(self, dataset, do_eval=True, pred_process_fun=None):
+    def retrieve(self, dataset):
         input_query = dataset.question
         retrieval_results = self.retriever.batch_search(input_query)
         dataset.update_output("retrieval_result", retrieval_results)
+        return dataset
 
+    def build_prompts(self, dataset):
         if self.refiner:
             input_prompt_flag = self.refiner.input_prompt_flag
             if "llmlingua" in self.refiner.name and input_prompt_flag:
@@ -118,17 +223,135 @@ class SequentialPipeline(BasicPipeline):
                 docs = item.retrieval_result
                 input_prompts.append([q + " " + doc['contents'] for doc in docs])
         dataset.update_output("prompt", input_prompts)
+        return dataset
+
+    def generate(self, dataset):
+        pred_answer_list = self.generator.generate(dataset.prompt)
+        dataset.update_output("pred", pred_answer_list)
+        return dataset
+
+    def run(self, dataset, do_eval=True, pred_process_fun=None):
+        dataset = self.retrieve(dataset)
+        dataset = self.build_prompts(dataset)
 
         # delete used refiner to release memory
-        if self.refiner:
+        if self.refiner and not self.chunked_run:
             del self.refiner
-        pred_answer_list = self.generator.generate(input_prompts)
-        dataset.update_output("pred", pred_answer_list)
+        dataset = self.generate(dataset)
 
         dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
 
         return dataset
 
+    def run_streaming(self, dataset, do_eval=True, pred_process_fun=None, chunk_size=None, queue_size=2):
+        """Run the pipeline chunk by chunk with overlapped stages.
+
+        Retrieval, refinement (prompt building) and generation run in separate threads connected by bounded
+        queues, so retrieval of chunk i+1, refinement of chunk i and generation of chunk i-1 happen at the
+        same time. Finished chunks are appended to `stream_output.jsonl` in the save dir in dataset order.
+
+        `dataset` can also be the path of a data file, it is then read chunk by chunk with `Dataset.iter_chunks`
+        (sampled with `test_sample_num` and `random_sample` in config) instead of being loaded at once.
+        """
+        import queue
+        import threading
+
+        if chunk_size is None:
+            chunk_size = self.config["pipeline_chunk_size"] if "pipeline_chunk_size" in self.config else None
+        if chunk_size is None:
+            chunk_size = 256
+
+        if isinstance(dataset, str):
+            sample_num = self.config["test_sample_num"] if "test_sample_num" in self.config else None
+            random_sample = self.config["random_sample"] if "random_sample" in self.config else False
+            input_chunks = Dataset.iter_chunks(
+                self.config, dataset, chunk_size, sample_num=sample_num, random_sample=random_sample
+            )
+            num_chunks = None
+        else:
+            input_chunks = get_batch_dataset(dataset, batch_size=chunk_size)
+            num_chunks = math.ceil(len(dataset) / chunk_size)
+
+        # set when the consumer stops (finished or failed), the stage threads then exit instead of blocking
+        stop_event = threading.Event()
+        end_signal = object()
+
+        def put_until_stop(output_queue, value):
+            while not stop_event.is_set():
+                try:
+                    output_queue.put(value, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run_stage(stage_func, input_iter, output_queue):
+            try:
+                for chunk in input_iter:
+                    if stop_event.is_set() or not put_until_stop(output_queue, stage_func(chunk)):
+                        return
+                put_until_stop(output_queue, end_signal)
+            except BaseException as e:
+                # raised again by the consumer of the queue
+                put_until_stop(output_queue, e)
+
+        def iter_queue(input_queue):
+            while True:
+                try:
+                    chunk = input_queue.get(timeout=0.1)
+                except queue.Empty:
+                    if stop_event.is_set():
+                        return
+                    continue
+                if chunk is end_signal:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+
+        retrieved_queue = queue.Queue(maxsize=queue_size)
+        prompt_queue = queue.Queue(maxsize=queue_size)
+        threads = [
+            threading.Thread(
+                target=run_stage,
+                args=(self.retrieve, input_chunks, retrieved_queue),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=run_stage, args=(self.build_prompts, iter_queue(retrieved_queue), prompt_queue), daemon=True
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        save_flag = self.config["save_intermediate_data"] and not self.config["disable_save"]
+        stream_path = os.path.join(self.config["save_dir"], "stream_output.jsonl")
+        writer = DatasetWriter(stream_path) if save_flag else None
+        finished_chunks = []
+        try:
+            for chunk in tqdm(iter_queue(prompt_queue), total=num_chunks, desc="Streaming: "):
+                chunk = self.generate(chunk)
+                finished_chunks.append(chunk)
+                if writer is not None:
+                    writer.write(chunk)
+        finally:
+            stop_event.set()
+            # free blocked producers and wait for them, also when the consumer raised
+            for stage_queue in [retrieved_queue, prompt_queue]:
+                while True:
+                    try:
+                        stage_queue.get_nowait()
+                    except queue.Empty:
+                        break
+            for thread in threads:
+                thread.join()
+            if writer is not None:
+                writer.close()
+
+        dataset = merge_batch_dataset(finished_chunks)
+        dataset = self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
+        return dataset
+
 
 class ConditionalPipeline(BasicPipeline):
     def __init__(self, config, prompt_template=None, retriever=None, generator=None):
@@ -141,9 +364,9 @@ class ConditionalPipeline(BasicPipeline):
 
         self.judger = get_judger(config)
         if generator is None:
-            self.generator = get_generator(config)
+            generator = get_generator(config)
         if retriever is None:
-            self.retriever = get_retriever(config)
+            retriever = get_retriever(config)
         self.generator = generator
         self.retriever = retriever
 
@@ -157,6 +380,9 @@ class ConditionalPipeline(BasicPipeline):
                             Only give me the answer and do not output any other words.",
             user_prompt="Question: {question}",
         )
+        # naive branch shares the modules of the sequential pipeline, only the prompt is different
+        self.naive_pipeline = copy.copy(self.sequential_pipeline)
+        self.naive_pipeline.prompt_template = self.zero_shot_templete
 
     def run(self, dataset, do_eval=True, pred_process_fun=None):
         # judge_result: list of bool element, representing whether to use retrieval
@@ -165,11 +391,16 @@ class ConditionalPipeline(BasicPipeline):
 
         # split dataset based on judge_result
         dataset_split = split_dataset(dataset, judge_result)
-        pos_dataset, neg_dataset = dataset_split[True], dataset_split[False]
 
-        pos_dataset = self.sequential_pipeline.run(pos_dataset, do_eval=False)
-        self.sequential_pipeline.prompt_template = self.zero_shot_templete
-        neg_dataset = self.sequential_pipeline.naive_run(neg_dataset, do_eval=False)
+        # run both branches concurrently, their generation requests are merged into shared batches
+        branch_funcs = []
+        if True in dataset_split:
+            branch_funcs.append(lambda: self.sequential_pipeline.run(dataset_split[True], do_eval=False))
+        if False in dataset_split:
+            branch_funcs.append(lambda: self.naive_pipeline.naive_run(dataset_split[False], do_eval=False))
+        batcher = GenerationBatcher(self.generator)
+        with use_generator([self.sequential_pipeline, self.naive_pipeline], batcher):
+            run_branches(batcher, branch_funcs)
 
         # merge datasets into original format
         dataset = merge_dataset(dataset_split, judge_result)
@@ -205,14 +436,14 @@ class AdaptivePipeline(BasicPipeline):
         from flashrag.pipeline import IRCOTPipeline
 
         if norag_template is None:
-            norag_templete = PromptTemplate(
+            norag_template = PromptTemplate(
                 config=config,
                 system_prompt="Answer the question based on your own knowledge. Only give me the answer and do not output any other words.",
                 user_prompt="Question: {question}",
             )
         self.norag_pipeline = SequentialPipeline(
             config,
-            prompt_template=norag_templete,
+            prompt_template=norag_template,
             retriever=retriever,
             generator=generator,
         )
@@ -235,15 +466,22 @@ class AdaptivePipeline(BasicPipeline):
 
         # split dataset based on judge_result
         dataset_split = split_dataset(dataset, judge_result)
+        symbol2run_func = {
+            "A": self.norag_pipeline.naive_run,
+            "B": self.single_hop_pipeline.run,
+            "C": self.multi_hop_pipeline.run,
+        }
+        branch_funcs = []
         for symbol, symbol_dataset in dataset_split.items():
-            if symbol == "A":
-                symbol_dataset = self.norag_pipeline.naive_run(symbol_dataset, do_eval=False)
-            elif symbol == "B":
-                symbol_dataset = self.single_hop_pipeline.run(symbol_dataset, do_eval=False)
-            elif symbol == "C":
-                symbol_dataset = self.multi_hop_pipeline.run(symbol_dataset, do_eval=False)
-            else:
-                assert False, "Unknown symbol!"
+            assert symbol in symbol2run_func, "Unknown symbol!"
+            branch_funcs.append(
+                lambda run_func=symbol2run_func[symbol], symbol_dataset=symbol_dataset: run_func(symbol_dataset, do_eval=False)
+            )
+
+        # run all branches concurrently, their generation requests are merged into shared batches
+        batcher = GenerationBatcher(self.generator)
+        with use_generator([self.norag_pipeline, self.single_hop_pipeline, self.multi_hop_pipeline], batcher):
+            run_branches(batcher, branch_funcs)
 
         # merge datasets into original format
         dataset = merge_dataset(dataset_split, judge_result)
@@ -85,6 +85,8 @@ class REPLUG_Generation(GenerationMixin):
                 model_kwargs["encoder_outputs"].get("hidden_states") if output_hidden_states else None
             )
 
+        replug_processor = next((p for p in logits_processor if isinstance(p, REPLUGLogitsProcessor)), None)
+
         # keep track of which sequences are already finished
         unfinished_sequences = torch.ones(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
 
@@ -142,8 +144,12 @@ class REPLUG_Generation(GenerationMixin):
             # Sample from the normalized "logits", assuming the REPLUG processor was used!
             probs = nn.functional.softmax(next_token_scores, dim=-1)
             next_tokens = torch.multinomial(probs, num_samples=1).squeeze(-1)
-            # Lock same next-token for all examples in batch
-            next_tokens[:] = next_tokens[0]
+            if replug_processor is not None:
+                # Lock same next-token for all docs of the same question
+                next_tokens = next_tokens[replug_processor.group_first_rows.to(next_tokens.device)]
+            else:
+                # Lock same next-token for all examples in batch
+                next_tokens[:] = next_tokens[0]
 
             # finished sentences should have their next token be a padding token
             if eos_token_id is not None:
@@ -205,21 +211,39 @@ class REPLUGLogitsProcessor(LogitsProcessor):
     """
     Merge logits of different docs in one batch.
 
+    The batch may contain the docs of several questions, `group_ids` gives the question (group) of each row.
+    Doc scores are normalized within each group and the logits are mixed per group, every row receives
+    the mixed logits of its group. Without `group_ids`, the whole batch is one group.
+
     Reference: fastRAG
     """
 
-    def __init__(self, doc_scores: torch.FloatTensor):
+    def __init__(self, doc_scores: torch.FloatTensor, group_ids: Optional[torch.LongTensor] = None):
         self.num_docs = doc_scores.shape[0]
-        # normalize
-        doc_scores /= doc_scores.sum()
+        if group_ids is None:
+            group_ids = torch.zeros(self.num_docs, dtype=torch.long, device=doc_scores.device)
+        group_ids = group_ids.to(doc_scores.device)
+        self.num_groups = int(group_ids.max().item()) + 1
+        self.group_ids = group_ids
+        # normalize within each group
+        group_sums = torch.zeros(self.num_groups, dtype=doc_scores.dtype, device=doc_scores.device)
+        group_sums.index_add_(0, group_ids, doc_scores)
+        doc_scores = doc_scores / group_sums[group_ids]
         self.doc_scores = torch.unsqueeze(doc_scores, 1)  # k*1
+        # first row of the group of each row, used to lock the sampled token within a group
+        first_rows = torch.full((self.num_groups,), self.num_docs, dtype=torch.long, device=doc_scores.device)
+        first_rows.scatter_reduce_(0, group_ids, torch.arange(self.num_docs, device=doc_scores.device), reduce="amin")
+        self.group_first_rows = first_rows[group_ids]
 
     def __call__(self, input_ids, scores):
         # doc_score: k*1, scores: k*vocab_size
-        replug_scores = self.doc_scores * scores
-        replug_scores = replug_scores.sum(dim=0)  # 1*vocab_size
-        replug_scores = torch.tile(replug_scores, (self.num_docs, 1))  # k*vocab_size
-        return replug_scores
+        if self.doc_scores.device != scores.device:
+            self.doc_scores = self.doc_scores.to(scores.device)
+            self.group_ids = self.group_ids.to(scores.device)
+        replug_scores = (self.doc_scores * scores).to(scores.dtype)
+        group_scores = torch.zeros((self.num_groups, scores.shape[-1]), dtype=scores.dtype, device=scores.device)
+        group_scores.index_add_(0, self.group_ids, replug_scores)  # num_groups*vocab_size
+        return group_scores[self.group_ids]  # k*vocab_size
 
 
 def load_replug_model(name_or_path):
@@ -0,0 +1,264 @@
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+
+class GenerationBatcher:
+    """A generator proxy shared by pipeline branches running in different threads.
+
+    Each branch calls `generate` as usual, the call blocks until every active branch is waiting for
+    generation (or has finished). Then all pending requests with the same generation params are merged
+    into one call of the wrapped generator, so the LLM sees one large mixed batch, and the outputs are
+    split back to each branch. Other attributes (e.g. tokenizer) are taken from the wrapped generator.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+        self._cond = threading.Condition()
+        self._num_branches = 0
+        self._pending = []
+        # number of requests and number of actual generator calls
+        self.num_requests = 0
+        self.num_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+    def add_branches(self, num_branches):
+        with self._cond:
+            self._num_branches += num_branches
+
+    def finish_branch(self):
+        with self._cond:
+            self._num_branches -= 1
+            self._flush_if_ready()
+
+    def generate(self, input_list, **params):
+        if isinstance(input_list, str):
+            input_list = [input_list]
+        if self._num_branches == 0 or len(input_list) == 0:
+            # not called from a branch
+            return self.generator.generate(input_list, **params)
+        request = {"inputs": list(input_list), "params": params, "done": False, "result": None, "error": None}
+        with self._cond:
+            self._pending.append(request)
+            self._flush_if_ready()
+            while not request["done"]:
+                self._cond.wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def _flush_if_ready(self):
+        # called with the lock held, run only when no active branch can add more requests
+        if len(self._pending) == 0 or len(self._pending) < self._num_branches:
+            return
+        pending, self._pending = self._pending, []
+        groups = {}
+        for request in pending:
+            group_key = (type(request["inputs"][0]).__name__, repr(sorted(request["params"].items())))
+            groups.setdefault(group_key, []).append(request)
+
+        for group in groups.values():
+            all_inputs = [input for request in group for input in request["inputs"]]
+            try:
+                outputs = self.generator.generate(all_inputs, **group[0]["params"])
+                start = 0
+                for request in group:
+                    end = start + len(request["inputs"])
+                    request["result"] = self._slice_outputs(outputs, start, end)
+                    start = end
+            except Exception as e:
+                for request in group:
+                    request["error"] = e
+            for request in group:
+                request["done"] = True
+            self.num_calls += 1
+        self.num_requests += len(pending)
+        self._cond.notify_all()
+
+    @classmethod
+    def _slice_outputs(cls, outputs, start, end):
+        if isinstance(outputs, tuple):
+            return tuple(cls._slice_outputs(output, start, end) for output in outputs)
+        if isinstance(outputs, dict):
+            return {key: cls._slice_outputs(value, start, end) for key, value in outputs.items()}
+        return outputs[start:end]
+
+
+@contextmanager
+def use_generator(pipelines, generator):
+    """Temporarily replace the generator of the given pipelines."""
+    original_generators = [pipeline.generator for pipeline in pipelines]
+    for pipeline in pipelines:
+        pipeline.generator = generator
+    try:
+        yield generator
+    finally:
+        for pipeline, original_generator in zip(pipelines, original_generators):
+            pipeline.generator = original_generator
+
+
+def run_branches(batcher, branch_funcs):
+    """Run branch functions concurrently in threads, with generation batched by `batcher`.
+
+    Returns the results of the branches in the given order, the first error of a branch is raised.
+    """
+    results = [None] * len(branch_funcs)
+    errors = []
+    # register all branches before starting, so the first request waits for the others
+    batcher.add_branches(len(branch_funcs))
+
+    def run_branch(idx, branch_func):
+        try:
+            results[idx] = branch_func()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            batcher.finish_branch()
+
+    threads = [threading.Thread(target=run_branch, args=(idx, func)) for idx, func in enumerate(branch_funcs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class RetrievalSession:
+    """Retrieval state shared by the rounds of an iterative pipeline.
+
+    Results are cached by query, so a query issued again (by another item or in a later round) does not
+    call the retriever. The docs retrieved for each item are kept as integer id / score arrays and merged
+    with NumPy (max score of duplicated docs, first-retrieved order), docs are stored once in a shared pool.
+    """
+
+    def __init__(self, retriever, num_items):
+        self.retriever = retriever
+        self.query_cache = {}
+        # doc id in corpus -> int id, int id -> doc
+        self.doc_key2int = {}
+        self.doc_pool = []
+        self.item_doc_ids = [np.empty(0, dtype=np.int64) for _ in range(num_items)]
+        self.item_doc_scores = [np.empty(0, dtype=np.float64) for _ in range(num_items)]
+        self.num_queries = 0
+        self.num_searched_queries = 0
+        self.num_search_calls = 0
+
+    def search(self, queries):
+        """Batch search with the query cache, returns the docs and scores of each query."""
+        new_queries = list(dict.fromkeys(query for query in queries if query not in self.query_cache))
+        if len(new_queries) > 0:
+            retrieval_results, scores = self.retriever.batch_search(new_queries, return_score=True)
+            for query, retrieval_result, query_scores in zip(new_queries, retrieval_results, scores):
+                self.query_cache[query] = (retrieval_result, query_scores)
+            self.num_search_calls += 1
+        self.num_queries += len(queries)
+        self.num_searched_queries += len(new_queries)
+        return [self.query_cache[query][0] for query in queries], [self.query_cache[query][1] for query in queries]
+
+    def add(self, item_idx, retrieval_result, scores):
+        """Merge docs into the pool of an item, a doc retrieved again keeps its max score."""
+        new_ids = np.array([self._get_int_id(doc) for doc in retrieval_result], dtype=np.int64)
+        all_ids = np.concatenate([self.item_doc_ids[item_idx], new_ids])
+        all_scores = np.concatenate([self.item_doc_scores[item_idx], np.asarray(scores, dtype=np.float64).reshape(-1)])
+        unique_ids, first_idxs, inverse = np.unique(all_ids, return_index=True, return_inverse=True)
+        max_scores = np.full(len(unique_ids), -np.inf)
+        np.maximum.at(max_scores, inverse, all_scores)
+        # keep the order in which docs are first retrieved
+        order = np.argsort(first_idxs, kind="stable")
+        self.item_doc_ids[item_idx] = unique_ids[order]
+        self.item_doc_scores[item_idx] = max_scores[order]
+
+    def get_docs(self, item_idx, topk=None, ascending=False):
+        """Docs of an item sorted by score (stable for equal scores), optionally only the top-k."""
+        scores = self.item_doc_scores[item_idx]
+        order = np.argsort(-scores, kind="stable")
+        if topk is not None:
+            order = order[:topk]
+        if ascending:
+            order = order[np.argsort(scores[order], kind="stable")]
+        return [self.doc_pool[doc_id] for doc_id in self.item_doc_ids[item_idx][order]]
+
+    def stats(self):
+        return {
+            "num_queries": self.num_queries,
+            "num_searched_queries": self.num_searched_queries,
+            "num_avoided_queries": self.num_queries - self.num_searched_queries,
+            "num_search_calls": self.num_search_calls,
+        }
+
+    def _get_int_id(self, doc):
+        doc_key = doc["id"] if "id" in doc else doc["contents"]
+        if doc_key not in self.doc_key2int:
+            self.doc_key2int[doc_key] = len(self.doc_pool)
+            self.doc_pool.append(doc)
+        return self.doc_key2int[doc_key]
+
+
+class PrefixGrouper:
+    """Submit prompts sharing a prefix next to each other, so the generator can reuse their KV cache
+    (e.g. vllm automatic prefix caching with `enable_prefix_caching`).
+
+    Prompts are sorted lexicographically, which puts the prompts with the longest common prefix side by
+    side. With `verbose`, the prefix-hit ratio is measured: the characters (or token ids, for tokenized
+    prompts) of each prompt shared with the previous one.
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.num_prompts = 0
+        self.prompt_length = 0
+        self.prefix_hit_length = 0
+
+    def _count(self, prompts):
+        for prev, curr in zip([prompts[0][:0]] + prompts[:-1], prompts):
+            self.prefix_hit_length += len(os.path.commonprefix([prev, curr]))
+            self.prompt_length += len(curr)
+        self.num_prompts += len(prompts)
+
+    def group(self, prompts):
+        """Return the submission order of the prompts."""
+        order = sorted(range(len(prompts)), key=lambda idx: prompts[idx])
+        if self.verbose and len(prompts) > 0:
+            self._count([prompts[idx] for idx in order])
+        return order
+
+    def measure(self, prompts):
+        """Only update the report with prompts submitted in the given order (if `verbose`)."""
+        if self.verbose and len(prompts) > 0:
+            self._count(list(prompts))
+
+    def generate(self, generator, prompts, **params):
+        """Generate in prefix-grouped order and return the outputs in the original order."""
+        if len(prompts) == 0:
+            return generator.generate(prompts, **params)
+        order = self.group(prompts)
+        outputs = generator.generate([prompts[idx] for idx in order], **params)
+        return self._restore_order(outputs, order)
+
+    @classmethod
+    def _restore_order(cls, outputs, order):
+        if isinstance(outputs, tuple):
+            return tuple(cls._restore_order(output, order) for output in outputs)
+        if isinstance(outputs, dict):
+            return {key: cls._restore_order(value, order) for key, value in outputs.items()}
+        restored = [None] * len(order)
+        for output, idx in zip(outputs, order):
+            restored[idx] = output
+        return restored
+
+    def report(self):
+        """Prefix sharing of the measured prompts, empty unless `verbose`."""
+        return {
+            "num_prompts": self.num_prompts,
+            "prompt_length": self.prompt_length,
+            "prefix_hit_length": self.prefix_hit_length,
+            "prefix_hit_ratio": self.prefix_hit_length / max(self.prompt_length, 1),
+        }
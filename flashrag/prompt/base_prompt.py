@@ -1,6 +1,7 @@
 from transformers import AutoTokenizer, AutoConfig
 import tiktoken
 import warnings
+from flashrag.utils.token_counter import get_token_counter
 
 class PromptTemplate:
     placeholders = ["reference", "question"]
@@ -56,22 +57,22 @@ class PromptTemplate:
             if not flag and holder != "reference":
                 assert False
 
-    def truncate_prompt(self, prompt):
+    def truncate_prompt(self, prompt, return_token_ids=False):
         if self.is_openai:
             truncated_messages = []
             total_tokens = 0
             assert isinstance(prompt, list)
-            for message in prompt:
-                role_content = message['content']
-                encoded_message = self.tokenizer.encode(role_content)
-
-                if total_tokens + len(encoded_message) <= self.max_input_len:
+            # memoized batch count, only an overflowing message is encoded for truncation
+            message_lengths = get_token_counter(self.tokenizer).count_batch([message['content'] for message in prompt])
+            for message, message_length in zip(prompt, message_lengths):
+                if total_tokens + message_length <= self.max_input_len:
                     truncated_messages.append(message)
-                    total_tokens += len(encoded_message)
+                    total_tokens += message_length
                 else:
-                    print(f"The input text length is greater than the maximum length ({total_tokens + len(encoded_message)} > {self.max_input_len}) and has been truncated!")
+                    print(f"The input text length is greater than the maximum length ({total_tokens + message_length} > {self.max_input_len}) and has been truncated!")
                     remaining_tokens = self.max_input_len - total_tokens
-                    truncated_message = self.encoding.decode(encoded_message[:remaining_tokens])
+                    encoded_message = self.tokenizer.encode(message['content'], disallowed_special=())
+                    truncated_message = self.tokenizer.decode(encoded_message[:remaining_tokens])
                     message['content'] = truncated_message
                     truncated_messages.append(message)
                     break
@@ -82,34 +83,57 @@ class PromptTemplate:
             if self.tokenizer is None:
                 self.tokenizer = AutoTokenizer.from_pretrained(self.generator_path, trust_remote_code=True)
             assert isinstance(prompt, str)
-            tokenized_prompt = self.tokenizer(prompt, truncation=False, return_tensors="pt").input_ids[0]
-
-            if len(tokenized_prompt) > self.max_input_len:
-                print(f"The input text length is greater than the maximum length ({len(tokenized_prompt)} > {self.max_input_len}) and has been truncated!")
+            if not return_token_ids and self._count_prompt_tokens([prompt])[0] <= self.max_input_len:
+                # counts are memoized and shared, a prompt within the budget is not encoded again
+                return prompt
+            # plain list of ids, no tensor is needed to measure the prompt
+            token_ids = self.tokenizer.encode(prompt)
+
+            if len(token_ids) > self.max_input_len:
+                print(f"The input text length is greater than the maximum length ({len(token_ids)} > {self.max_input_len}) and has been truncated!")
                 half = int(self.max_input_len / 2)
-                prompt = self.tokenizer.decode(tokenized_prompt[:half], skip_special_tokens=True) + \
-                        self.tokenizer.decode(tokenized_prompt[-half:], skip_special_tokens=True)
+                if return_token_ids:
+                    # keep the ids directly, avoid the decode / re-encode round trip
+                    return token_ids[:half] + token_ids[-half:]
+                prompt = self.tokenizer.decode(token_ids[:half], skip_special_tokens=True) + \
+                        self.tokenizer.decode(token_ids[-half:], skip_special_tokens=True)
+            if return_token_ids:
+                return token_ids
             return prompt
 
-
-
-    def get_string(self, question=None, retrieval_result=None, formatted_reference=None, previous_gen=None, messages=None, **params):
+    def _count_prompt_tokens(self, prompts, tokenizer=None):
+        """Encoded lengths of prompts. Texts are counted by the shared counter without special tokens
+        (the same counter `CountToken` uses for this tokenizer), the special tokens added on encoding are added back."""
+        if tokenizer is None:
+            tokenizer = self.tokenizer
+        token_counts = get_token_counter(tokenizer).count_batch(prompts)
+        num_special_tokens = tokenizer.num_special_tokens_to_add() if hasattr(tokenizer, "num_special_tokens_to_add") else 0
+        return [token_count + num_special_tokens for token_count in token_counts]
+
+    def get_string(self, question=None, retrieval_result=None, formatted_reference=None, previous_gen=None, messages=None, return_token_ids=False, **params):
+        """Build the input of the generator.
+
+        If `return_token_ids` is True, the token ids of the (truncated) prompt are returned instead of the
+        string, which can be passed to `HFCausalLMGenerator` / `VLLMGenerator` without tokenizing again
+        (not supported for openai models).
+        """
+        assert not (return_token_ids and self.is_openai), "Token ids are not supported for openai models."
         if messages is not None:
             if isinstance(messages, str):
-                return self.truncate_prompt(messages)
+                return self.truncate_prompt(messages, return_token_ids=return_token_ids)
             if self.is_chat and self.enable_chat:
                 if self.is_openai:
-                    self.truncate_prompt(messages)
+                    return self.truncate_prompt(messages)
                 else:
                     prompt = self.tokenizer.apply_chat_template(
                         messages, tokenize=False, add_generation_prompt=True
                     )
-                    return self.truncate_prompt(prompt)
+                    return self.truncate_prompt(prompt, return_token_ids=return_token_ids)
             else:
                 prompt = "\n\n".join(
                     [message['content'] for message in messages if message['content']]
                 )
-                return self.truncate_prompt(prompt)
+                return self.truncate_prompt(prompt, return_token_ids=return_token_ids)
 
         if formatted_reference is None:
             if retrieval_result is not None:
@@ -137,7 +161,7 @@ class PromptTemplate:
         if previous_gen is not None and previous_gen not in ["", " "] and self.is_openai is False:
             input += previous_gen
 
-        return self.truncate_prompt(input)
+        return self.truncate_prompt(input, return_token_ids=return_token_ids)
 
     def get_string_with_varying_examplars(
         self,
@@ -148,46 +172,60 @@ class PromptTemplate:
         examplars=[],
         tokenizer=None,
         max_length=2048,
+        return_token_ids=False,
         **params,
     ):
         """
-        Select the maximum number of examplars that can be placed in the prompt
-        """
+        Select the maximum number of examplars that can be placed in the prompt.
 
-        final_examplars = None
-        num = len(examplars)
-        while len(examplars) > 0:
-            for num in range(len(examplars), 0, -1):
-                possible_prompt = self.get_string(
-                    question=question,
-                    retrieval_result=retrieval_result,
-                    formatted_reference=formatted_reference,
-                    previous_gen=previous_gen,
-                    examplars="\n\n".join(examplars[:num]),
-                    **params,
-                )
-
-                possible_prompt_tokens = tokenizer.encode(possible_prompt)
-                if len(possible_prompt_tokens) <= max_length:
-                    final_examplars = examplars[:num]
+        Examplars are packed in token space: the prompt without examplars is measured once, the token counts
+        of the examplars come from the shared token counter, and the largest window of examplars that fits in `max_length` is selected
+        greedily (dropping leading examplars first). Only the selected prompt is rendered and checked again.
+        """
+        if tokenizer is None:
+            tokenizer = self.tokenizer
+        examplar_sep = "\n\n"
+
+        def render(selected_examplars, return_token_ids=False):
+            return self.get_string(
+                question=question,
+                retrieval_result=retrieval_result,
+                formatted_reference=formatted_reference,
+                previous_gen=previous_gen,
+                examplars=examplar_sep.join(selected_examplars),
+                return_token_ids=return_token_ids,
+                **params,
+            )
+
+        if formatted_reference is None and retrieval_result is not None:
+            # format the reference once instead of in every rendering
+            formatted_reference = self.format_reference(retrieval_result)
+            retrieval_result = None
+
+        segment_counter = get_token_counter(tokenizer)
+        base_length = self._count_prompt_tokens([render([])], tokenizer)[0]
+        sep_length = segment_counter.count(examplar_sep)
+        examplar_lengths = [length + sep_length for length in segment_counter.count_batch(examplars)]
+
+        final_examplars = []
+        start = 0
+        while start < len(examplars):
+            # largest window starting at `start` whose estimated length fits the budget
+            total_length, num = base_length - sep_length, 0
+            for examplar_length in examplar_lengths[start:]:
+                if total_length + examplar_length > max_length:
                     break
-            if final_examplars is None:
-                examplars = examplars[1:]
-            else:
+                total_length += examplar_length
+                num += 1
+            # token counts are not exactly additive at segment boundaries, check the real length
+            while num > 0 and self._count_prompt_tokens([render(examplars[start : start + num])], tokenizer)[0] > max_length:
+                num -= 1
+            if num > 0:
+                final_examplars = examplars[start : start + num]
                 break
-        if final_examplars is None:
-            final_examplars = []
-
-        final_prompt = self.get_string(
-            question=question,
-            retrieval_result=retrieval_result,
-            formatted_reference=formatted_reference,
-            previous_gen=previous_gen,
-            examplars="\n\n".join(final_examplars[:num]),
-            **params,
-        )
-
-        return final_prompt
+            start += 1
+
+        return render(final_examplars, return_token_ids=return_token_ids)
 
     def format_reference(self, retrieval_result):
         format_reference = ""
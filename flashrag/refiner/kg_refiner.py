@@ -69,6 +69,7 @@ class KGTraceRefiner(BaseRefiner):
                 pooling_method="mean",
                 max_length=256,
                 use_fp16=True,
+                device=config["device"],
             )
         else:
             self.encoder = self.retriever.encoder
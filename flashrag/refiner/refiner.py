@@ -154,7 +154,8 @@ class ExtractiveRefiner(BaseRefiner):
             model_path=self.model_path, 
             pooling_method=self.pooling_method, 
             max_length=self.encode_max_length, 
-            use_fp16=True
+            use_fp16=True,
+            device=self.device,
         )
 
     def batch_run(self, dataset, batch_size=16):
@@ -220,7 +221,7 @@ class AbstractiveRecompRefiner(BaseRefiner):
         # load model
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
         self.model = AutoModelForSeq2SeqLM.from_pretrained(self.model_path)
-        self.model.cuda()
+        self.model.to(self.device)
         self.model.eval()
 
     def batch_run(self, dataset, batch_size=2):
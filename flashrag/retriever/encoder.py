@@ -18,21 +18,23 @@ class Encoder:
         max_length (int): The maximum length of the input sequences.
         use_fp16 (bool): Whether to use FP16 precision.
         instruction (str): Additional instructions for parsing queries.
+        device (str): The device to run the model on, e.g. "cuda" or "cpu".
 
     Methods:
         encode(query_list: List[str], is_query=True) -> np.ndarray:
             Encodes a list of queries into embeddings.
     """
 
-    def __init__(self, model_name, model_path, pooling_method, max_length, use_fp16, instruction):
+    def __init__(self, model_name, model_path, pooling_method, max_length, use_fp16, instruction, device="cuda"):
         self.model_name = model_name
         self.model_path = model_path
         self.pooling_method = pooling_method
         self.max_length = max_length
         self.use_fp16 = use_fp16
         self.instruction = instruction
+        self.device = device
         self.gpu_num = torch.cuda.device_count()
-        self.model, self.tokenizer = load_model(model_path=model_path, use_fp16=use_fp16)
+        self.model, self.tokenizer = load_model(model_path=model_path, use_fp16=use_fp16, device=device)
 
     @torch.inference_mode()
     def single_batch_encode(self, query_list: Union[List[str], str], is_query=True) -> np.ndarray:
@@ -41,7 +43,7 @@ class Encoder:
         inputs = self.tokenizer(
             query_list, max_length=self.max_length, padding=True, truncation=True, return_tensors="pt"
         )
-        inputs = {k: v.cuda() for k, v in inputs.items()}
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
 
         if "T5" in type(self.model).__name__ or (isinstance(self.model, torch.nn.DataParallel) and "T5" in type(self.model.module).__name__):
             # T5-based retrieval model
@@ -90,6 +92,7 @@ class STEncoder:
         max_length (int): The maximum length of the input sequences.
         use_fp16 (bool): Whether to use FP16 precision.
         instruction (str): Additional instructions for parsing queries.
+        device (str): The device to run the model on, default to the one chosen by SentenceTransformers.
 
     Methods:
         encode(query_list: List[str], batch_size=64, is_query=True) -> np.ndarray:
@@ -98,7 +101,7 @@ class STEncoder:
             Encodes a list of queries into embeddings using multiple GPUs.
     """
 
-    def __init__(self, model_name, model_path, max_length, use_fp16, instruction):
+    def __init__(self, model_name, model_path, max_length, use_fp16, instruction, device=None):
         import torch
         from sentence_transformers import SentenceTransformer
 
@@ -108,7 +111,10 @@ class STEncoder:
         self.use_fp16 = use_fp16
         self.instruction = instruction
         self.model = SentenceTransformer(
-            model_path, trust_remote_code=True, model_kwargs={"torch_dtype": torch.float16 if use_fp16 else torch.float}
+            model_path,
+            device=device,
+            trust_remote_code=True,
+            model_kwargs={"torch_dtype": torch.float16 if use_fp16 else torch.float},
         )
 
     @torch.inference_mode()
@@ -142,10 +148,11 @@ class STEncoder:
 class ClipEncoder:
     """ClipEncoder class for encoding queries using CLIP."""
 
-    def __init__(self, model_name, model_path):
+    def __init__(self, model_name, model_path, device="cuda"):
 
         self.model_name = model_name
         self.model_path = model_path
+        self.device = device
         self.load_clip_model()
 
     def load_clip_model(self):
@@ -167,7 +174,7 @@ class ClipEncoder:
             raise NotImplementedError(f"Unsupported model type: {model_type}")
 
         self.model.eval()
-        self.model.cuda()
+        self.model.to(self.device)
 
         # set model max length for model that not specified in config.json
         if self.processor is not None and self.processor.tokenizer.model_max_length > 100000:
@@ -210,7 +217,7 @@ class ClipEncoder:
             # need handle image
             image_list = [parse_image(image) for image in image_list]
             inputs = self.processor(images=image_list, return_tensors="pt")
-            inputs = {k: v.cuda() for k, v in inputs.items()}
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
             image_emb = self.model.get_image_features(**inputs)
             image_emb = image_emb / image_emb.norm(p=2, dim=-1, keepdim=True)
             image_emb = image_emb.detach().cpu().numpy().astype(np.float32)
@@ -230,7 +237,7 @@ class ClipEncoder:
                 truncation=True,
                 return_tensors="pt",
             )
-            inputs = {k: v.cuda() for k, v in inputs.items()}
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
             text_emb = self.model.get_text_features(**inputs)
             text_emb = text_emb / text_emb.norm(p=2, dim=-1, keepdim=True)
             text_emb = text_emb.detach().cpu().numpy().astype(np.float32)
@@ -117,6 +117,7 @@ class BiReranker(BaseReranker):
             pooling_method=config["rerank_pooling_method"],
             max_length=self.max_length,
             use_fp16=config["rerank_use_fp16"],
+            device=self.device,
         )
 
     def get_rerank_scores(self, query_list, doc_list, batch_size):
@@ -133,6 +133,7 @@ class BaseRetriever:
     def update_base_setting(self):
         self.retrieval_method = self._config["retrieval_method"]
         self.topk = self._config["retrieval_topk"]
+        self.device = self._config["device"] if "device" in self._config else "cuda"
 
         self.index_path = self._config["index_path"]
         self.corpus_path = self._config["corpus_path"]
@@ -377,6 +378,7 @@ class DenseRetriever(BaseTextRetriever):
                 max_length = self.query_max_length,
                 use_fp16 = self.use_fp16,
                 instruction = self.instruction,
+                device = self.device,
             )
         else:
             self.encoder = Encoder(
@@ -386,6 +388,7 @@ class DenseRetriever(BaseTextRetriever):
                 max_length = self.query_max_length,
                 use_fp16 = self.use_fp16,
                 instruction = self.instruction,
+                device = self.device,
             )
 
     def _search(self, query: str, num: int = None, return_score=False):
@@ -458,6 +461,7 @@ class MultiModalRetriever(BaseRetriever):
         self.encoder = ClipEncoder(
             model_name=self.retrieval_method,
             model_path=config["retrieval_model_path"],
+            device=self.device,
         )
 
     def _judge_input_modal(self, query):
@@ -51,11 +51,11 @@ def convert_numpy(obj: Union[Dict, list, np.ndarray, np.generic]) -> Any:
     else:
         return obj  # Return the object as-is if it's neither a dict, list, nor numpy type
     
-def load_model(model_path: str, use_fp16: bool = False):
+def load_model(model_path: str, use_fp16: bool = False, device: str = "cuda"):
     model_config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
     model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
     model.eval()
-    model.cuda()
+    model.to(device)
     if use_fp16:
         model = model.half()
     tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, trust_remote_code=True)
@@ -1,2 +1,3 @@
 from flashrag.utils.utils import *
-from flashrag.utils.pred_parse import *
\ No newline at end of file
+from flashrag.utils.pred_parse import *
+from flashrag.utils.token_counter import *
@@ -0,0 +1,91 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+__all__ = ["TokenCounter", "get_token_counter"]
+
+
+class TokenCounter:
+    """Count tokens of texts with a tokenizer (HF tokenizer or tiktoken encoding).
+
+    Texts are encoded in batches (fast-tokenizer batch calls / tiktoken `encode_batch`), large inputs are
+    split over a thread pool. Counts are memoized by a blake2b hash of the text, so a text is encoded once
+    no matter how many prompts, templates or metrics count it. Use `get_token_counter` to share counters.
+    """
+
+    def __init__(self, tokenizer, add_special_tokens=False, batch_size=256, num_threads=4, max_cache_size=1 << 20):
+        self.tokenizer = tokenizer
+        self.is_tiktoken = hasattr(tokenizer, "encode_batch")
+        self.add_special_tokens = add_special_tokens
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.max_cache_size = max_cache_size
+        # text hash -> token count
+        self.cache = {}
+        self._lock = threading.Lock()
+        self.num_hits = 0
+        self.num_encoded = 0
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()
+
+    def _encode_lengths(self, texts: List[str]) -> List[int]:
+        if self.is_tiktoken:
+            encoded = self.tokenizer.encode_batch(texts, disallowed_special=())
+        else:
+            encoded = self.tokenizer(texts, add_special_tokens=self.add_special_tokens)["input_ids"]
+        return [len(token_ids) for token_ids in encoded]
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """Token counts of texts, only texts not seen before are encoded."""
+        keys = [self._hash(text) for text in texts]
+        with self._lock:
+            counts = [self.cache.get(key) for key in keys]
+        missing = {}
+        for key, text, count in zip(keys, texts, counts):
+            if count is None and key not in missing:
+                missing[key] = text
+        with self._lock:
+            self.num_hits += len(texts) - len(missing)
+        if len(missing) == 0:
+            return counts
+
+        missing_texts = list(missing.values())
+        batches = [missing_texts[idx : idx + self.batch_size] for idx in range(0, len(missing_texts), self.batch_size)]
+        if len(batches) > 1 and self.num_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                batch_lengths = list(executor.map(self._encode_lengths, batches))
+        else:
+            batch_lengths = [self._encode_lengths(batch) for batch in batches]
+        new_counts = dict(zip(missing.keys(), [length for lengths in batch_lengths for length in lengths]))
+        with self._lock:
+            if len(self.cache) + len(new_counts) > self.max_cache_size:
+                self.cache.clear()
+            self.cache.update(new_counts)
+            self.num_encoded += len(new_counts)
+        return [new_counts[key] if count is None else count for key, count in zip(keys, counts)]
+
+    def stats(self):
+        return {"num_hits": self.num_hits, "num_encoded": self.num_encoded, "cache_size": len(self.cache)}
+
+
+_token_counters = {}
+_token_counters_lock = threading.Lock()
+
+
+def get_token_counter(tokenizer, add_special_tokens=False) -> TokenCounter:
+    """Shared `TokenCounter` of a tokenizer, tokenizers loaded from the same model share one counter."""
+    if hasattr(tokenizer, "encode_batch"):
+        tokenizer_key = ("tiktoken", tokenizer.name)
+    else:
+        tokenizer_key = ("hf", getattr(tokenizer, "name_or_path", None) or id(tokenizer))
+    key = (tokenizer_key, add_special_tokens)
+    with _token_counters_lock:
+        if key not in _token_counters:
+            _token_counters[key] = TokenCounter(tokenizer, add_special_tokens=add_special_tokens)
+        return _token_counters[key]
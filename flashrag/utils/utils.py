@@ -2,7 +2,7 @@ import os
 import json
 import importlib
 from transformers import AutoConfig
-from flashrag.dataset.dataset import Dataset
+from flashrag.dataset.dataset import Dataset, ColumnarDataset
 
 
 def get_dataset(config):
@@ -11,6 +11,11 @@ def get_dataset(config):
 
     dataset_path = config["dataset_path"]
     all_split = config["split"]
+    dataset_backend = config["dataset_backend"] if "dataset_backend" in config else None
+    if dataset_backend == "columnar":
+        dataset_class = ColumnarDataset
+    else:
+        dataset_class = Dataset
 
     split_dict = {split: None for split in all_split}
 
@@ -28,11 +33,11 @@ def get_dataset(config):
         else:
             print(f"Loading {split} dataset from: {split_path}...")
         if split in ["test", "val", "dev"]:
-            split_dict[split] = Dataset(
+            split_dict[split] = dataset_class(
                 config, split_path, sample_num=config["test_sample_num"], random_sample=config["random_sample"]
             )
         else:
-            split_dict[split] = Dataset(config, split_path)
+            split_dict[split] = dataset_class(config, split_path)
 
     return split_dict
 
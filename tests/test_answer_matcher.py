@@ -0,0 +1,57 @@
+import sys
+import pytest
+
+pytest.importorskip("numpy")
+
+from flashrag.evaluator.metrics import AnswerMatcher, Retrieval_Recall
+
+CASES = [
+    (["paris"], "the capital is paris", True),
+    (["paris"], "the capital is rome", False),
+    (["new york", "york"], "born in york", True),
+    (["new york", "york"], "born in new jersey", False),
+    (["a.b", "c+"], "value a.b here", True),
+    (["a.b", "c+"], "value axb here", False),
+    (["", "paris"], "anything", True),
+    ([], "anything", False),
+]
+
+
+@pytest.fixture(params=["ahocorasick", "regex"])
+def backend(request, monkeypatch):
+    if request.param == "ahocorasick":
+        pytest.importorskip("ahocorasick")
+    else:
+        # a None entry makes `import ahocorasick` raise ImportError
+        monkeypatch.setitem(sys.modules, "ahocorasick", None)
+    return request.param
+
+
+@pytest.mark.parametrize("answers, text, expected", CASES)
+def test_has_match(backend, answers, text, expected):
+    matcher = AnswerMatcher(answers)
+    assert (matcher.automaton is not None) == (backend == "ahocorasick" and "" not in answers and len(answers) > 0)
+    assert matcher.has_match(text) == expected
+
+
+def test_backends_agree_with_substring_search(monkeypatch):
+    pytest.importorskip("ahocorasick")
+    answers = ["war", "king", "new york", "1945", "of the"]
+    texts = ["the king of the north", "new yorker", "in 1944", "warsaw", "the end", "newyork"]
+    automaton_results = [AnswerMatcher(answers).has_match(text) for text in texts]
+    monkeypatch.setitem(sys.modules, "ahocorasick", None)
+    regex_results = [AnswerMatcher(answers).has_match(text) for text in texts]
+    expected = [any(answer in text for answer in answers) for text in texts]
+    assert automaton_results == regex_results == expected
+
+
+def test_doc_norm_cache_is_bounded_and_detects_rewritten_docs(monkeypatch):
+    monkeypatch.setattr(Retrieval_Recall, "cached_doc_norms", type(Retrieval_Recall.cached_doc_norms)())
+    monkeypatch.setattr(Retrieval_Recall, "max_cached_docs", 2)
+    metric = Retrieval_Recall({"dataset_name": "test", "metric_setting": {"retrieval_recall_topk": 5}})
+
+    assert metric.normalize_doc({"id": "1", "contents": "The Paris."}) == "paris"
+    assert metric.normalize_doc({"id": "1", "contents": "Rome!"}) == "rome"
+    metric.normalize_doc({"id": "2", "contents": "b"})
+    metric.normalize_doc({"id": "3", "contents": "c"})
+    assert list(metric.cached_doc_norms) == ["2", "3"]
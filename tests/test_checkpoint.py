@@ -0,0 +1,84 @@
+import json
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from flashrag.dataset import Dataset
+from flashrag.pipeline import BasicPipeline
+
+
+class FakeRetriever:
+    def __init__(self):
+        self.num_saves = 0
+
+    def _save_cache(self):
+        self.num_saves += 1
+
+
+class UpperPipeline(BasicPipeline):
+    """Predicts the upper-cased question, counts the items it runs."""
+
+    def __init__(self, config):
+        super().__init__(config, prompt_template=object())
+        self.retriever = FakeRetriever()
+        self.run_ids = []
+
+    def run(self, dataset, do_eval=True, pred_process_fun=None):
+        for item in dataset:
+            item.update_output("pred", item.question.upper())
+            self.run_ids.append(item.id)
+        return self.evaluate(dataset, do_eval=do_eval, pred_process_fun=pred_process_fun)
+
+
+def get_config(save_dir):
+    return {
+        "dataset_name": "test",
+        "device": "cpu",
+        "save_dir": str(save_dir),
+        "save_retrieval_cache": True,
+        "save_metric_score": False,
+        "save_intermediate_data": False,
+        "metrics": [],
+        "metric_setting": {},
+    }
+
+
+def get_dataset(config, num_items=5):
+    data = [{"id": str(idx), "question": f"q{idx}", "golden_answers": [f"Q{idx}"]} for idx in range(num_items)]
+    return Dataset(config=config, data=data)
+
+
+def read_records(checkpoint_path):
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_after_truncated_last_line(tmp_path):
+    config = get_config(tmp_path)
+    dataset = get_dataset(config)
+    checkpoint_path = tmp_path / "checkpoint.jsonl"
+    with open(checkpoint_path, "w", encoding="utf-8") as f:
+        for idx in range(2):
+            item = {"id": str(idx), "question": f"q{idx}", "golden_answers": [], "output": {"pred": f"Q{idx}"}}
+            f.write(json.dumps({"index": idx, "id": str(idx), "item": item}) + "\n")
+        # record cut by a crash, without the final newline
+        f.write('{"index": 2, "id": "2", "item": {"id": "2", "que')
+
+    pipeline = UpperPipeline(config)
+    result = pipeline.run_with_checkpoint(dataset, do_eval=False, chunk_size=2, resume_dir=str(tmp_path))
+
+    assert pipeline.run_ids == ["2", "3", "4"]
+    assert result.pred == ["Q0", "Q1", "Q2", "Q3", "Q4"]
+    # every line of the repaired checkpoint is valid, each item is recorded once
+    records = read_records(checkpoint_path)
+    assert sorted(record["index"] for record in records) == [0, 1, 2, 3, 4]
+
+
+def test_retrieval_cache_saved_once(tmp_path):
+    config = get_config(tmp_path)
+    pipeline = UpperPipeline(config)
+    pipeline.run_with_checkpoint(get_dataset(config), do_eval=False, chunk_size=2)
+
+    assert pipeline.retriever.num_saves == 1
+    assert len(read_records(tmp_path / "checkpoint.jsonl")) == 5
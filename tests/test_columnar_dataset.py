@@ -0,0 +1,112 @@
+import json
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("datasets")
+pytest.importorskip("PIL")
+
+from flashrag.dataset import Dataset, ColumnarDataset, RaggedColumn
+from flashrag.dataset.utils import split_dataset, merge_dataset, get_batch_dataset
+
+DOCS = [{"id": str(idx), "contents": f"Title {idx}\ntext of doc {idx}"} for idx in range(3)]
+RECORDS = [
+    {
+        "id": f"q{idx}",
+        "question": f"question {idx}?",
+        "golden_answers": [f"answer {idx}"],
+        "output": {"retrieval_result": [DOCS[idx % 3], DOCS[(idx + 1) % 3]], "doc_scores": [0.5, 0.25]},
+    }
+    for idx in range(5)
+]
+
+
+def get_dataset():
+    return ColumnarDataset(config={"dataset_name": "test"}, data=RECORDS)
+
+
+def test_build_from_records():
+    dataset = get_dataset()
+    assert len(dataset) == 5
+    assert dataset.id == [record["id"] for record in RECORDS]
+    assert dataset[1].question == "question 1?"
+    assert dataset[-1].id == "q4"
+    assert dataset[1].retrieval_result == [DOCS[1], DOCS[2]]
+    assert isinstance(dataset.get_column("retrieval_result"), RaggedColumn)
+    # each doc is pooled once
+    assert len(dataset.doc_pool.docs) == 3
+    with pytest.raises(IndexError):
+        dataset[5]
+    with pytest.raises(IndexError):
+        dataset[-6]
+
+
+def test_iteration():
+    dataset = get_dataset()
+    assert [item.id for item in dataset] == dataset.id
+    assert list(zip(dataset, range(10)))[-1][1] == 4
+
+
+def test_update_output_columns():
+    dataset = get_dataset()
+    dataset.update_output("retrieval_result", [[DOCS[2]]] * 5)
+    dataset.update_output("doc_scores", [[1, 2], [3], [], [4], [5, 6, 7]])
+    dataset.update_output("pred", [f"pred {idx}" for idx in range(5)])
+
+    assert isinstance(dataset.get_column("retrieval_result"), RaggedColumn)
+    assert dataset[3].retrieval_result == [DOCS[2]]
+    values, offsets = dataset.get_ragged_arrays("doc_scores")
+    assert values.dtype == np.int64 and offsets.tolist() == [0, 2, 3, 3, 4, 7]
+    assert dataset.doc_scores[4] == [5, 6, 7]
+    assert isinstance(dataset.get_column("pred"), list)
+    assert dataset.pred == [f"pred {idx}" for idx in range(5)]
+
+
+def test_item_view_updates_write_back():
+    dataset = get_dataset()
+    item = dataset[2]
+    item.update_output("pred", "answer 2")
+    item.update_output("doc_scores", [0.1])
+    item.update_output("retrieval_result", "not a doc list")
+    item.update_evaluation_score("em", 1.0)
+    item.update_evaluation_score("f1", 0.5)
+
+    assert dataset.pred == [None, None, "answer 2", None, None]
+    assert dataset.doc_scores[2] == [0.1]
+    assert dataset.retrieval_result[2] == "not a doc list"
+    assert dataset.retrieval_result[0] == [DOCS[0], DOCS[1]]
+    assert dataset[2].output["metric_score"] == {"em": 1.0, "f1": 0.5}
+    assert "pred" not in dataset[0].output
+    with pytest.raises(AttributeError):
+        item.update_output("question", "changed")
+
+
+def test_to_dict_and_save_round_trip(tmp_path):
+    dataset = get_dataset()
+    dataset[0].update_output("pred", "answer 0")
+    assert dataset[0].to_dict()["output"] == dict(RECORDS[0]["output"], pred="answer 0")
+
+    save_path = str(tmp_path / "data.jsonl")
+    dataset.save(save_path)
+    loaded = ColumnarDataset(config={"dataset_name": "test"}, dataset_path=save_path)
+    assert [item.to_dict() for item in loaded] == [item.to_dict() for item in dataset]
+
+    save_path = str(tmp_path / "data.json")
+    dataset.save(save_path)
+    with open(save_path, "r", encoding="utf-8") as f:
+        assert json.load(f) == [item.to_dict() for item in dataset]
+
+
+def test_split_merge_and_batch_keep_row_order():
+    dataset = get_dataset()
+    split_symbol = [True, False, True, True, False]
+    dataset_split = split_dataset(dataset, split_symbol)
+    assert [item.id for item in dataset_split[True]] == ["q0", "q2", "q3"]
+    assert [item.id for item in dataset_split[False]] == ["q1", "q4"]
+
+    merged = merge_dataset(dataset_split, split_symbol)
+    assert merged.id == dataset.id
+    assert [item.retrieval_result for item in merged] == list(dataset.retrieval_result)
+
+    batches = list(get_batch_dataset(dataset, batch_size=2))
+    assert [batch.id for batch in batches] == [["q0", "q1"], ["q2", "q3"], ["q4"]]
+    assert isinstance(batches[0], Dataset)
@@ -0,0 +1,112 @@
+import json
+import warnings
+import pytest
+
+pytest.importorskip("datasets")
+pytest.importorskip("PIL")
+
+from flashrag.dataset import Dataset, ColumnarDataset
+from flashrag.dataset.utils import save_compact_dataset, load_compact_dataset, DocRefList
+
+CORPUS = [{"id": str(idx), "contents": f"Title {idx}\ntext of doc {idx}"} for idx in range(5)]
+
+
+class ListCorpus(list):
+    """A loaded corpus: docs by row, the `id` column by name."""
+
+    def __getitem__(self, key):
+        if key == "id":
+            return [doc["id"] for doc in self]
+        return list.__getitem__(self, key)
+
+
+def get_dataset(dataset_class=Dataset):
+    data = [
+        {
+            "id": "q0",
+            "question": "who?",
+            "golden_answers": ["doc 1"],
+            "output": {
+                "retrieval_result": [CORPUS[1], CORPUS[3]],
+                "doc_scores": [0.9, 0.4],
+                "pred": "doc 1",
+                "metric_score": {"em": 1.0},
+            },
+        },
+        {
+            "id": "q1",
+            "question": "what?",
+            "golden_answers": ["doc 4"],
+            "output": {
+                "retrieval_result": [CORPUS[4]],
+                "retrieval_result_iter_0": [CORPUS[0], CORPUS[4]],
+                "doc_scores": [0.7],
+                "pred": "none",
+            },
+        },
+    ]
+    return dataset_class(config={"dataset_name": "test"}, data=data)
+
+
+def write_corpus(corpus_path, corpus):
+    with open(corpus_path, "w", encoding="utf-8") as f:
+        for doc in corpus:
+            f.write(json.dumps(doc) + "\n")
+
+
+def assert_same_items(loaded, dataset):
+    assert len(loaded) == len(dataset)
+    for loaded_item, item in zip(loaded, dataset):
+        assert loaded_item.id == item.id
+        assert loaded_item.question == item.question
+        assert loaded_item.golden_answers == item.golden_answers
+        for key, value in item.output.items():
+            loaded_value = loaded_item.output[key]
+            if isinstance(value, list):
+                loaded_value = list(loaded_value)
+            assert loaded_value == value
+
+
+@pytest.mark.parametrize("dataset_class", [Dataset, ColumnarDataset])
+def test_round_trip_with_loaded_corpus(tmp_path, dataset_class):
+    dataset = get_dataset(dataset_class)
+    save_path = str(tmp_path / "data.compact.jsonl")
+    save_compact_dataset(dataset, save_path)
+
+    # docs are stored as ids, not contents
+    with open(save_path, "r", encoding="utf-8") as f:
+        header, first_item = json.loads(f.readline()), json.loads(f.readline())
+    assert header["format"] == "flashrag-compact" and header["num_items"] == 2
+    assert first_item["output"]["retrieval_result"] == {"__doc_ids__": ["1", "3"]}
+
+    loaded = load_compact_dataset(save_path, corpus=ListCorpus(CORPUS))
+    assert isinstance(loaded[0].retrieval_result, DocRefList)
+    assert_same_items(loaded, dataset)
+
+
+def test_round_trip_compressed(tmp_path):
+    pytest.importorskip("zstandard")
+    corpus_path = str(tmp_path / "corpus.jsonl")
+    write_corpus(corpus_path, CORPUS)
+    dataset = get_dataset()
+    save_path = str(tmp_path / "data.compact.jsonl.zst")
+    save_compact_dataset(dataset, save_path, corpus_path=corpus_path, compress=True)
+
+    with open(save_path, "rb") as f:
+        assert f.read(4) == b"\x28\xb5\x2f\xfd"
+    # the corpus matches its fingerprint in the header, no warning
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        loaded = load_compact_dataset(save_path, config={"dataset_name": "test"}, corpus=ListCorpus(CORPUS))
+    assert_same_items(loaded, dataset)
+
+
+def test_changed_corpus_warns(tmp_path):
+    corpus_path = str(tmp_path / "corpus.jsonl")
+    write_corpus(corpus_path, CORPUS)
+    save_path = str(tmp_path / "data.compact.jsonl")
+    save_compact_dataset(get_dataset(), save_path, corpus_path=corpus_path)
+    write_corpus(corpus_path, [dict(doc, contents=doc["contents"] + " (edited)") for doc in CORPUS])
+
+    with pytest.warns(UserWarning, match="does not match"):
+        load_compact_dataset(save_path)
@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+from flashrag.pipeline.parallel import ParallelPipelineRunner
+
+VOCAB = ["<pad>", "<unk>", "query", ":", "paris", "rome"]
+
+
+def get_config(**kwargs):
+    config = {
+        "dataset_name": "test",
+        "save_dir": "",
+        "save_metric_score": False,
+        "save_intermediate_data": False,
+        "metrics": [],
+        "metric_setting": {},
+        "gpu_num": 0,
+        "gpu_id": None,
+    }
+    config.update(kwargs)
+    return config
+
+
+@pytest.mark.parametrize("framework", ["vllm", "fschat"])
+def test_cpu_workers_reject_gpu_only_generators(framework):
+    with pytest.raises(AssertionError, match=framework):
+        ParallelPipelineRunner(get_config(framework=framework), pipeline_class=object, num_workers=2)
+    # gpu workers are not checked
+    ParallelPipelineRunner(get_config(framework=framework), pipeline_class=object, worker_devices=["0", "1"])
+
+
+def test_cpu_workers_with_hf_generator():
+    runner = ParallelPipelineRunner(get_config(framework="hf"), pipeline_class=object, num_workers=2)
+    assert runner.worker_devices == ["cpu", "cpu"]
+
+
+def test_encoder_runs_on_configured_device(tmp_path):
+    pytest.importorskip("langid")
+    from transformers import BertConfig, BertModel, PreTrainedTokenizerFast
+    from flashrag.retriever.encoder import Encoder
+
+    model = tokenizers.models.WordLevel({token: idx for idx, token in enumerate(VOCAB)}, unk_token="<unk>")
+    tokenizer = tokenizers.Tokenizer(model)
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", unk_token="<unk>").save_pretrained(tmp_path)
+    bert_config = BertConfig(
+        vocab_size=len(VOCAB), hidden_size=8, num_hidden_layers=1, num_attention_heads=2, intermediate_size=16
+    )
+    BertModel(bert_config).save_pretrained(tmp_path)
+
+    encoder = Encoder(
+        model_name="test",
+        model_path=str(tmp_path),
+        pooling_method="mean",
+        max_length=8,
+        use_fp16=False,
+        instruction="query :",
+        device="cpu",
+    )
+    assert next(encoder.model.parameters()).device.type == "cpu"
+    query_emb = encoder.encode(["paris", "rome paris"], batch_size=1)
+    assert query_emb.shape == (2, 8)
+    assert query_emb[0] == pytest.approx(query_emb[0] / (query_emb[0] ** 2).sum() ** 0.5)
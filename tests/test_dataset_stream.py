@@ -0,0 +1,87 @@
+import json
+import pytest
+
+pytest.importorskip("datasets")
+
+from flashrag.dataset import Dataset
+import flashrag.dataset.dataset as dataset_module
+
+
+def write_records(data_path, num_items=10):
+    with open(data_path, "w", encoding="utf-8") as f:
+        for idx in range(num_items):
+            f.write(json.dumps({"id": str(idx), "question": f"q{idx}", "golden_answers": [f"Q{idx}"]}) + "\n")
+    return str(data_path)
+
+
+def test_iter_chunks_reads_one_chunk_at_a_time(tmp_path, monkeypatch):
+    data_path = write_records(tmp_path / "test.jsonl")
+    num_read = []
+    iter_records = dataset_module.iter_records
+
+    def counting_iter_records(dataset_path):
+        for record in iter_records(dataset_path):
+            num_read.append(record["id"])
+            yield record
+
+    monkeypatch.setattr(dataset_module, "iter_records", counting_iter_records)
+    chunks = Dataset.iter_chunks({"dataset_name": "test"}, data_path, chunk_size=3)
+    first_chunk = next(chunks)
+    assert first_chunk.id == ["0", "1", "2"] and len(num_read) == 3
+
+    assert [chunk.id for chunk in chunks] == [["3", "4", "5"], ["6", "7", "8"], ["9"]]
+
+
+def test_iter_chunks_sampling(tmp_path):
+    data_path = write_records(tmp_path / "test.jsonl")
+    chunks = list(Dataset.iter_chunks({"dataset_name": "test"}, data_path, chunk_size=3, sample_num=5))
+    assert [chunk.id for chunk in chunks] == [["0", "1", "2"], ["3", "4"]]
+
+    chunks = list(Dataset.iter_chunks({"dataset_name": "test"}, data_path, chunk_size=3, sample_num=4, random_sample=True))
+    sampled_ids = [item_id for chunk in chunks for item_id in chunk.id]
+    assert [len(chunk) for chunk in chunks] == [3, 1]
+    assert len(set(sampled_ids)) == 4 and set(sampled_ids) <= {str(idx) for idx in range(10)}
+
+
+class FakeRetriever:
+    def batch_search(self, queries):
+        return [[{"id": query, "contents": f"doc of {query}"}] for query in queries]
+
+
+class FakeGenerator:
+    def generate(self, prompts):
+        return [prompt.upper() for prompt in prompts]
+
+
+class FakeTemplate:
+    def get_string(self, question, retrieval_result):
+        return f"{question}: {retrieval_result[0]['contents']}"
+
+
+def test_run_streaming_from_data_file(tmp_path):
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from flashrag.pipeline import SequentialPipeline
+
+    config = {
+        "dataset_name": "test",
+        "device": "cpu",
+        "save_dir": str(tmp_path),
+        "save_retrieval_cache": False,
+        "save_metric_score": False,
+        "save_intermediate_data": True,
+        "disable_save": False,
+        "metrics": [],
+        "metric_setting": {},
+        "use_fid": False,
+        "refiner_name": None,
+        "test_sample_num": 7,
+    }
+    data_path = write_records(tmp_path / "test.jsonl")
+    pipeline = SequentialPipeline(config, prompt_template=FakeTemplate(), retriever=FakeRetriever(), generator=FakeGenerator())
+
+    dataset = pipeline.run_streaming(data_path, do_eval=False, chunk_size=3)
+    assert dataset.id == [str(idx) for idx in range(7)]
+    assert dataset.pred[6] == "Q6: DOC OF Q6"
+    with open(tmp_path / "stream_output.jsonl", "r", encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == dataset.id
@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("numpy")
+# importing flashrag.pipeline loads the generator modules
+pytest.importorskip("transformers")
+
+from flashrag.pipeline.utils import RetrievalSession
+
+
+class FakeRetriever:
+    """Returns fixed docs and scores per query, records the queries of each call."""
+
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def batch_search(self, queries, return_score=False):
+        self.calls.append(list(queries))
+        return [self.results[query][0] for query in queries], [self.results[query][1] for query in queries]
+
+
+def doc(doc_id):
+    return {"id": doc_id, "contents": f"contents of {doc_id}"}
+
+
+def get_ids(docs):
+    return [d["id"] for d in docs]
+
+
+def test_merge_keeps_max_score_and_sorts_by_score():
+    session = RetrievalSession(FakeRetriever({}), num_items=1)
+    session.add(0, [doc("a"), doc("b")], [0.5, 0.9])
+    session.add(0, [doc("b"), doc("c"), doc("a")], [0.3, 0.7, 0.8])
+
+    assert get_ids(session.get_docs(0)) == ["b", "a", "c"]
+    assert get_ids(session.get_docs(0, ascending=True)) == ["c", "a", "b"]
+    assert get_ids(session.get_docs(0, topk=2)) == ["b", "a"]
+    assert get_ids(session.get_docs(0, topk=2, ascending=True)) == ["a", "b"]
+
+
+def test_equal_scores_keep_first_retrieved_order():
+    session = RetrievalSession(FakeRetriever({}), num_items=2)
+    session.add(0, [doc("c"), doc("a")], [1.0, 1.0])
+    session.add(0, [doc("b"), doc("a")], [1.0, 0.1])
+    session.add(1, [doc("a")], [0.2])
+
+    assert get_ids(session.get_docs(0)) == ["c", "a", "b"]
+    assert get_ids(session.get_docs(0, ascending=True)) == ["c", "a", "b"]
+    # items do not share their docs, the pool does
+    assert get_ids(session.get_docs(1)) == ["a"]
+    assert len(session.doc_pool) == 3
+
+
+def test_search_reuses_issued_queries():
+    retriever = FakeRetriever({"q1": ([doc("a")], [0.1]), "q2": ([doc("b")], [0.2])})
+    session = RetrievalSession(retriever, num_items=3)
+
+    docs, scores = session.search(["q1", "q2", "q1"])
+    assert [get_ids(d) for d in docs] == [["a"], ["b"], ["a"]]
+    assert scores == [[0.1], [0.2], [0.1]]
+    session.search(["q2"])
+
+    assert retriever.calls == [["q1", "q2"]]
+    assert session.stats() == {"num_queries": 4, "num_searched_queries": 2, "num_avoided_queries": 2, "num_search_calls": 1}
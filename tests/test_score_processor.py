@@ -0,0 +1,50 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from flashrag.generator.score_processor import GenerationScoreProcessor
+
+
+def simulate_generation(processor, prompt_ids, step_scores):
+    """Greedy decoding loop of `generate`: the processor sees the scores of each step before the token is chosen."""
+    input_ids = prompt_ids
+    for scores in step_scores:
+        scores = processor(input_ids, scores)
+        input_ids = torch.cat([input_ids, scores.argmax(dim=-1, keepdim=True)], dim=1)
+    return input_ids
+
+
+def test_chosen_log_probs_match_log_softmax():
+    torch.manual_seed(0)
+    prompt_ids = torch.tensor([[1, 2, 3], [4, 5, 6]])
+    step_scores = [torch.randn(2, 10) for _ in range(4)]
+    processor = GenerationScoreProcessor(prompt_length=3, topk=3)
+    sequences = simulate_generation(processor, prompt_ids, step_scores)
+
+    chosen_log_probs, topk_log_probs, topk_token_ids = processor.finalize(sequences)
+
+    expected = torch.stack(
+        [scores.log_softmax(dim=-1).gather(1, sequences[:, 3 + step, None]).squeeze(-1) for step, scores in enumerate(step_scores)],
+        dim=1,
+    )
+    assert chosen_log_probs.shape == (2, 4)
+    assert torch.allclose(chosen_log_probs, expected)
+    expected_topk = torch.stack([scores.log_softmax(dim=-1).topk(3, dim=-1).values for scores in step_scores], dim=1)
+    assert topk_log_probs.shape == (2, 4, 3)
+    assert torch.allclose(topk_log_probs, expected_topk)
+    # greedy decoding chooses the top-1 token
+    assert torch.equal(topk_token_ids[:, :, 0], sequences[:, 3:])
+
+
+def test_scores_are_not_modified():
+    scores = torch.randn(2, 5)
+    processor = GenerationScoreProcessor(prompt_length=1)
+    assert processor(torch.tensor([[0], [1]]), scores) is scores
+
+
+def test_no_generated_tokens():
+    processor = GenerationScoreProcessor(prompt_length=2, topk=2)
+    chosen_log_probs, topk_log_probs, topk_token_ids = processor.finalize(torch.tensor([[1, 2], [3, 4]]))
+    assert chosen_log_probs.shape == (2, 0)
+    assert topk_log_probs is None and topk_token_ids is None
@@ -0,0 +1,90 @@
+import json
+import math
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from statistics import NormalDist
+from flashrag.evaluator.significance import bootstrap_ci, paired_bootstrap, paired_permutation_test, compare_runs
+
+
+def exact_sign_flip_p_value(num_positive, num_negative):
+    """Exact two-sided p-value of the sign-flip test for +1 / -1 differences."""
+    num_nonzero = num_positive + num_negative
+    observed = abs(num_positive - num_negative)
+    num_extreme = sum(math.comb(num_nonzero, k) for k in range(num_nonzero + 1) if abs(2 * k - num_nonzero) >= observed)
+    return num_extreme / 2**num_nonzero
+
+
+@pytest.mark.parametrize("num_positive, num_negative, num_ties", [(8, 0, 92), (6, 2, 0), (30, 18, 52)])
+def test_permutation_test_matches_exact_p_value(num_positive, num_negative, num_ties):
+    scores_a = np.array([1.0] * num_positive + [0.0] * num_negative + [1.0] * num_ties)
+    scores_b = np.array([0.0] * num_positive + [1.0] * num_negative + [1.0] * num_ties)
+    result = paired_permutation_test(scores_a, scores_b, num_permutations=20000, seed=0)
+
+    expected = exact_sign_flip_p_value(num_positive, num_negative)
+    assert result["num_items"] == num_positive + num_negative + num_ties
+    assert result["mean_diff"] == pytest.approx((num_positive - num_negative) / result["num_items"])
+    # within 4 standard errors of the Monte Carlo estimate
+    assert result["p_value"] == pytest.approx(expected, abs=4 * math.sqrt(expected * (1 - expected) / 20000) + 1e-4)
+
+
+def test_permutation_test_continuous_scores_match_normal_approximation():
+    rng = np.random.default_rng(0)
+    diffs = rng.normal(size=2000)
+    # shift so that the observed mean is at the two-sided 5% level
+    diffs = diffs - diffs.mean() + 1.96 * np.sqrt((diffs**2).sum()) / len(diffs)
+    result = paired_permutation_test(diffs, np.zeros_like(diffs), num_permutations=20000, seed=0)
+
+    z = abs(diffs.mean()) / (np.sqrt((diffs**2).sum()) / len(diffs))
+    expected = 2 * (1 - NormalDist().cdf(z))
+    assert result["p_value"] == pytest.approx(expected, abs=0.01)
+
+
+def test_bootstrap_ci_of_binary_scores():
+    scores = np.array([1.0] * 300 + [0.0] * 700)
+    result = bootstrap_ci(scores, num_resamples=20000, seed=0)
+
+    half_width = 1.96 * math.sqrt(0.3 * 0.7 / len(scores))
+    assert result["mean"] == pytest.approx(0.3)
+    assert result["ci"][0] == pytest.approx(0.3 - half_width, abs=0.005)
+    assert result["ci"][1] == pytest.approx(0.3 + half_width, abs=0.005)
+
+
+def test_paired_bootstrap():
+    scores = np.array([1.0, 0.0] * 50)
+    same = paired_bootstrap(scores, scores, num_resamples=1000, seed=0)
+    assert same["mean_diff"] == 0 and same["ci"] == (0.0, 0.0) and same["p_value"] == 1.0
+
+    better = paired_bootstrap(np.ones(100), scores, num_resamples=1000, seed=0)
+    assert better["mean_diff"] == pytest.approx(0.5)
+    assert better["ci"][0] > 0 and better["p_value"] == 0.0
+
+
+def test_nan_scores_are_ignored_and_results_are_seeded():
+    scores_a = np.array([1.0, math.nan, 0.0, 1.0, 1.0, 0.0])
+    scores_b = np.array([0.0, 1.0, 0.0, math.nan, 0.0, 1.0])
+    result = paired_bootstrap(scores_a, scores_b, num_resamples=500, seed=1)
+    assert result["num_items"] == 4
+    assert result == paired_bootstrap(scores_a, scores_b, num_resamples=500, seed=1)
+    assert bootstrap_ci([math.nan])["num_items"] == 0
+
+
+def write_run(save_dir, ids, em_scores):
+    save_dir.mkdir()
+    data = [{"id": item_id, "output": {"metric_score": {"em": em}}} for item_id, em in zip(ids, em_scores)]
+    with open(save_dir / "intermediate_data.json", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    return str(save_dir)
+
+
+def test_compare_runs_pairs_items_by_id(tmp_path):
+    ids = [str(idx) for idx in range(100)]
+    run_a = write_run(tmp_path / "a", ids, [1.0] * 60 + [0.0] * 40)
+    # same scores in reversed order, the runs only match when items are paired by id
+    run_b = write_run(tmp_path / "b", ids[::-1], ([1.0] * 60 + [0.0] * 40)[::-1])
+
+    result = compare_runs(run_a, run_b, num_resamples=1000, seed=0)["em"]
+    assert result["run_a"]["mean"] == pytest.approx(0.6)
+    assert result["paired_bootstrap"]["mean_diff"] == 0
+    assert result["permutation_test"]["p_value"] == 1.0
@@ -0,0 +1,109 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+from transformers import PreTrainedTokenizerFast
+from flashrag.generator.stop_word_criteria import StopWordCriteria, truncate_at_stop_words
+from flashrag.generator.multimodal_generator import HFMultiModalGenerator
+
+VOCAB = ["<pad>", "a", "Answer", ":", "Paris", "is", "nice", "Question", "."]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    model = tokenizers.models.WordLevel({token: idx for idx, token in enumerate(VOCAB)}, unk_token="a")
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizers.Tokenizer(model), pad_token="<pad>")
+
+
+def ids(*tokens):
+    return [VOCAB.index(token) for token in tokens]
+
+
+def run_steps(criteria, prompt, rows):
+    """Feed the rows to the criteria one generated token per step, return the finished flags of each step."""
+    finished_steps = []
+    for step in range(len(rows[0])):
+        input_ids = torch.tensor([prompt + row[: step + 1] for row in rows])
+        finished_steps.append(criteria(input_ids, None).tolist())
+    return finished_steps
+
+
+def test_single_token_stop_word_stops_only_its_row(tokenizer):
+    criteria = StopWordCriteria(tokenizer, stop_words=["Question"], prompt_length=2)
+    rows = [ids("Paris", "Question", "is"), ids("Paris", "is", "nice")]
+    assert run_steps(criteria, ids("Answer", ":"), rows) == [[False, False], [True, False], [True, False]]
+
+
+def test_stop_word_spanning_tokens(tokenizer):
+    criteria = StopWordCriteria(tokenizer, stop_words=["is nice"], prompt_length=1)
+    rows = [ids("Paris", "is", "nice", "."), ids("is", "Paris", "is", "Paris")]
+    finished_steps = run_steps(criteria, ids("Answer"), rows)
+    assert finished_steps == [[False, False], [False, False], [True, False], [True, False]]
+
+
+def test_prompt_length_inferred_and_reset(tokenizer):
+    criteria = StopWordCriteria(tokenizer, stop_words=["Question"])
+    # the stop word in the prompt is not part of the generated text
+    prompt = ids("Question", ":")
+    assert run_steps(criteria, prompt, [ids("Paris", "Question")]) == [[False], [True]]
+    criteria.reset()
+    assert run_steps(criteria, prompt, [ids("Paris", "nice")]) == [[False], [False]]
+
+
+def test_reset_between_batches_of_different_sizes(tokenizer):
+    criteria = StopWordCriteria(tokenizer, stop_words=["Question"])
+    prompt = ids("Answer", ":")
+    assert run_steps(criteria, prompt, [ids("Question", "is"), ids("Paris", "is")]) == [[True, False], [True, False]]
+    criteria.reset()
+    # no row is carried over from the previous batch
+    assert run_steps(criteria, prompt, [ids("Paris", "Question")]) == [[False], [True]]
+
+
+class FakeInferenceEngine:
+    """Runs the stopping criteria of each call over the tokens of the messages, returns the finished flags."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.criteria = []
+
+    def generate(self, input_list, **params):
+        criteria = params["stopping_criteria"][0]
+        self.criteria.append(criteria)
+        rows = [ids(*messages[0]["content"].split()) for messages in input_list]
+        return run_steps(criteria, ids("Answer", ":"), rows)[-1]
+
+
+def test_multimodal_generator_uses_new_criteria_per_batch(tokenizer):
+    generator = HFMultiModalGenerator.__new__(HFMultiModalGenerator)
+    generator.batch_size = 2
+    generator.generation_params = {}
+    generator.inference_engine = FakeInferenceEngine(tokenizer)
+    input_list = [[{"role": "user", "content": content}] for content in ["Paris Question", "Paris is", "Paris nice"]]
+
+    assert generator.generate(input_list, stop=["Question"]) == [True, False, False]
+    first_criteria, second_criteria = generator.inference_engine.criteria
+    assert first_criteria is not second_criteria
+
+
+def test_extract_answers(tokenizer):
+    criteria = StopWordCriteria(tokenizer, stop_words=["Question"], prompt_length=2)
+    input_ids = torch.tensor([ids("Answer", ":", "Paris", "Question", "is"), ids("Answer", ":", "is", "nice", ".")])
+    criteria(input_ids, None)
+    assert criteria.extract_answers(input_ids) == ["Paris ", "is nice ."]
+    assert criteria.extract_answers(input_ids, strip_stopword=False) == ["Paris Question", "is nice ."]
+
+
+@pytest.mark.parametrize(
+    "text, stop_words, strip_stopword, expected",
+    [
+        ("Paris\nQuestion: next", ["\n"], True, "Paris"),
+        ("Paris\nQuestion: next", ["Question", "\n"], True, "Paris"),
+        ("Paris\nQuestion: next", ["Question"], False, "Paris\nQuestion"),
+        ("Paris", ["\n"], True, "Paris"),
+        ("Paris", [], True, "Paris"),
+    ],
+)
+def test_truncate_at_stop_words(text, stop_words, strip_stopword, expected):
+    assert truncate_at_stop_words(text, stop_words, strip_stopword) == expected